@@ -29,15 +29,15 @@ class DactylCLIParser:
                 help="Use the specified target (from the config file).")
 
         if utility == self.UTIL_BUILD:
-            build_mode = parser.add_mutually_exclusive_group(required=False)
-            build_mode.add_argument("--pdf", nargs="?", type=str,
+            # --md, --html, and --es can be combined; --pdf takes precedence
+            parser.add_argument("--pdf", nargs="?", type=str,
                                 const=DEFAULT_PDF_FILE, default=NO_PDF,
                                 help="Output a PDF to this file. Requires Prince.")
-            build_mode.add_argument("--md", action="store_true",
-                                help="Output markdown only")
-            build_mode.add_argument("--html", action="store_true", default=True,
+            parser.add_argument("--md", action="store_true",
+                                help="Output markdown")
+            parser.add_argument("--html", action="store_true",
                                 help="Output HTML files (the default)")
-            build_mode.add_argument("--es", action="store_true",
+            parser.add_argument("--es", action="store_true",
                                 help="Output JSON for ElasticSearch upload")
             # HTML is the default mode
 
@@ -59,6 +59,18 @@ class DactylCLIParser:
                                 help="Upload documents to ElasticSearch cluster "+
                                 "at this URL (http://localhost:9200 by default). "+
                                 "Ignored when making PDFs.")
+            parser.add_argument("--es_publish", action="store_true",
+                                help="With --es_upload, build a new index and "+
+                                "switch the target's alias to it when done, "+
+                                "uploading only documents that changed")
+            parser.add_argument("--incremental", "-i", action="store_true",
+                                help="Only rebuild pages whose inputs changed "+
+                                "since the last build. PDF builds always do "+
+                                "this when their staging folder from the last "+
+                                "build is still there (see pdf_staging_path).")
+            parser.add_argument("--jobs", "-j", type=int, default=1,
+                                help="Render pages in this many parallel "+
+                                "processes (default: 1)")
             parser.add_argument("--leave_temp_files", action="store_true",
                                 help="Leave temp files in place (for debugging or "+
                                 "manual PDF generation). Ignored when using --watch",
@@ -66,6 +78,10 @@ class DactylCLIParser:
             parser.add_argument("--list_targets_only", "-l", action="store_true",
                                 help="Don't build anything, just display list of "+
                                 "known targets from the config file.")
+            parser.add_argument("--offline", action="store_true",
+                                help="Read remote Markdown, templates, and "+
+                                "OpenAPI specs from the cache of earlier "+
+                                "builds instead of the network.")
             parser.add_argument("--only", type=str, help=".md or .html filename of a "+
                                 "single page in the config to build alone.")
             parser.add_argument("--out_dir", "-o", type=str,
@@ -76,6 +92,12 @@ class DactylCLIParser:
                                 "to generate docs from.")
             parser.add_argument("--no_cover", "-n", action="store_true",
                                 help="Don't automatically add a cover / index file.")
+            parser.add_argument("--serve", nargs="?", type=int,
+                                const=DEFAULT_SERVE_PORT, default=None,
+                                help="Serve pages for previewing at "+
+                                "http://localhost on this port (%d by default), " % DEFAULT_SERVE_PORT +
+                                "rendering them on demand and reloading the "+
+                                "browser when they change.")
             parser.add_argument("--skip_preprocessor", action="store_true", default=False,
                                 help="Don't pre-process Jinja syntax in markdown files")
             parser.add_argument("--template_strict_undefined", action="store_true",
@@ -99,6 +121,27 @@ class DactylCLIParser:
             parser.add_argument("-s", "--strict", action="store_true",
                 help="Exit with error even on known problems")
             parser.add_argument("-n", "--no_final_retry", action="store_true",
-                help="Don't wait and retry failed remote links at the end.")
+                help="Don't retry remote links that look broken.")
+            parser.add_argument("-i", "--incremental", action="store_true",
+                help="Only parse pages that changed since the last "+
+                "incremental check. Every page's local links and anchors "+
+                "are still checked, and remote links use the link cache "+
+                "as usual.")
+            parser.add_argument("--jobs", "-j", type=int, default=1,
+                help="Parse and check pages in this many parallel processes "+
+                "(default: 1)")
+            parser.add_argument("--json_report", type=str,
+                help="Also write the results to this file as JSON")
+            parser.add_argument("--junit_report", type=str,
+                help="Also write the results to this file as JUnit XML, "+
+                "with one test case per page")
+            parser.add_argument("--metrics", type=str,
+                help="Write progress metrics (pages/sec, URLs in flight, "+
+                "response times by host, cache hit rate) to this file as "+
+                "JSON lines")
+            parser.add_argument("--max_age", type=float,
+                help="Re-check remote links whose cached results are older "+
+                "than this many seconds (overrides link_cache_ttl and "+
+                "link_cache_broken_ttl)")
 
         self.cli_args = parser.parse_args()
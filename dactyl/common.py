@@ -9,6 +9,7 @@ import json
 import logging
 import os
 import re
+import stat
 import time
 import traceback
 
@@ -22,6 +23,7 @@ DEFAULT_PDF_FILE = "__DEFAULT_FILENAME__"
 NO_PDF = "__NO_PDF__"
 DEFAULT_ES_URL = "__DEFAULT_ES_HOST__"
 NO_ES_UP = "__NO_ES_UP__"
+DEFAULT_SERVE_PORT = 8000
 
 def recoverable_error(msg, bypass_errors):
     """Logs a warning/error message and exits if bypass_errors==False"""
@@ -29,6 +31,30 @@ def recoverable_error(msg, bypass_errors):
     if not bypass_errors:
         exit(1)
 
+def user_temp_path(temp_root, name):
+    """Path to a folder named name in temp_root for the current user only, so
+    that different users don't share (or tamper with) each other's files. Use
+    private_dir() to create it."""
+    if hasattr(os, "getuid"):
+        name = "%s-%d" % (name, os.getuid())
+    return os.path.join(temp_root, name)
+
+def private_dir(path):
+    """Create the folder path (and any missing parents) so that only the
+    current user can use it. If it already exists, make sure it belongs to the
+    current user and other users can't write to it. Raises OSError if not."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if not hasattr(os, "getuid"):
+        return path
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode) or not stat.S_ISDIR(st.st_mode):
+        raise OSError("%s isn't a folder" % path)
+    if st.st_uid != os.getuid():
+        raise OSError("%s belongs to another user" % path)
+    if st.st_mode & 0o022:
+        raise OSError("%s can be written by other users" % path)
+    return path
+
 # Note: this regex means non-ascii characters get stripped from filenames,
 #  which is not preferable when making non-English filenames.
 unacceptable_chars = re.compile(r"[^A-Za-z0-9._ ]+")
@@ -88,7 +114,7 @@ def parse_frontmatter(text):
             frontmatter["name"] = frontmatter["title"]
         if "categories" in frontmatter.keys() and len(frontmatter["categories"]):
             frontmatter["category"] = frontmatter["categories"][0]
-        print("Loaded frontmatter:", frontmatter)#TODO: remove me
+        logger.debug("Loaded frontmatter: %s" % frontmatter)
 
         return text[text.find("---", 3)+4:], frontmatter
     else:
@@ -185,6 +185,12 @@ class DactylConfig:
 
         self.config["skip_preprocessor"] = self.cli_args.skip_preprocessor
 
+        if self.cli_args.es_publish:
+            self.config["es_publish"] = True
+
+        if self.cli_args.offline:
+            self.config["remote_fetch_offline"] = True
+
         if self.cli_args.template_strict_undefined:
             self.config["template_allow_undefined"] = False
         if self.cli_args.pp_strict_undefined:
@@ -208,7 +214,7 @@ class DactylConfig:
 
     def get_es_template(self, filename):
         """Loads an ElasticSearch template (as JSON)"""
-        template_path = os.path.join(self.config["template_path"], filename)
+        template_path = os.path.join(self.config.get("template_path", ""), filename)
         try:
             with open(template_path, encoding="utf-8") as f:
                 es_template = json.load(f)
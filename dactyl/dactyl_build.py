@@ -10,32 +10,44 @@
 from dactyl.common import *
 
 # Necessary to copy static files to the output dir
-from distutils.dir_util import copy_tree, remove_tree
-from shutil import copy as copy_file
+import shutil
 
 # shallow copying of data types
-from copy import copy
+from copy import copy, deepcopy
 
 # Necessary for prince
 import subprocess
 
+# Used to render pages in parallel
+import contextlib
+import io
+import multiprocessing
+import sys
+
 # Used to fetch markdown sources from the net
 import requests
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlunparse
+from dactyl import remote_fetch
 
 # Various content and template processing stuff
 import jinja2
 from markdown import markdown
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, NavigableString
 
 # Watchdog stuff
+import threading
 from watchdog.observers import Observer
 from watchdog.events import PatternMatchingEventHandler
 
-from dactyl.config import DactylConfig
+from dactyl.config import DactylConfig, DEFAULT_CONFIG_FILE
 from dactyl.cli import DactylCLIParser
 from dactyl.openapi import ApiDef
 from dactyl.jinja_loaders import FrontMatterRemoteLoader, FrontMatterFSLoader
+from dactyl.manifest import BuildManifest, hash_value, template_dependencies
+from dactyl.es_upload import ESBulkUploader, ESIndexPublisher, ESPublishError
+from dactyl.dev_server import DevServer
+from dactyl.static_sync import StaticSync
+from dactyl.pdf_chunks import ChunkedPdf, chunk_pages
 
 # These fields are special, and pages don't inherit them directly
 RESERVED_KEYS_TARGET = [
@@ -85,6 +97,37 @@ def temp_dir():
         os.makedirs(run_dir)
     return run_dir
 
+def pdf_staging_dir(target):
+    """Get the folder where target's pages are rendered for Prince, which can
+    be kept between PDF builds so they only have to update what changed.
+    Returns None if PDF staging is turned off or the folder can't be used."""
+    # Prince runs the staged pages' JavaScript, so the folder has to be
+    # private to this user
+    staging_root = config.get("pdf_staging_path",
+            user_temp_path(config["temporary_files_path"], "dactyl-pdf-staging"))
+    if not staging_root:
+        return None
+    # Different projects and config files can have targets with the same name
+    project_hash = hash_value([os.path.abspath(os.getcwd()),
+            os.path.abspath(config.cli_args.config or DEFAULT_CONFIG_FILE)])[:12]
+    staging_dir = os.path.join(staging_root, "%s-%s" % (
+            target_slug_name(target, ["name"]), project_hash))
+    try:
+        private_dir(staging_root)
+        private_dir(staging_dir)
+    except OSError as e:
+        logger.warning("Not using PDF staging folder: %s" % repr(e))
+        return None
+    return staging_dir
+
+def remove_pdf_temp_files(target):
+    """Remove the folder that make_pdf stages target's files in, unless it's
+    the pdf_staging_path from the config."""
+    if config.get("pdf_staging_path"):
+        return
+    temp_files_path = pdf_staging_dir(target) or temp_dir()
+    shutil.rmtree(temp_files_path, ignore_errors=True)
+
 def get_target(target):
     """Get a target by name, or return the default target object.
        We can't use default args in function defs because the default is
@@ -175,11 +218,66 @@ def get_filters_for_page(page, target=None):
     return ffp
 
 
+class PageContent:
+    """
+    The body of a page after its Markdown is parsed and filtered. Keeps the
+    soup that the soup filters worked on, so the table of contents and the
+    ElasticSearch fields can be read from it instead of parsing the HTML
+    again.
+    """
+    def __init__(self, soup=None):
+        if soup is None:
+            soup = BeautifulSoup("", "html.parser")
+        self.soup = soup
+        self._html = None
+
+    @property
+    def html(self):
+        """The content serialized as an HTML string (only done once)."""
+        if self._html is None:
+            logger.info("... re-rendering HTML from soup...")
+            self._html = str(self.soup)
+        return self._html
+
+    def toc(self):
+        return toc_from_headers(self.soup)
+
+    def plaintext(self):
+        return self.soup.get_text()
+
+    def headermap(self):
+        """Map of header text to #anchor for headers that have IDs"""
+        headers = self.soup.find_all(re.compile("h[1-6]"), id=True)
+        return {h.get_text(): "#" + h["id"] for h in headers}
+
+    def blurb(self):
+        """Text of the first non-empty paragraph, or None if there isn't one"""
+        p = self.soup.find("p")
+        while p:
+            if p.get_text().strip():
+                return p.get_text()
+            p = p.find_next_sibling("p")
+        return None
+
+
 def parse_markdown(page, target=None, pages=None, categories=[], mode="html",
                     current_time="", bypass_errors=False):
     """Takes a page object (must contain "md" attribute) and returns parsed
-    and filtered HTML."""
+    and filtered HTML. Pass the target's page list as pages if you have it;
+    otherwise it's computed here."""
+    return parse_page_content(page, target=target, pages=pages,
+                              categories=categories, mode=mode,
+                              current_time=current_time,
+                              bypass_errors=bypass_errors).html
+
+
+def parse_page_content(page, target=None, pages=None, categories=[],
+                       mode="html", current_time="", bypass_errors=False):
+    """Like parse_markdown, but returns a PageContent object, for callers
+    that need more than the HTML string."""
     target = get_target(target)
+    if pages is None:
+        pages = get_pages(target, bypass_errors)
 
     logger.info("Preparing page %s" % page["name"])
 
@@ -192,6 +290,7 @@ def parse_markdown(page, target=None, pages=None, categories=[], mode="html",
     try:
         md = preprocess_markdown(page,
             target=target,
+            pages=pages,
             categories=categories,
             mode=mode,
             current_time=current_time,
@@ -205,6 +304,7 @@ def parse_markdown(page, target=None, pages=None, categories=[], mode="html",
         # Just fetch the md without running the preprocessor
         md = preprocess_markdown(page,
             target=target,
+            pages=pages,
             categories=categories,
             mode=mode,
             current_time=current_time,
@@ -256,9 +356,7 @@ def parse_markdown(page, target=None, pages=None, categories=[], mode="html",
             )
             # ^ the soup filters apply to the same object, passed by reference
 
-    logger.info("... re-rendering HTML from soup...")
-    html2 = str(soup)
-    return html2
+    return PageContent(soup)
 
 
 cached_openapi_specs = {}
@@ -288,6 +386,9 @@ def get_pages(target=None, bypass_errors=False):
         pages = [page for page in pages
                  if should_include(page, target["name"])]
 
+    # Download remote specs all at once before parsing any of them
+    prefetch_remote_sources([p for p in pages if OPENAPI_SPEC_KEY in p])
+
     # Expand OpenAPI spec placeholders into their generated pages
     new_pages = []
     for p in pages:
@@ -362,14 +463,17 @@ def get_categories(pages):
     return categories
 
 
-def preprocess_markdown(page, target=None, categories=[], page_filters=[],
-                        mode="html", current_time="TIME_UNKNOWN",
-                        bypass_errors=False, skip_preprocessor="NOT SPECIFIED",
+def preprocess_markdown(page, target=None, pages=None, categories=[],
+                        page_filters=[], mode="html",
+                        current_time="TIME_UNKNOWN", bypass_errors=False,
+                        skip_preprocessor="NOT SPECIFIED",
                         read_frontmatter=True):
     """Read a markdown file, local or remote, and preprocess it, returning the
-    preprocessed text."""
+    preprocessed text. Pass the target's page list as pages if you have it;
+    otherwise it's computed here."""
     target=get_target(target)
-    pages=get_pages(target, bypass_errors)
+    if pages is None:
+        pages=get_pages(target, bypass_errors)
 
     if skip_preprocessor=="NOT SPECIFIED":
         skip_preprocessor = config["skip_preprocessor"]
@@ -463,27 +567,28 @@ def read_markdown_remote(url):
     # template trying to import another template, so let's assume it's from the
     # base path of the imported template
     if not parsed_url.scheme:
-        url = os.path.join(read_markdown_remote.baseurl, url)
+        url = os.path.join(urlunparse(read_markdown_remote.baseurl), url)
 
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.text
-    else:
-        raise requests.RequestException("Status code for page was not 200")
+    return remote_fetch.fetch(url)
 
 
 def copy_static_files(template_static=True, content_static=True, out_path=None):
-    """Copy static files to the output directory."""
+    """Copy static files to the output directory, skipping files that
+    haven't changed since they were last copied there."""
     if out_path == None:
         out_path = config["out_path"]
+    static_sync = StaticSync(out_path, jobs=config["static_sync_jobs"],
+                             link=config["static_sync_link"],
+                             prune=config["static_sync_prune"],
+                             checksum=config["static_sync_checksum"])
 
     if template_static:
         template_static_src = config["template_static_path"]
 
         if os.path.isdir(template_static_src):
-            template_static_dst = os.path.join(out_path,
-                                       os.path.basename(template_static_src))
-            copy_tree(template_static_src, template_static_dst)
+            template_static_dst = os.path.basename(
+                                       os.path.normpath(template_static_src))
+            static_sync.add_tree(template_static_src, template_static_dst)
         else:
             logger.warning(("Template` static path '%s' doesn't exist; "+
                             "skipping.") % template_static_src)
@@ -497,21 +602,21 @@ def copy_static_files(template_static=True, content_static=True, out_path=None):
 
             for content_static_src in content_static_srcs:
                 if os.path.isdir(content_static_src):
-                    content_static_dst = os.path.join(out_path,
-                                        os.path.basename(content_static_src))
-                    copy_tree(content_static_src, content_static_dst)
+                    content_static_dst = os.path.basename(
+                                        os.path.normpath(content_static_src))
+                    static_sync.add_tree(content_static_src, content_static_dst)
                 elif os.path.isfile(content_static_src):
-                    content_static_dst = os.path.join(out_path,
-                                        os.path.dirname(content_static_src))
                     logger.debug("Copying single content_static_path file '%s'." %
                             content_static_src)
-                    copy_file(content_static_src, content_static_dst)
+                    static_sync.add_file(content_static_src, content_static_src)
                 else:
                     logger.warning("Content static path '%s' doesn't exist; skipping." %
                                     content_static_src)
         else:
             logger.debug("No content_static_path in conf; skipping copy")
 
+    static_sync.sync()
+
 
 def get_page_how(page=None):
     """
@@ -534,8 +639,25 @@ def get_page_how(page=None):
         return HOW_FROM_FILE, config["content_path"]
 
 
+# Preprocessor Jinja environments, shared by pages that load templates from
+# the same place with the same settings, so included templates and macros
+# only get compiled once per build.
+pp_env_pool = {}
+
 def setup_pp_env(page=None, page_filters=[], no_loader=False, strict_undefined=False):
     how, path = get_page_how(page)
+    export_filters = tuple(sorted(f for f in page_filters
+            if f in config.filters.keys() and "export" in dir(config.filters[f])))
+    if how == HOW_FROM_URL or how == HOW_FROM_GENERATOR:
+        # The loader is specific to this page, so don't reuse it
+        pool_key = None
+    elif no_loader:
+        pool_key = (None, strict_undefined, export_filters)
+    else:
+        pool_key = (path, strict_undefined, export_filters)
+    if pool_key in pp_env_pool:
+        return pp_env_pool[pool_key]
+
     if strict_undefined:
         preferred_undefined = jinja2.StrictUndefined
     else:
@@ -554,7 +676,8 @@ def setup_pp_env(page=None, page_filters=[], no_loader=False, strict_undefined=F
     else:
         logger.debug("Using FileSystemLoader for page %s" % page)
         pp_env = jinja2.Environment(undefined=preferred_undefined,
-                loader=FrontMatterFSLoader(path))
+                loader=FrontMatterFSLoader(path),
+                bytecode_cache=get_bytecode_cache("preprocessor"))
 
     # Add custom "defined_and_" tests
     def defined_and_equalto(a,b):
@@ -573,17 +696,97 @@ def setup_pp_env(page=None, page_filters=[], no_loader=False, strict_undefined=F
             for key,val in config.filters[filter_name].export.items():
                 logger.debug("... pulling in filter_%s's exported key '%s'" % (filter_name, key))
                 pp_env.globals[key] = val
+
+    if pool_key is not None:
+        pp_env_pool[pool_key] = pp_env
     return pp_env
 
 
+bytecode_caches = {}
+def get_bytecode_cache(kind):
+    """
+    Get an on-disk cache of compiled Jinja templates, so unchanged templates
+    don't have to be recompiled on every run. Jinja keys the cache by template
+    filename and checks the source's checksum before using it. Environments
+    that compile templates differently (e.g. with trim_blocks) need to use a
+    different kind of cache. Returns None if caching is disabled.
+    """
+    if kind in bytecode_caches:
+        return bytecode_caches[kind]
+
+    # Cached templates are code, so the cache has to be private to this user
+    cache_root = config.get("jinja_cache_path",
+            user_temp_path(config["temporary_files_path"], "dactyl-jinja-cache"))
+    if not cache_root:
+        bytecode_caches[kind] = None
+        return None
+    cache_dir = os.path.join(cache_root, kind)
+    try:
+        private_dir(cache_root)
+        private_dir(cache_dir)
+        bytecode_caches[kind] = jinja2.FileSystemBytecodeCache(cache_dir)
+    except OSError as e:
+        logger.warning("Not caching compiled templates: %s" % repr(e))
+        bytecode_caches[kind] = None
+    return bytecode_caches[kind]
+
+
+def setup_remote_fetch():
+    """Set up the shared fetcher for remote Markdown, templates, and OpenAPI
+    specs, with an on-disk cache unless it's turned off."""
+    # Cached files go through the preprocessor, so the cache has to be
+    # private to this user
+    cache_path = config.get("remote_cache_path",
+            user_temp_path(config["temporary_files_path"], "dactyl-remote-cache"))
+    if cache_path:
+        try:
+            private_dir(cache_path)
+        except OSError as e:
+            logger.warning("Not caching remote files: %s" % repr(e))
+            cache_path = None
+    remote_fetch.configure(cache_path or None,
+                           offline=config["remote_fetch_offline"],
+                           timeout=config["remote_fetch_timeout"],
+                           concurrency=config["remote_fetch_concurrency"])
+
+
+def is_remote_path(path):
+    return path[:5] == "http:" or path[:6] == "https:"
+
+def prefetch_remote_sources(pages):
+    """Download the remote Markdown and OpenAPI specs that pages use, several
+    at a time, so the build doesn't wait on them one by one."""
+    urls = []
+    for page in pages:
+        how, path = get_page_how(page)
+        if how == HOW_FROM_URL:
+            urls.append(page["md"])
+        spec_path = page.get(OPENAPI_SPEC_KEY)
+        if spec_path and is_remote_path(spec_path) and \
+                spec_path not in cached_openapi_specs:
+            urls.append(spec_path)
+    remote_fetch.get_fetcher().prefetch(urls)
+
+
+# HTML template environments, kept between builds in watch mode so compiled
+# templates stay in memory. Jinja reloads any template file that changes.
+html_env_pool = {}
+
 def setup_html_env(strict_undefined=False):
+    pool_key = (config.get("template_path"), strict_undefined)
+    if pool_key not in html_env_pool:
+        html_env_pool[pool_key] = make_html_env(strict_undefined)
+    return html_env_pool[pool_key]
+
+def make_html_env(strict_undefined=False):
     if strict_undefined:
         preferred_undefined = jinja2.StrictUndefined
     else:
         preferred_undefined = jinja2.Undefined
     if "template_path" in config:
         env = jinja2.Environment(undefined=preferred_undefined,
-                loader=jinja2.FileSystemLoader(config["template_path"]))
+                loader=jinja2.FileSystemLoader(config["template_path"]),
+                bytecode_cache=get_bytecode_cache("templates"))
     else:
         env = setup_fallback_env()
 
@@ -600,19 +803,28 @@ def setup_html_env(strict_undefined=False):
     return env
 
 
+shared_fallback_env = None
+
 def setup_fallback_env():
     """
     Set up a Jinja env to load templates from the package. These templates
     assume that we're not using StrictUndefined.
     """
-    env = jinja2.Environment(loader=jinja2.PackageLoader(__name__))
-    env.lstrip_blocks = True
-    env.trim_blocks = True
-    return env
-
-def toc_from_headers(html_string):
-    """make a table of contents from headers"""
-    soup = BeautifulSoup(html_string, "html.parser")
+    global shared_fallback_env
+    if shared_fallback_env is None:
+        shared_fallback_env = jinja2.Environment(loader=jinja2.PackageLoader(__name__),
+                bytecode_cache=get_bytecode_cache("templates"))
+        shared_fallback_env.lstrip_blocks = True
+        shared_fallback_env.trim_blocks = True
+    return shared_fallback_env
+
+def toc_from_headers(html_or_soup):
+    """make a table of contents from headers, given an HTML string or an
+    already-parsed soup"""
+    if isinstance(html_or_soup, BeautifulSoup):
+        soup = html_or_soup
+    else:
+        soup = BeautifulSoup(html_or_soup, "html.parser")
     headers = soup.find_all(name=re.compile("h[1-3]"), id=True)
     toc_s = ""
     for h in headers:
@@ -626,6 +838,10 @@ def toc_from_headers(html_string):
         new_a = soup.new_tag("a", href="#"+h["id"])
         if h.string:
             new_a.string = h.string
+        elif all(isinstance(c, NavigableString) for c in h.contents):
+            # Filters can leave several adjacent strings in a header, which
+            # would've been one string if the HTML were parsed fresh
+            new_a.string = "".join(h.strings)
         else:
             new_a.string = " ".join(h.strings)
         new_li = soup.new_tag("li")
@@ -665,11 +881,13 @@ def match_only_page(only_page, currentpage):
     return False
 
 def render_page(currentpage, target, pages, mode, current_time, categories,
-        use_template, bypass_errors=False):
-    if "md" in currentpage or "__md_generator" in currentpage:
+        use_template, bypass_errors=False, content=None):
+    """Render a page into its HTML template. If the page's content has
+    already been parsed, pass it in as a PageContent object."""
+    if content is None and ("md" in currentpage or "__md_generator" in currentpage):
         # Read and parse the markdown
         try:
-            html_content = parse_markdown(
+            content = parse_page_content(
                 currentpage,
                 target=target,
                 pages=pages,
@@ -683,13 +901,14 @@ def render_page(currentpage, target, pages, mode, current_time, categories,
             traceback.print_tb(e.__traceback__)
             recoverable_error("Error when fetching page %s: %s" %
                  (currentpage["name"], repr(e)), bypass_errors)
-            html_content=""
+            content = PageContent()
 
-    else:
-        html_content = ""
+    elif content is None:
+        content = PageContent()
 
     # Prepare some parameters for rendering
-    page_toc = toc_from_headers(html_content)
+    page_toc = content.toc()
+    html_content = content.html
 
     # Render the content into the appropriate template
     out_html = use_template.render(
@@ -707,41 +926,35 @@ def render_page(currentpage, target, pages, mode, current_time, categories,
     return out_html
 
 def add_bonus_fields(currentpage, target=None, pages=None, categories=[],
-        mode="html", current_time="", bypass_errors=False):
+        mode="html", current_time="", bypass_errors=False, content=None):
     """Adds several metadata fields to a page based on the process of rendering
-    it into HTML, including plaintext, blurb, and headermap"""
-    body_html = parse_markdown(
-        currentpage,
-        target=target,
-        pages=pages,
-        mode=mode,
-        current_time=current_time,
-        categories=categories,
-        bypass_errors=bypass_errors,
-    )
-    soup = BeautifulSoup(body_html, "html.parser")
+    it into HTML, including plaintext, blurb, and headermap. If the page's
+    content has already been parsed, pass it in as a PageContent object."""
+    if content is None:
+        content = parse_page_content(
+            currentpage,
+            target=target,
+            pages=pages,
+            mode=mode,
+            current_time=current_time,
+            categories=categories,
+            bypass_errors=bypass_errors,
+        )
 
     # Get "true" plaintext of the page
-    currentpage["plaintext"] = soup.get_text()
+    currentpage["plaintext"] = content.plaintext()
 
     # Get a map of all headers
-    headermap = {}
-    headers = soup.find_all(re.compile("h[1-6]"), id=True)
-    currentpage["headermap"] = {h.get_text(): "#" + h["id"] for h in headers}
+    currentpage["headermap"] = content.headermap()
 
     # Make a blurb from the first non-empty paragraph if no blurb is defined
     if "blurb" not in currentpage:
-        p = soup.find("p")
-        while p:
-            if p.get_text().strip():
-                currentpage["blurb"] = p.get_text()
-                break
-            else:
-                p = p.find_next_sibling("p")
-        else:
+        blurb = content.blurb()
+        if blurb is None:
             logger.debug("Couldn't find a paragraph with text in %s." % currentpage)
             # Fall back to reusing the page name as the blurb
-            currentpage["blurb"] = currentpage["name"]
+            blurb = currentpage["name"]
+        currentpage["blurb"] = blurb
 
 
 def eval_es_string(expr, context):
@@ -755,17 +968,20 @@ def eval_es_string(expr, context):
 
 def render_es_json(currentpage, es_template, pages=[], target=None, categories=[],
                     page_filters=[], mode="es", current_time="TIME_UNKNOWN",
-                    bypass_errors=False):
-    """Returns stringified JSON representing the currentpage"""
+                    bypass_errors=False, content=None):
+    """Returns stringified JSON representing the currentpage. If the page's
+    content has already been parsed, pass it in as a PageContent object."""
 
     # This method modifies the currentpage dictionary inline:
     add_bonus_fields(
         currentpage,
         target=target,
+        pages=pages,
         mode=mode,
         current_time=current_time,
         categories=categories,
         bypass_errors=bypass_errors,
+        content=content,
     )
 
     context = {
@@ -823,36 +1039,25 @@ def get_es_instance(es_base_url):
     return es_base_url
 
 def upload_es_json(es_json, es_index, es_base, id, doc_type='article'):
-    """Uploads a document to the ElasticSearch index."""
-
-    # Using requests
-    url = "{es_base}/{index}/{doc_type}/{id}".format(
-        es_base=es_base,
-        index=es_index.lower(), # ES index names must be lowercase
-        doc_type=doc_type,
-        id=id,
-    )
-    headers = {"Content-Type": "application/json"}
-    logger.info("Uploading to ES: PUT %s" % url)
-    r = requests.put(url, headers=headers, data=es_json)
-    if r.status_code >= 400:
-        recoverable_error("ES upload failed with error: '%s'" % r.text,
-                config.bypass_errors)
-
-
-def render_pages(target=None, mode="html", bypass_errors=False,
-                only_page=False, temp_files_path=None, es_upload=NO_ES_UP):
-    """Parse and render all pages in target, writing files to out_path."""
-    target = get_target(target)
-    pages = get_pages(target, bypass_errors)
-    categories = get_categories(pages)
-    current_time = time.strftime(config["time_format"]) # Get time once only
-
-    if es_upload != NO_ES_UP:
-        es_base_url = get_es_instance(es_upload)
-        es_index = es_index_name(target)
-        # Note: this doesn't delete the old index
-
+    """Uploads a document to the ElasticSearch index.
+
+    Deprecated: this sends one document per request. To upload several, use
+    an ESBulkUploader, which sends them in batches."""
+    uploader = ESBulkUploader(es_base, doc_type=doc_type,
+                              bypass_errors=config.bypass_errors)
+    uploader.add(es_json, es_index, id)
+    uploader.close()
+
+def make_render_context(target, pages, mode="html", bypass_errors=False,
+                        es_upload=NO_ES_UP, current_time=None):
+    """Set up everything render_page_output needs to render pages of target
+    in a given mode: the page list, categories, and Jinja templates."""
+    if current_time is None:
+        current_time = time.strftime(config["time_format"])
+    env = None
+    fallback_env = None
+    default_template = None
+    default_es_template = None
     if mode == "pdf" or mode == "html":
         if config["template_allow_undefined"] == False and not bypass_errors:
             strict_undefined = True
@@ -862,127 +1067,534 @@ def render_pages(target=None, mode="html", bypass_errors=False,
         env = setup_html_env(strict_undefined=strict_undefined)
         fallback_env = setup_fallback_env()
     if mode == "pdf":
-        out_path = temp_files_path or temp_dir()
         default_template = safe_get_template(config["default_pdf_template"], env, fallback_env)
     elif mode == "html":
-        out_path = config["out_path"]
         default_template = safe_get_template(config["default_template"], env, fallback_env)
-    elif mode == "md":
-        out_path = config["out_path"]
-    elif mode == "es":
-        out_path = config["out_path"]
-    else:
-        exit("Unknown mode %s" % mode)
     if mode == "es" or es_upload != NO_ES_UP:
         default_es_template = config.get_es_template(config["default_es_template"])
 
-    matched_only = False
-    for currentpage in pages:
-        if only_page:
-            if match_only_page(only_page, currentpage):
-                matched_only = True
-            else:
-                logger.debug("only_page mode: skipping page %s" % currentpage)
-                continue
+    return {
+        "target": target,
+        "pages": pages,
+        "categories": get_categories(pages),
+        "current_time": current_time,
+        "mode": mode,
+        "bypass_errors": bypass_errors,
+        "es_upload": es_upload,
+        "env": env,
+        "fallback_env": fallback_env,
+        "default_template": default_template,
+        "default_es_template": default_es_template,
+        "unchanged": {},
+        "dependency_envs": {},
+    }
 
-        if mode == "html":
-            filepath = currentpage["html"]
-            if "template" in currentpage:
-                use_template = safe_get_template(currentpage["template"], env, fallback_env)
-            else:
-                use_template = default_template
-        elif mode == "pdf":
-            filepath = currentpage["html"] # Used in the temp dir
-            if "pdf_template" in currentpage:
-                use_template = safe_get_template(currentpage["pdf_template"], env, fallback_env)
-            else:
-                use_template = default_template
-        elif mode == "es":
-            filepath = re.sub(r'(.+)\.html?$', r'\1.json', currentpage["html"], flags=re.I)
 
-        if mode == "es" or es_upload != NO_ES_UP:
-            if "es_template" in currentpage:
-                es_template = config.get_es_template(currentpage["es_template"])
-            else:
-                es_template = default_es_template
+def render_pages(target=None, mode="html", bypass_errors=False,
+                only_page=False, temp_files_path=None, es_upload=NO_ES_UP,
+                jobs=1, pages=None, incremental=False, rebuild_pages=None,
+                watch_state=None):
+    """Parse and render all pages in target, writing files to out_path.
+    With jobs > 1, pages are rendered by a pool of worker processes, but still
+    written (and their log output printed) in the same order as a serial
+    build.
+
+    The target's page list is computed once here (unless passed in as pages)
+    and shared by every page rendered.
+
+    With incremental=True, skips pages whose inputs haven't changed since
+    they were last written, according to the build manifest in out_path.
+
+    In watch mode, rebuild_pages is the list of pages to re-render (the rest
+    are skipped as unchanged), and the inputs of each page rendered are
+    recorded in watch_state."""
+    target = get_target(target)
+    if pages is None:
+        pages = get_pages(target, bypass_errors)
+    current_time = time.strftime(config["time_format"]) # Get time once only
 
-        if "md" in currentpage and (mode == "es" or es_upload != NO_ES_UP):
-            # Generate the ES JSON & upload it first; save it for es mode
-            # so we don't end up having to build the JSON twice in es mode
-            try:
-                es_json_s = render_es_json(currentpage,
-                    es_template,
-                    target=target,
-                    pages=pages,
-                    categories=categories,
-                    mode=mode,
-                    current_time=current_time,
-                    page_filters=get_filters_for_page(currentpage, target),
-                    bypass_errors=bypass_errors,)
-                if es_upload != NO_ES_UP:
-                    es_page_id = target["name"]+"."+currentpage["html"]
-                    upload_es_json(es_json_s, es_index, es_base_url, es_page_id)
-            except Exception as e:
-                traceback.print_tb(e.__traceback__)
-                recoverable_error( ("Skipping ES build/upload of %s " +
-                          "due to error: %s") %
-                           (currentpage["name"], repr(e)), bypass_errors)
-                es_json_s = "{}"
-
-        if mode == "html" or mode == "pdf":
-            logger.debug("use_template is: %s" % use_template)
-            page_text = render_page(
-                currentpage,
-                target,
-                pages,
-                mode,
-                current_time,
-                categories,
-                use_template,
-                bypass_errors=bypass_errors
-            )
-        elif mode == "md":
-            if "md" not in currentpage and "__md_generator" not in currentpage:
-                logger.info("md mode: Skipping page (no md): %s" % currentpage)
-                continue
-            if "md" not in currentpage:
-                # Uses an __md_generator, assume there's an "html" field provided
-                filepath = currentpage["html"].replace(".html", ".md")
-                if filepath[-3:] != ".md": # previous replacement didn't work
-                    filepath = filepath + ".md"
-            else:
-                filepath = currentpage["md"]
-            if filepath.lower()[:5] == "http:" or filepath.lower()[:6] == "https:":
-                filepath = slugify(filepath)
+    es_uploader = None
+    es_publisher = None
+    if es_upload != NO_ES_UP:
+        es_base_url = get_es_instance(es_upload)
+        es_index = es_index_name(target)
+        es_upload_options = {
+            "max_docs": config["es_bulk_max_docs"],
+            "max_bytes": config["es_bulk_max_bytes"],
+            "concurrency": config["es_upload_concurrency"],
+            "max_retries": config["es_upload_retries"],
+            "bypass_errors": bypass_errors,
+        }
+        if config["es_publish"] and only_page:
+            # The new index would only have this page, and replace the live one
+            recoverable_error("Can't publish an ES index of only one page; "+
+                    "skipping ES upload", bypass_errors)
+            es_upload = NO_ES_UP
+        elif config["es_publish"]:
             try:
-                page_text = preprocess_markdown(currentpage,
-                    target=target,
-                    categories=categories,
-                    mode=mode,
-                    current_time=current_time,
-                    page_filters=get_filters_for_page(currentpage, target),
-                    bypass_errors=bypass_errors,
-                )
-            except Exception as e:
-                traceback.print_tb(e.__traceback__)
-                recoverable_error( ("Preprocessing page %s failed " +
-                          "with error: %s") %
-                           (currentpage["name"], repr(e)), bypass_errors)
-        elif mode == "es":
-            if "md" not in currentpage:
-                logger.info("es mode: Skipping page (no md content): %s" % currentpage)
-                continue
-            page_text = es_json_s
+                es_publisher = ESIndexPublisher(es_base_url, es_index,
+                        config["out_path"], **es_upload_options)
+                es_uploader = es_publisher
+            except ESPublishError as e:
+                recoverable_error("Skipping ES publish due to error: %s" % e,
+                        bypass_errors)
+                es_upload = NO_ES_UP
+        else:
+            # Note: this doesn't delete the old index
+            es_uploader = ESBulkUploader(es_base_url, **es_upload_options)
 
+    # Unless it's published, don't leave a new ES index behind, even if the
+    # build stops early
+    published = False
+    try:
+        if mode == "pdf":
+            out_path = temp_files_path or temp_dir()
+        elif mode in ("html", "md", "es"):
+            out_path = config["out_path"]
         else:
-            exit("render_pages error: unknown mode: %s" % mode)
+            exit("Unknown mode %s" % mode)
+        render_context = make_render_context(target, pages, mode, bypass_errors,
+                                             es_upload, current_time)
+
+        matched_only = False
+        pages_to_render = []
+        for currentpage in pages:
+            if only_page:
+                if match_only_page(only_page, currentpage):
+                    matched_only = True
+                else:
+                    logger.debug("only_page mode: skipping page %s" % currentpage)
+                    continue
+            pages_to_render.append(currentpage)
+        prefetch_remote_sources(pages_to_render)
+
+        page_frontmatter = None
+        if jobs > 1 or incremental or rebuild_pages is not None:
+            page_frontmatter = [read_page_frontmatter(p) for p in pages_to_render]
+
+        if rebuild_pages is not None:
+            rebuild_ids = {id(p) for p in rebuild_pages}
+            for currentpage, frontmatter in zip(pages_to_render, page_frontmatter):
+                filepath = output_filepath(currentpage, mode)
+                if filepath and id(currentpage) not in rebuild_ids:
+                    render_context["unchanged"][filepath] = frontmatter
+
+        manifest = None
+        if incremental and mode == "pdf" and not temp_files_path:
+            logger.info("Incremental builds don't apply to PDFs without a staging folder; building all pages")
+        elif incremental:
+            manifest = BuildManifest(out_path)
+            # Changes to config, vars, or other pages' frontmatter can affect any
+            # page (navigation, xrefs, etc.), so they invalidate the whole build
+            build_fingerprint = hash_value({
+                "config": config.config,
+                "target": target,
+                "frontmatter": page_frontmatter,
+                "mode": mode,
+                "es_upload": es_upload,
+                "current_time": current_time,
+                "bypass_errors": bypass_errors,
+            })
+            for currentpage, frontmatter in zip(pages_to_render, page_frontmatter):
+                filepath = output_filepath(currentpage, mode)
+                if filepath and manifest.is_fresh(filepath, build_fingerprint):
+                    render_context["unchanged"][filepath] = frontmatter
+            if es_publisher and not es_publisher.reused and render_context["unchanged"]:
+                logger.info("Rendering all pages to fill the new ES index")
+                render_context["unchanged"] = {}
+
+        if jobs > 1 and len(pages_to_render) > 1:
+            rendered = render_pages_parallel(pages_to_render, render_context, jobs,
+                                             page_frontmatter)
+        else:
+            rendered = (render_page_output(p, render_context) for p in pages_to_render)
+
+        for currentpage, result in zip(pages_to_render, rendered):
+            if watch_state and (rebuild_pages is None or id(currentpage) in rebuild_ids):
+                watch_state.record(currentpage,
+                                   *page_dependencies(currentpage, render_context))
+            if result is None:
+                continue
+            filepath, page_text, es_json_s = result
 
-        # Finally, write the rendered page
-        write_page(page_text, filepath, out_path)
+            if es_json_s is not None:
+                try:
+                    es_page_id = target["name"]+"."+currentpage["html"]
+                    es_uploader.add(es_json_s, es_index, es_page_id)
+                except Exception as e:
+                    traceback.print_tb(e.__traceback__)
+                    recoverable_error( ("Skipping ES build/upload of %s " +
+                              "due to error: %s") %
+                               (currentpage["name"], repr(e)), bypass_errors)
+
+            # Finally, write the rendered page
+            write_page(page_text, filepath, out_path)
+
+            if manifest:
+                input_paths, complete = page_dependencies(currentpage, render_context)
+                if complete:
+                    manifest.record(filepath, build_fingerprint, input_paths)
+                else:
+                    logger.debug("Can't track all inputs of %s; it'll be rebuilt every time" %
+                                 filepath)
+                    manifest.forget(filepath)
+
+        if manifest:
+            manifest.save()
+
+        if es_publisher:
+            es_doc_ids = [target["name"]+"."+p["html"] for p in pages if "md" in p]
+            es_publisher.close(es_doc_ids)
+            published = True
+        elif es_uploader:
+            es_uploader.close()
+    except ESPublishError as e:
+        recoverable_error("ES publish failed: %s" % e, bypass_errors)
+    finally:
+        if es_publisher and not published:
+            es_publisher.discard()
 
     if only_page and not matched_only:
         exit("Didn't find requested 'only' page '%s'" % only_page)
 
+
+def output_filepath(currentpage, mode):
+    """Choose where (relative to the output folder) currentpage gets written
+    in the given mode. Returns None if the page has no output in this mode."""
+    if mode == "html" or mode == "pdf":
+        return currentpage["html"] # In the temp dir, for PDFs
+    elif mode == "es":
+        if "md" not in currentpage:
+            return None
+        return re.sub(r'(.+)\.html?$', r'\1.json', currentpage["html"], flags=re.I)
+    elif mode == "md":
+        if "md" not in currentpage and "__md_generator" not in currentpage:
+            return None
+        if "md" not in currentpage:
+            # Uses an __md_generator, assume there's an "html" field provided
+            filepath = currentpage["html"].replace(".html", ".md")
+            if filepath[-3:] != ".md": # previous replacement didn't work
+                filepath = filepath + ".md"
+        else:
+            filepath = currentpage["md"]
+        if filepath.lower()[:5] == "http:" or filepath.lower()[:6] == "https:":
+            filepath = slugify(filepath)
+        return filepath
+    else:
+        exit("render_pages error: unknown mode: %s" % mode)
+
+
+def page_template(currentpage, render_context):
+    """Get the Jinja template that currentpage's HTML goes into, or None if
+    the mode doesn't use one."""
+    env = render_context["env"]
+    fallback_env = render_context["fallback_env"]
+    if render_context["mode"] == "html":
+        if "template" in currentpage:
+            return safe_get_template(currentpage["template"], env, fallback_env)
+        return render_context["default_template"]
+    elif render_context["mode"] == "pdf":
+        if "pdf_template" in currentpage:
+            return safe_get_template(currentpage["pdf_template"], env, fallback_env)
+        return render_context["default_template"]
+    return None
+
+
+def page_dependencies(currentpage, render_context):
+    """List the files that currentpage's output is built from, for the build
+    manifest. Returns a (paths, complete) tuple. complete is False if some
+    inputs can't be tracked, such as remote or generated markdown."""
+    mode = render_context["mode"]
+    paths = set()
+    complete = True
+
+    if "md" in currentpage or "__md_generator" in currentpage:
+        how, basepath = get_page_how(currentpage)
+        if how != HOW_FROM_FILE:
+            return paths, False
+        if config["skip_preprocessor"]:
+            paths.add(currentpage["md"])
+        else:
+            dep_envs = render_context["dependency_envs"]
+            if basepath not in dep_envs:
+                dep_envs[basepath] = jinja2.Environment(
+                        loader=FrontMatterFSLoader(basepath))
+            md_paths, md_complete = template_dependencies(dep_envs[basepath],
+                                                          currentpage["md"])
+            paths.update(md_paths)
+            complete = complete and md_complete
+        for filter_name in get_filters_for_page(currentpage, render_context["target"]):
+            filter_file = getattr(config.filters[filter_name], "__file__", None)
+            if filter_file:
+                paths.add(filter_file)
+            else:
+                complete = False
+
+    use_template = page_template(currentpage, render_context)
+    if use_template is not None:
+        t_paths, t_complete = template_dependencies(use_template.environment,
+                                                    use_template.name)
+        paths.update(t_paths)
+        complete = complete and t_complete
+
+    if mode == "es" or render_context["es_upload"] != NO_ES_UP:
+        es_template_path = os.path.join(config.get("template_path", ""),
+            currentpage.get("es_template", config["default_es_template"]))
+        if os.path.isfile(es_template_path):
+            paths.add(es_template_path)
+
+    return paths, complete
+
+
+def render_page_output(currentpage, render_context):
+    """Render a single page for the mode in render_context. Returns a
+    (filepath, page_text, es_json) tuple, or None if the page has no output
+    in this mode or is unchanged since the last build. es_json is None unless
+    the page should be uploaded to ElasticSearch."""
+    target = render_context["target"]
+    pages = render_context["pages"]
+    categories = render_context["categories"]
+    current_time = render_context["current_time"]
+    mode = render_context["mode"]
+    bypass_errors = render_context["bypass_errors"]
+    es_upload = render_context["es_upload"]
+
+    filepath = output_filepath(currentpage, mode)
+    if filepath is None:
+        if mode == "md":
+            logger.info("md mode: Skipping page (no md): %s" % currentpage)
+        else:
+            logger.info("es mode: Skipping page (no md content): %s" % currentpage)
+        return None
+
+    if filepath in render_context["unchanged"]:
+        logger.info("Skipping unchanged page %s" % currentpage["name"])
+        # Later pages would've seen this page's frontmatter if it were built
+        merge_dicts(render_context["unchanged"][filepath], currentpage)
+        return None
+
+    use_template = page_template(currentpage, render_context)
+
+    if mode == "es" or es_upload != NO_ES_UP:
+        if "es_template" in currentpage:
+            es_template = config.get_es_template(currentpage["es_template"])
+        else:
+            es_template = render_context["default_es_template"]
+
+    # When uploading to ES while building HTML, parse the page once and use
+    # the result for both
+    content = None
+    content_error = None
+    if ("md" in currentpage and es_upload != NO_ES_UP and
+            (mode == "html" or mode == "pdf")):
+        try:
+            content = parse_page_content(
+                currentpage,
+                target=target,
+                pages=pages,
+                mode=mode,
+                current_time=current_time,
+                categories=categories,
+                bypass_errors=bypass_errors,
+            )
+        except Exception as e:
+            traceback.print_tb(e.__traceback__)
+            content_error = e
+
+    es_json_s = None
+    es_upload_json = None
+    if "md" in currentpage and (mode == "es" or es_upload != NO_ES_UP):
+        # Generate the ES JSON first; save it for es mode so we don't end up
+        # having to build the JSON twice in es mode
+        try:
+            if content_error:
+                raise content_error
+            es_json_s = render_es_json(currentpage,
+                es_template,
+                target=target,
+                pages=pages,
+                categories=categories,
+                mode=mode,
+                current_time=current_time,
+                page_filters=get_filters_for_page(currentpage, target),
+                bypass_errors=bypass_errors,
+                content=content)
+            if es_upload != NO_ES_UP:
+                es_upload_json = es_json_s
+        except Exception as e:
+            traceback.print_tb(e.__traceback__)
+            recoverable_error( ("Skipping ES build/upload of %s " +
+                      "due to error: %s") %
+                       (currentpage["name"], repr(e)), bypass_errors)
+            es_json_s = "{}"
+
+    if mode == "html" or mode == "pdf":
+        logger.debug("use_template is: %s" % use_template)
+        if content_error:
+            recoverable_error("Error when fetching page %s: %s" %
+                 (currentpage["name"], repr(content_error)), bypass_errors)
+            content = PageContent()
+        page_text = render_page(
+            currentpage,
+            target,
+            pages,
+            mode,
+            current_time,
+            categories,
+            use_template,
+            bypass_errors=bypass_errors,
+            content=content,
+        )
+    elif mode == "md":
+        try:
+            page_text = preprocess_markdown(currentpage,
+                target=target,
+                pages=pages,
+                categories=categories,
+                mode=mode,
+                current_time=current_time,
+                page_filters=get_filters_for_page(currentpage, target),
+                bypass_errors=bypass_errors,
+            )
+        except Exception as e:
+            traceback.print_tb(e.__traceback__)
+            recoverable_error( ("Preprocessing page %s failed " +
+                      "with error: %s") %
+                       (currentpage["name"], repr(e)), bypass_errors)
+            page_text = ""
+    elif mode == "es":
+        page_text = es_json_s
+
+    return filepath, page_text, es_upload_json
+
+
+def read_page_frontmatter(page):
+    """Read just the frontmatter of a page whose markdown is a local file,
+    without preprocessing it. Returns {} for other pages."""
+    how, basepath = get_page_how(page)
+    if how != HOW_FROM_FILE or "md" not in page:
+        return {}
+    if config["skip_preprocessor"]:
+        md_path = page["md"]
+    else:
+        md_path = os.path.join(basepath, page["md"])
+    try:
+        with open(md_path, "r", encoding="utf-8") as f:
+            md, frontmatter = parse_frontmatter(f.read())
+    except Exception as e:
+        logger.debug("Couldn't read frontmatter of %s: %s" % (md_path, repr(e)))
+        return {}
+    return frontmatter
+
+
+# Set in the parent process right before forking the render pool, so workers
+# inherit it (along with config, filters, and Jinja envs) instead of having
+# to pickle it.
+_worker_render_context = None
+_worker_pages = None
+_worker_frontmatter = None
+_worker_frontmatter_applied = 0
+
+def render_pages_parallel(pages_to_render, render_context, jobs,
+                          page_frontmatter=None):
+    """Render pages in a pool of forked worker processes. Yields the same
+    results as render_page_output, in page order. Each page's console output
+    is replayed when its result is consumed, so logs and errors come out as
+    they would in a serial build. page_frontmatter is the list of each page's
+    frontmatter, if it's already been read."""
+    global _worker_render_context, _worker_pages, _worker_frontmatter
+    if "fork" not in multiprocessing.get_all_start_methods():
+        logger.warning("Parallel rendering requires fork(); rendering serially")
+        for currentpage in pages_to_render:
+            yield render_page_output(currentpage, render_context)
+        return
+
+    _worker_render_context = render_context
+    _worker_pages = pages_to_render
+    # In a serial build, each page sees the frontmatter that earlier pages
+    # merged into the shared page list; workers replay that from here.
+    if page_frontmatter is None:
+        page_frontmatter = [read_page_frontmatter(p) for p in pages_to_render]
+    _worker_frontmatter = page_frontmatter
+    # Don't let the workers inherit (and re-print) buffered output
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    logger.info("rendering %d pages with %d jobs..." % (len(pages_to_render), jobs))
+    chunksize = max(1, len(pages_to_render) // (jobs * 4))
+    ctx = multiprocessing.get_context("fork")
+    with ctx.Pool(jobs) as pool:
+        for result, out_s, err_s, exit_code in pool.imap(_render_page_job,
+                range(len(pages_to_render)), chunksize):
+            sys.stdout.write(out_s)
+            sys.stderr.write(err_s)
+            if exit_code is not None:
+                pool.terminate()
+                exit(exit_code)
+            yield result
+
+
+def _render_page_job(i):
+    """Pool worker: render one page, capturing its output instead of printing
+    it. Returns (result, stdout text, stderr text, exit code or None)."""
+    global _worker_frontmatter_applied
+    # Pages are handed out in order, so this only moves forward
+    for j in range(_worker_frontmatter_applied, i):
+        merge_dicts(_worker_frontmatter[j], _worker_pages[j])
+    _worker_frontmatter_applied = max(_worker_frontmatter_applied, i)
+
+    out_buf = io.StringIO()
+    err_buf = io.StringIO()
+    handlers = [h for h in logger.handlers if isinstance(h, logging.StreamHandler)]
+    old_streams = [h.setStream(err_buf) for h in handlers]
+    result = None
+    exit_code = None
+    try:
+        with contextlib.redirect_stdout(out_buf), contextlib.redirect_stderr(err_buf):
+            result = render_page_output(_worker_pages[i], _worker_render_context)
+    except SystemExit as e:
+        # recoverable_error() exits; let the parent do it, in order
+        exit_code = e.code if e.code is not None else 0
+    finally:
+        for h, old_stream in zip(handlers, old_streams):
+            h.setStream(old_stream)
+    return result, out_buf.getvalue(), err_buf.getvalue(), exit_code
+
+def render_modes(target=None, modes=["html"], bypass_errors=False,
+                 only_page=False, es_upload=NO_ES_UP, jobs=1,
+                 incremental=False, watch_state=None, rebuild_pages=None):
+    """Render pages in one or more of the html, md, and es modes, sharing one
+    page list. When uploading to ElasticSearch, the upload goes with es mode
+    if that's one of the modes (so the uploaded documents match the JSON
+    files), or else with the first mode.
+
+    In watch mode, the page list comes from watch_state, and only
+    rebuild_pages are re-rendered (or all pages, if it's None)."""
+    target = get_target(target)
+    if watch_state:
+        pages = watch_state.pages
+    else:
+        pages = get_pages(target, bypass_errors)
+    if "es" in modes:
+        upload_mode = "es"
+    else:
+        upload_mode = modes[0]
+
+    for mode in modes:
+        logger.info("rendering %s..." % mode)
+        render_pages(target=target,
+                     mode=mode,
+                     bypass_errors=bypass_errors,
+                     only_page=only_page,
+                     es_upload=(es_upload if mode == upload_mode else NO_ES_UP),
+                     jobs=jobs,
+                     incremental=incremental,
+                     pages=pages,
+                     rebuild_pages=rebuild_pages,
+                     watch_state=watch_state,
+        )
+        logger.info("done rendering %s" % mode)
+
 # def make_esj(target=target, bypass_errors=cli_args.bypass_errors,
 #             only_page=cli_args.only,):
 #     """Build .json files to be uploaded to ElasticSearch for pages in target."""
@@ -999,55 +1611,296 @@ def write_page(page_text, filepath, out_path):
         f.write(page_text)
 
 
+class WatchState:
+    """What watch mode keeps in memory between rebuilds: the target's page
+    list, each page's frontmatter, and which files each page is built from
+    (as far as the build manifest's dependency tracking can tell)."""
+    def __init__(self, pages):
+        self.pages = pages
+        # Building a page merges its frontmatter into its dict, so keep the
+        # dicts as they were to start each rebuild from
+        self.original_pages = {id(p): deepcopy(p) for p in pages}
+        self.frontmatter = {id(p): read_page_frontmatter(p) for p in pages}
+        self.dependents = {} # absolute path -> ids of pages built from it
+        self.tracked = set() # ids of pages whose inputs are all known
+
+    def record(self, currentpage, paths, complete):
+        page_id = id(currentpage)
+        for path in paths:
+            self.dependents.setdefault(os.path.abspath(path), set()).add(page_id)
+        if complete:
+            self.tracked.add(page_id)
+        else:
+            self.tracked.discard(page_id)
+
+    def affected_pages(self, changed_paths):
+        """Returns the pages that need to be re-rendered because of changes to
+        changed_paths, or None if everything should be rebuilt. Pages whose
+        inputs can't all be tracked are always re-rendered."""
+        affected = {id(p) for p in self.pages} - self.tracked
+        for path in changed_paths:
+            path = os.path.abspath(path)
+            if path not in self.dependents:
+                logger.info("%s isn't a known input of any page; rebuilding all pages" % path)
+                return None
+            affected |= self.dependents[path]
+        for currentpage in self.pages:
+            page_id = id(currentpage)
+            if page_id in affected:
+                frontmatter = read_page_frontmatter(currentpage)
+                if frontmatter != self.frontmatter[page_id]:
+                    # Other pages' navigation etc. might use it
+                    logger.info("Frontmatter of %s changed; rebuilding all pages" %
+                                currentpage.get("name", currentpage.get("md")))
+                    self.frontmatter[page_id] = frontmatter
+                    return None
+        return [p for p in self.pages if id(p) in affected]
+
+    def reset_pages(self, pages=None):
+        """Put pages (or all pages, if None) back the way they were before
+        they were built, so they pick up their current frontmatter when
+        they're built again. (merge_dicts doesn't overwrite keys, so the
+        frontmatter from the last build would win otherwise.) The dicts are
+        updated in place, so they keep their ids."""
+        if pages is None:
+            pages = self.pages
+        for currentpage in pages:
+            currentpage.clear()
+            currentpage.update(deepcopy(self.original_pages[id(currentpage)]))
+            self.frontmatter[id(currentpage)] = read_page_frontmatter(currentpage)
+
+
+class RebuildDebouncer:
+    """Collects changed paths and calls rebuild(paths) once they stop changing
+    for delay seconds, so an editor save that fires several events only
+    causes one rebuild. Only one rebuild runs at a time; changes that come in
+    during a rebuild are collected for the next one."""
+    def __init__(self, rebuild, delay=0.5):
+        self.rebuild = rebuild
+        self.delay = delay
+        self.changed = set()
+        self.timer = None
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+
+    def add(self, path):
+        with self.lock:
+            self.changed.add(path)
+            if self.timer:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.delay, self.fire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def fire(self):
+        with self.build_lock:
+            with self.lock:
+                changed = self.changed
+                self.changed = set()
+            if changed:
+                self.rebuild(changed)
+
+
 def watch(mode, target, only_page="", pdf_file=DEFAULT_PDF_FILE,
-          es_upload=NO_ES_UP):
+          es_upload=NO_ES_UP, jobs=1, incremental=False, watch_state=None):
     """Look for changed files and re-run the build whenever there's an update.
+       mode is "pdf" or a list of other modes to build together.
+       Events are debounced, and outside of PDF mode only the pages built from
+       the changed files are re-rendered, using the page list (and the
+       dependencies recorded by the first build) in watch_state.
        Runs until interrupted."""
     target = get_target(target)
+    if mode != "pdf" and watch_state is None:
+        watch_state = WatchState(get_pages(target, True))
+
+    def rebuild(changed_paths):
+        logger.info("%d file(s) changed: %s" % (len(changed_paths),
+                    ", ".join(sorted(changed_paths))))
+        # Check remote files for changes again, but only once per rebuild
+        remote_fetch.get_fetcher().new_build()
+        # bypass_errors=True because Watch shouldn't
+        #  just die if a file is temporarily not found
+        if mode == "pdf":
+            # Keep the staged files until watching stops, so each rebuild
+            # only updates what changed
+            make_pdf(pdf_file, target=target, bypass_errors=True,
+                remove_tmp=False, only_page=only_page, es_upload=es_upload,
+                jobs=jobs)
+        else:
+            rebuild_pages = watch_state.affected_pages(changed_paths)
+            if rebuild_pages is not None:
+                logger.info("re-rendering %d of %d pages" %
+                            (len(rebuild_pages), len(watch_state.pages)))
+            watch_state.reset_pages(rebuild_pages)
+            render_modes(target, modes=mode, bypass_errors=True,
+                        only_page=only_page, es_upload=es_upload,
+                        jobs=jobs, incremental=incremental,
+                        watch_state=watch_state, rebuild_pages=rebuild_pages)
+        logger.info("done rendering")
+
+    debouncer = RebuildDebouncer(rebuild, config["watch_debounce"])
+    observer = watch_files(debouncer)
+    # The above starts an observing thread,
+    #   so the main thread can just wait
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        observer.stop()
+    observer.join()
+    if mode == "pdf":
+        remove_pdf_temp_files(target)
+
 
+def watch_files(debouncer, patterns=["*template-*.html", "*.md", "*code_samples/*"],
+                paths=None):
+    """Start a watchdog Observer that passes changes to files matching
+    patterns in paths (by default, the template and content paths) to a
+    RebuildDebouncer. Returns the Observer."""
     class UpdaterHandler(PatternMatchingEventHandler):
         """Updates to pattern-matched files means rendering."""
         def on_any_event(self, event):
-            logger.info("got event!")
-            # bypass_errors=True because Watch shouldn't
-            #  just die if a file is temporarily not found
-            if mode == "pdf":
-                make_pdf(pdf_file, target=target, bypass_errors=True,
-                    only_page=only_page, es_upload=es_upload)
-            else:
-                render_pages(target, mode=mode, bypass_errors=True,
-                            only_page=only_page, es_upload=es_upload)
-            logger.info("done rendering")
-
-    patterns = ["*template-*.html",
-                "*.md",
-                "*code_samples/*"]
-
+            logger.debug("got event: %s" % event)
+            # Newer watchdog versions also report files being opened and
+            # closed, which the build itself does
+            if event.is_directory or event.event_type not in (
+                    "created", "modified", "deleted", "moved"):
+                return
+            debouncer.add(event.src_path)
+            if getattr(event, "dest_path", None):
+                debouncer.add(event.dest_path)
+
+    if paths is None:
+        paths = [config["template_path"], config["content_path"]]
     event_handler = UpdaterHandler(patterns=patterns)
     observer = Observer()
-    observer.schedule(event_handler, config["template_path"], recursive=True)
-    observer.schedule(event_handler, config["content_path"], recursive=True)
+    for path in paths:
+        if os.path.isdir(path):
+            observer.schedule(event_handler, path, recursive=True)
     observer.start()
-    # The above starts an observing thread,
-    #   so the main thread can just wait
+    return observer
+
+
+def static_dirs():
+    """Map the URL paths where copy_static_files puts static files to the
+    folders they come from."""
+    dirs = {}
+    if os.path.isdir(config["template_static_path"]):
+        src = config["template_static_path"]
+        dirs[os.path.basename(os.path.normpath(src))] = src
+    content_static = config.get("content_static_path", [])
+    if type(content_static) == str:
+        content_static = [content_static]
+    for src in content_static:
+        if os.path.isdir(src):
+            dirs[os.path.basename(os.path.normpath(src))] = src
+        elif os.path.isfile(src):
+            dirs[os.path.dirname(src)] = os.path.dirname(src) or "."
+    return dirs
+
+
+def serve(target, port=DEFAULT_SERVE_PORT, host="localhost"):
+    """Serve target's pages over HTTP, rendering each page when it's first
+    requested and again after its inputs change. Runs until interrupted."""
+    target = get_target(target)
+    watch_state = WatchState(get_pages(target, True))
+    pages_by_path = {}
+    for currentpage in watch_state.pages:
+        if "html" in currentpage:
+            pages_by_path["/" + currentpage["html"].replace(os.sep, "/")] = currentpage
+
+    def merge_frontmatter(pages=None):
+        # Every page sees every other page's frontmatter, as in a full build.
+        # The pages (all of them, if None) start from fresh dicts, so edited
+        # frontmatter replaces what was merged in before.
+        watch_state.reset_pages(pages)
+        for currentpage in (watch_state.pages if pages is None else pages):
+            merge_dicts(watch_state.frontmatter[id(currentpage)], currentpage)
+
+    merge_frontmatter()
+    render_context = make_render_context(target, watch_state.pages, "html",
+                                         bypass_errors=True)
+
+    def render(path):
+        if path == "/index.html" and path not in pages_by_path \
+                and watch_state.pages and "html" in watch_state.pages[0]:
+            # Show the first page if there's no index
+            path = "/" + watch_state.pages[0]["html"]
+        currentpage = pages_by_path.get(path)
+        if currentpage is None:
+            return None
+        result = render_page_output(currentpage, render_context)
+        watch_state.record(currentpage,
+                           *page_dependencies(currentpage, render_context))
+        if result is None:
+            return None
+        filepath, page_text, es_json_s = result
+        return page_text
+
+    server = DevServer(render, static_dirs=static_dirs(),
+                       fallback_dir=config["out_path"], host=host, port=port)
+
+    def on_change(changed_paths):
+        nonlocal render_context
+        logger.info("%d file(s) changed: %s" % (len(changed_paths),
+                    ", ".join(sorted(changed_paths))))
+        static_roots = [os.path.abspath(d) for d in server.static_dirs.values()]
+        page_inputs = [p for p in changed_paths if not any(
+                os.path.abspath(p).startswith(root + os.sep) for root in static_roots)]
+        if page_inputs:
+            remote_fetch.get_fetcher().new_build()
+            affected = watch_state.affected_pages(page_inputs)
+            # Don't change pages while one is being rendered
+            with server.render_lock:
+                merge_frontmatter(affected)
+                if affected is None:
+                    render_context = make_render_context(target,
+                            watch_state.pages, "html", bypass_errors=True)
+            if affected is None:
+                server.invalidate()
+            else:
+                affected_ids = {id(p) for p in affected}
+                server.invalidate(path for path, p in pages_by_path.items()
+                                  if id(p) in affected_ids)
+        server.reload()
+
+    debouncer = RebuildDebouncer(on_change, config["watch_debounce"])
+    observer = watch_files(debouncer)
+    static_observer = watch_files(debouncer, patterns=["*"],
+                                  paths=list(server.static_dirs.values()))
+    server.start()
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        observer.stop()
+        pass
+    observer.stop()
+    static_observer.stop()
+    server.shutdown()
     observer.join()
+    static_observer.join()
 
 
 def make_pdf(outfile, target=None, bypass_errors=False, remove_tmp=True,
-        only_page="", es_upload=NO_ES_UP):
-    """Use prince to convert several HTML files into a PDF"""
+        only_page="", es_upload=NO_ES_UP, jobs=1):
+    """Use prince to convert several HTML files into a PDF.
+
+    Pages and static files are staged in a folder (see pdf_staging_dir), and
+    only the ones that changed since the last run are updated. If staging is
+    turned off, they go in a new temp folder. Either way, the folder is
+    removed afterward if remove_tmp is True, unless it's the pdf_staging_path
+    from the config."""
     logger.info("rendering PDF-able versions of pages...")
     target = get_target(target)
 
-    temp_files_path = temp_dir()
+    temp_files_path = pdf_staging_dir(target)
+    staged = temp_files_path is not None
+    if not staged:
+        temp_files_path = temp_dir()
+    pages = get_pages(target, bypass_errors)
     render_pages(target=target, mode="pdf", bypass_errors=bypass_errors,
             temp_files_path=temp_files_path, only_page=only_page,
-            es_upload=es_upload)
+            es_upload=es_upload, jobs=jobs, pages=pages, incremental=staged)
 
     # Choose a reasonable default filename if one wasn't provided yet
     if outfile == DEFAULT_PDF_FILE:
@@ -1065,28 +1918,36 @@ def make_pdf(outfile, target=None, bypass_errors=False, remove_tmp=True,
     # Start preparing the prince command
     args = [config["prince_executable"], '--javascript', '-o', abs_pdf_path, '--no-warn-css']
 
-    pages = get_pages(target, bypass_errors)
     if only_page:
         pages = [p for p in pages if match_only_page(only_page, p)][:1]
         if not len(pages):
             recoverable_error("Couldn't find 'only' page %s" % only_page,
                 bypass_errors)
             return
-    # Each HTML output file in the target is another arg to prince
-    args += [p["html"] for p in pages]
 
     # Change dir to the tempfiles path; this may avoid a bug in Prince
     old_cwd = os.getcwd()
     os.chdir(temp_files_path)
 
-    logger.info("generating PDF: running %s..." % " ".join(args))
-    prince_resp = subprocess.check_output(args, universal_newlines=True)
-    print(prince_resp)
+    if config["pdf_chunk_by"] and len(pages) > 1:
+        chunks = chunk_pages(pages, config["pdf_chunk_by"], config["pdf_chunk_size"])
+        chunked_pdf = ChunkedPdf([[p["html"] for p in chunk] for chunk in chunks],
+                temp_files_path, [config["prince_executable"], '--javascript',
+                '--no-warn-css'], jobs=config["pdf_chunk_jobs"])
+        chunked_pdf.make(abs_pdf_path)
+    else:
+        # Each HTML output file in the target is another arg to prince
+        args += [p["html"] for p in pages]
+
+        logger.info("generating PDF: running %s..." % " ".join(args))
+        prince_resp = subprocess.check_output(args, universal_newlines=True)
+        print(prince_resp)
 
-    # Clean up the tempdir now that we're done using it
+    # Clean up the tempdir now that we're done using it. The default staging
+    # folder is a temp file like any other, but a configured one is kept.
     os.chdir(old_cwd)
-    if remove_tmp:
-        remove_tree(temp_files_path)
+    if remove_tmp and not (staged and config.get("pdf_staging_path")):
+        shutil.rmtree(temp_files_path)
 
 def list_targets():
     rows = []
@@ -1109,6 +1970,8 @@ def main(cli_args):
         list_targets()
         exit(0)
 
+    setup_remote_fetch()
+
     if cli_args.pages:
         make_adhoc_target(cli_args.pages)
         cli_args.target = ADHOC_TARGET
@@ -1144,31 +2007,36 @@ def main(cli_args):
         coverpage["targets"] = [target["name"]]
         config["pages"].insert(0, coverpage)
 
+    if cli_args.serve is not None:
+        # --serve 0 picks any free port
+        serve(target, cli_args.serve)
+        return
+
+    watch_state = None
     if cli_args.pdf != NO_PDF:
         mode = "pdf"
         logger.info("making a pdf...")
         make_pdf(cli_args.pdf,
                 target=target,
                 bypass_errors=cli_args.bypass_errors,
-                remove_tmp=(not cli_args.leave_temp_files),
+                # With --watch, it's removed when watching stops
+                remove_tmp=(not cli_args.leave_temp_files and not cli_args.watch),
                 only_page=cli_args.only,
                 es_upload=cli_args.es_upload,
+                jobs=cli_args.jobs,
         )
         logger.info("pdf done")
     else:
-        # Set mode and default content/template static copy settings
+        # Set modes and default content/template static copy settings
+        mode = []
+        if cli_args.html or not (cli_args.md or cli_args.es):
+            mode.append("html")
         if cli_args.md:
-            mode = "md"
-            content_static = True
-            template_static = False
-        elif cli_args.es:
-            mode = "es"
-            content_static = False
-            template_static = False
-        else:
-            mode = "html"
-            content_static = True
-            template_static = True
+            mode.append("md")
+        if cli_args.es:
+            mode.append("es")
+        content_static = ("html" in mode or "md" in mode)
+        template_static = ("html" in mode)
 
         # Override static files copy setting based on CLI flags, if any are used
         if cli_args.no_static:
@@ -1185,14 +2053,19 @@ def main(cli_args):
             template_static = True
 
 
-        logger.info("rendering %s..." % mode)
-        render_pages(target=target,
+        if cli_args.watch:
+            # Keep the page list and each page's dependencies for rebuilds
+            watch_state = WatchState(get_pages(target, cli_args.bypass_errors))
+
+        render_modes(target=target,
+                     modes=mode,
                      bypass_errors=cli_args.bypass_errors,
                      only_page=cli_args.only,
-                     mode=mode,
                      es_upload=cli_args.es_upload,
+                     jobs=cli_args.jobs,
+                     incremental=cli_args.incremental,
+                     watch_state=watch_state,
         )
-        logger.info("done rendering %s" % mode)
         if content_static or template_static:
             logger.info("outputting static files...")
             copy_static_files(template_static=template_static,
@@ -1201,7 +2074,8 @@ def main(cli_args):
     if cli_args.watch:
         logger.info("watching for changes...")
         watch(mode, target, cli_args.only, cli_args.pdf,
-                es_upload=cli_args.es_upload,)
+                es_upload=cli_args.es_upload, jobs=cli_args.jobs,
+                incremental=cli_args.incremental, watch_state=watch_state)
 
 
 def dispatch_main():
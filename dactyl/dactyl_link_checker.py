@@ -1,276 +1,855 @@
 #!/usr/bin/env python3
 from dactyl.common import *
 
+import contextlib
+import heapq
+import io
+import itertools
+import multiprocessing
+import random
+import sys
+import threading
 import requests
-from bs4 import BeautifulSoup
+import xml.etree.ElementTree as ET
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+from html.parser import HTMLParser
 from time import time, sleep
+from urllib.parse import urlparse
 
 from dactyl.config import DactylConfig
 from dactyl.cli import DactylCLIParser
+from dactyl.link_cache import LinkCache, LinkReport
+from dactyl.link_metrics import LinkCheckMetrics
 
 TIMEOUT_SECS = 9.1
 CHECK_IN_INTERVAL = 30
-FINAL_RETRY_DELAY = 4 * CHECK_IN_INTERVAL
-
-soupsCache = {}
-def getSoup(fullPath):
-    if fullPath in soupsCache.keys():
-        soup = soupsCache[fullPath]
-    else:
-        with open(fullPath, 'r', encoding="utf-8") as f:
-            soup = BeautifulSoup(f.read(), "html.parser")
-            soupsCache[fullPath] = soup
-    return soup
-
-
-def check_for_unparsed_reference_links(soup):
-    #unmatched_reflink_regex = re.compile(r"\[[^\]]+\]\[(\w| )*\]")
-    unmatched_reflink_regex = re.compile(r"(\[[^\]]+)?\]\[(\w| )*\]")
-    unparsed_links = []
-    for s in soup.strings:
-        m = re.search(unmatched_reflink_regex, s)
+MB = 1024 * 1024
+
+UNPARSED_REFLINK_REGEX = re.compile(r"(\[[^\]]+)?\]\[(\w| )*\]")
+
+class PageLinks(HTMLParser):
+    """
+    Everything the link checker needs from one HTML page, collected in a
+    single pass: the targets of links and images (in the order they appear),
+    the ids and <a name> anchors the page defines, and any Markdown reference
+    links that weren't converted to HTML.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links = [] # ("a" or "img", href or src). src is None if missing
+        self.ids = set()
+        self.names = set()
+        self.unparsed_reflinks = []
+        self.in_script = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if attrs.get("id") is not None:
+            self.ids.add(attrs["id"])
+        if tag == "a":
+            if attrs.get("name") is not None:
+                self.names.add(attrs["name"])
+            if "href" in attrs:
+                self.links.append( ("a", attrs["href"] or "") )
+            #else: probably an <a name> type anchor, nothing to check
+        elif tag == "img":
+            if "src" in attrs:
+                self.links.append( ("img", attrs["src"] or "") )
+            else:
+                self.links.append( ("img", None) )
+        elif tag in ("script", "style"):
+            self.in_script += 1
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style") and self.in_script:
+            self.in_script -= 1
+
+    def handle_data(self, data):
+        if self.in_script:
+            return
+        m = re.search(UNPARSED_REFLINK_REGEX, data)
         if m:
-            unparsed_links.append(m.group(0))
-    return unparsed_links
+            self.unparsed_reflinks.append(m.group(0))
+
+
+def read_page_links(fullPath):
+    page = PageLinks()
+    with open(fullPath, 'r', encoding="utf-8") as f:
+        page.feed(f.read())
+    page.close()
+    return page
+
+def saved_page_links(saved):
+    """Rebuild a page's PageLinks from its entry in a LinkReport, instead of
+    parsing the page again."""
+    page = PageLinks()
+    page.links = [(tag, endpoint) for tag, endpoint in saved["links"]]
+    page.ids = set(saved["anchors"])
+    page.unparsed_reflinks = saved["unparsed_reflinks"]
+    return page
+
+class AnchorIndex:
+    """The ids and <a name> anchors defined in each page, so anchor links can
+    be checked without parsing (or keeping) the target pages.
+
+    To keep memory use bounded on large sites, the index holds at most about
+    max_bytes of anchors. When it's full, it forgets the pages that were used
+    least recently; if they're needed again, they're re-read from disk."""
+    def __init__(self, max_bytes=0):
+        self.anchors = OrderedDict()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self.rereads = 0
+        self.evicted = set()
+
+    def add(self, fullPath, anchors):
+        fullPath = os.path.normpath(fullPath)
+        self.anchors[fullPath] = anchors
+        self.size += anchors_size(anchors)
+        while self.max_bytes and self.size > self.max_bytes and len(self.anchors) > 1:
+            oldPath, oldAnchors = self.anchors.popitem(last=False)
+            self.size -= anchors_size(oldAnchors)
+            self.evicted.add(oldPath)
+            self.evictions += 1
+
+    def has_anchor(self, fullPath, anchor):
+        fullPath = os.path.normpath(fullPath)
+        if fullPath in self.anchors:
+            self.anchors.move_to_end(fullPath)
+        else:
+            # Evicted, or not one of the pages in the walk (such as a
+            # non-.html file)
+            if fullPath in self.evicted:
+                self.rereads += 1
+            page = read_page_links(fullPath)
+            self.add(fullPath, frozenset(page.ids | page.names))
+        return anchor in self.anchors[fullPath]
+
+    def report(self):
+        logger.info(("Anchor index: %d pages, %.1f MB (limit: %s), "+
+                     "%d evicted, %d re-read") % (len(self.anchors),
+                     self.size / MB, "%d MB" % (self.max_bytes / MB)
+                     if self.max_bytes else "none",
+                     self.evictions, self.rereads))
+
+
+def anchors_size(anchors):
+    """Approximate memory use, in bytes, of a set of anchors."""
+    return sys.getsizeof(anchors) + sum(sys.getsizeof(a) for a in anchors)
+
+
+def peak_memory_mb():
+    """Returns the peak memory use of this process, in MB, or None if it can't
+    be measured on this platform."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / MB # bytes
+    return peak / 1024 # kilobytes
+
+
+def resolve_anchor_links(pending_anchors, anchor_index, broken_links):
+    """Check anchor links against the anchors of every page, once they've
+    all been indexed."""
+    for seq, fullPath, endpoint, fullTargetPath, anchor in pending_anchors:
+        if anchor_index.has_anchor(fullTargetPath, anchor):
+            logger.info("...anchor %s found." % endpoint)
+        else:
+            logger.warning("Broken anchor link in %s to %s" %
+                    (fullPath, endpoint))
+            broken_links.append( (seq, fullPath, endpoint) )
 
 
-def check_remote_url(endpoint, fullPath, broken_links, externalCache, isImg=False):
-    if isImg:
-        linkword = "image"
-    else:
-        linkword = "link"
-    if endpoint in [v for k,v in broken_links]:
-        # We already confirmed this was broken, so just add another instance
-        logger.warning("Broken %s %s appears again in %s" % (linkword, endpoint, fullPath))
-        broken_links.append( (fullPath, endpoint) )
-        return False
-    if endpoint in externalCache:
-        logger.debug("Skipping cached %s %s" % (linkword, endpoint))
-        return True
-    if endpoint in config["known_broken_links"]:
-        logger.warning("Skipping known broken %s %s in %s" % (linkword, endpoint, fullPath))
-        return True
-
-    logger.info("Testing remote %s URL %s"%(linkword, endpoint))
+def remote_url_status(endpoint, session=requests, headers=None):
+    """Returns the HTTP status code of a remote URL, or 500 if the request
+    fails entirely, and the response (if any)."""
+    r = None
     try:
-        code = requests.head(endpoint, timeout=TIMEOUT_SECS).status_code
+        r = session.head(endpoint, headers=headers, timeout=TIMEOUT_SECS)
+        code = r.status_code
     except Exception as e:
         logger.warning("Error occurred: %s" % repr(e))
         code = 500
     if code == 405 or code == 404:
         #HEAD didn't work, maybe GET will?
         try:
-            code = requests.get(endpoint, timeout=TIMEOUT_SECS).status_code
+            r = session.get(endpoint, headers=headers, timeout=TIMEOUT_SECS)
+            code = r.status_code
         except Exception as e:
           logger.warning("Error occurred: %s" % repr(e))
           code = 500
-
-    if code < 200 or code >= 400:
-        logger.warning("Broken remote %s in %s to %s"%(linkword, fullPath, endpoint))
-        broken_links.append( (fullPath, endpoint) )
-        return False
-    else:
-        logger.info("...success.")
-        externalCache.append(endpoint)
-        return True
-
-
-def checkLinks(offline=False):
-    externalCache = []
-    broken_links = []
-    num_links_checked = 0
-    last_checkin = time()
-    for dirpath, dirnames, filenames in os.walk(config["out_path"]):
-        if time() - last_checkin > CHECK_IN_INTERVAL:
+    return code, r
+
+
+class RemoteHost:
+    """Connection limit, politeness delay, and keep-alive session for one
+    host."""
+    def __init__(self, connections, delay):
+        self.semaphore = threading.Semaphore(connections)
+        self.delay = delay
+        self.next_request = 0
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def wait_turn(self):
+        """Sleeps until at least delay seconds after the last request to this
+        host started."""
+        with self.lock:
+            now = time()
+            start = max(now, self.next_request)
+            self.next_request = start + self.delay
+        if start > now:
+            sleep(start - now)
+
+
+def retry_after_secs(r):
+    """Returns the number of seconds a response's Retry-After header asks
+    for, or None."""
+    if r is None or not r.headers.get("Retry-After"):
+        return None
+    value = r.headers["Retry-After"]
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryScheduler:
+    """Calls functions after a delay, from one background thread."""
+    def __init__(self):
+        self.queue = [] # heap of (time to run, sequence, function)
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def call_later(self, delay, func):
+        with self.cond:
+            heapq.heappush(self.queue, (time() + delay, next(self.counter), func))
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.closed and (not self.queue or
+                                           self.queue[0][0] > time()):
+                    if self.queue:
+                        self.cond.wait(self.queue[0][0] - time())
+                    else:
+                        self.cond.wait()
+                if self.closed:
+                    return
+                when, n, func = heapq.heappop(self.queue)
+            func()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+
+class RemoteLinkChecker:
+    """
+    Checks remote URLs in a pool of threads, so the local files can be parsed
+    while the requests run. Each URL is requested only once, no matter how
+    many times it's linked. Requests to any one host are limited to
+    host_connections at a time, and start at least host_delay seconds apart.
+
+    URLs that look broken are retried up to retries times, in case they're
+    just flaps, with exponential backoff (starting from retry_delay seconds,
+    up to max_retry_delay) or as long as the server's Retry-After header
+    asks. Other checks keep going in the meantime.
+
+    With a LinkCache, URLs with fresh cached results aren't requested at all,
+    and other URLs that worked before are requested conditionally.
+
+    Requests and their response times are counted in metrics, a
+    LinkCheckMetrics.
+    """
+    def __init__(self, max_connections=16, host_connections=2, host_delay=0,
+                 cache=None, retries=0, retry_delay=5, max_retry_delay=60,
+                 metrics=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_connections)
+        self.scheduler = RetryScheduler()
+        self.host_connections = host_connections
+        self.host_delay = host_delay
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.hosts = {}
+        self.statuses = {}
+        self.cache = cache
+        self.metrics = metrics or LinkCheckMetrics()
+        self.lock = threading.Lock()
+
+    def check(self, endpoint):
+        """Returns a Future for the URL's status code."""
+        with self.lock:
+            if endpoint in self.statuses:
+                return self.statuses[endpoint]
+            code = None
+            if self.cache:
+                code = self.cache.lookup(endpoint)
+            status = Future()
+            if code is None:
+                self.metrics.url_queued()
+                self.executor.submit(self.fetch_status, endpoint, status)
+            else:
+                logger.debug("Using cached status %d for %s" % (code, endpoint))
+                status.set_result(code)
+            self.statuses[endpoint] = status
+            return status
+
+    def host(self, netloc):
+        with self.lock:
+            if netloc not in self.hosts:
+                self.hosts[netloc] = RemoteHost(self.host_connections,
+                                                self.host_delay)
+            return self.hosts[netloc]
+
+    def fetch_status(self, endpoint, status, attempt=0):
+        """Request a URL and set the result of the status Future, or schedule
+        a retry."""
+        try:
+            netloc = urlparse(endpoint).netloc
+            host = self.host(netloc)
+            with host.semaphore:
+                host.wait_turn()
+                logger.info("Testing remote URL %s" % endpoint)
+                headers = None
+                if self.cache:
+                    headers = self.cache.conditional_headers(endpoint)
+                self.metrics.request_started()
+                started = time()
+                try:
+                    code, r = remote_url_status(endpoint, host.session, headers)
+                finally:
+                    self.metrics.request_done(netloc, time() - started)
+
+            if (code < 200 or code >= 400) and attempt < self.retries:
+                delay = self.retry_delay * (2 ** attempt) * random.uniform(0.5, 1.5)
+                retry_after = retry_after_secs(r)
+                if retry_after is not None:
+                    delay = retry_after
+                delay = min(delay, self.max_retry_delay)
+                logger.info("Remote URL %s returned %d; retrying in %.1fs" %
+                            (endpoint, code, delay))
+                self.scheduler.call_later(delay, lambda: self.executor.submit(
+                        self.fetch_status, endpoint, status, attempt + 1))
+                return
+            if attempt and 200 <= code < 400:
+                logger.info("Remote URL %s is back online" % endpoint)
+
+            if self.cache:
+                code = self.cache.update(endpoint, code, r)
+        except Exception as e:
+            # Don't leave anyone waiting on this URL forever
+            logger.warning("Error checking %s: %s" % (endpoint, repr(e)))
+            code = 500
+        self.metrics.url_done()
+        status.set_result(code)
+
+    def close(self):
+        self.scheduler.close()
+        self.executor.shutdown()
+        for host in self.hosts.values():
+            host.session.close()
+
+
+def resolve_remote_links(pending_remote, broken_links):
+    """Wait for queued remote link checks and add the broken ones to
+    broken_links."""
+    confirmed_broken = set()
+    for seq, fullPath, endpoint, isImg, status in pending_remote:
+        while not wait([status], timeout=CHECK_IN_INTERVAL).done:
             ## Print output periodically so Jenkins/etc. don't kill the job
-            last_checkin = time()
-            print("... still working (dirpath: %s) ..." % dirpath)
+            print("... still working (waiting for %s) ..." % endpoint)
+        code = status.result()
+        if isImg:
+            linkword = "image"
+        else:
+            linkword = "link"
+        if code < 200 or code >= 400:
+            if endpoint in confirmed_broken:
+                logger.warning("Broken %s %s appears again in %s" %
+                               (linkword, endpoint, fullPath))
+            else:
+                logger.warning("Broken remote %s in %s to %s" %
+                               (linkword, fullPath, endpoint))
+                confirmed_broken.add(endpoint)
+            broken_links.append( (seq, fullPath, endpoint) )
+
+
+def get_link_cache(max_age=None):
+    """Loads the link cache, or returns None if it's turned off (or the
+    default cache folder can't be used)."""
+    cache_path = config.get("link_cache_path")
+    if cache_path is None:
+        # Others could make broken links look OK, so by default the cache is
+        # private to this user
+        cache_dir = user_temp_path(config["temporary_files_path"],
+                                   "dactyl-link-cache")
+        try:
+            private_dir(cache_dir)
+        except OSError as e:
+            logger.warning("Not caching link results: %s" % repr(e))
+            return None
+        cache_path = os.path.join(cache_dir, "link-cache.jsonl")
+    if not cache_path:
+        return None
+    return LinkCache(cache_path, ok_ttl=config["link_cache_ttl"],
+                     broken_ttl=config["link_cache_broken_ttl"], max_age=max_age)
+
+
+def find_pages():
+    """Lists the HTML files in the output path to check, in the order
+    os.walk() finds them."""
+    pages = []
+    for dirpath, dirnames, filenames in os.walk(config["out_path"]):
         if "template_path" in config and \
                os.path.abspath(dirpath) == os.path.abspath(config["template_path"]):
             # don't try to parse and linkcheck the templates
             logger.warning("Skipping link checking for template path %s" % dirpath)
             continue
         for fname in filenames:
-            if time() - last_checkin > CHECK_IN_INTERVAL:
-                last_checkin = time()
-                print("... still working (file: %s) ..." % fname)
-
             fullPath = os.path.join(dirpath, fname)
             if "/node_modules/" in fullPath or ".git" in fullPath:
                 logger.debug("skipping ignored dir: %s" % fullPath)
                 continue
             if fullPath.endswith(".html"):
-                soup = getSoup(fullPath)
-                unparsed_links = check_for_unparsed_reference_links(soup)
-                if unparsed_links:
-                    logger.warning("Found %d unparsed Markdown reference links: %s" %
-                            (len(unparsed_links), "\n... ".join(unparsed_links)))
-                    [broken_links.append( (fullPath, u) ) for u in unparsed_links]
-                links = soup.find_all('a')
-                for link in links:
-                    if time() - last_checkin > CHECK_IN_INTERVAL:
-                        last_checkin = time()
-                        print("... still working (link: %s) ..." % link)
-                    if "href" not in link.attrs:
-                        #probably an <a name> type anchor, skip
-                        continue
-
-                    endpoint = link['href']
-                    if not endpoint.strip():
-                        logger.warning("Empty link in %s" % fullPath)
-                        broken_links.append( (fullPath, endpoint) )
-                        num_links_checked += 1
-
-                    elif endpoint == "#":
-                        continue
-
-                    elif "mailto:" in endpoint:
-                        logger.warning("Skipping email link in %s to %s" %
-                                (fullPath, endpoint))
-                        continue
-
-                    elif endpoint[0] == '/':
-                        # Can't properly test absolute links without knowing where the
-                        #   server root will be, so skip this
-                        logger.warning("Skipping absolute link in %s to %s" %
-                                (fullPath, endpoint))
-                        continue
-
-                    elif "://" in endpoint:
-                        if offline:
-                            logger.info("Offline - Skipping remote URL %s" % (endpoint))
-                            continue
-
-                        num_links_checked += 1
-                        check_remote_url(endpoint, fullPath, broken_links, externalCache)
-
-
-                    elif '#' in endpoint:
-                        if fname in config["ignore_anchors_in"]:
-                            logger.warning("Ignoring anchor %s in dynamic page %s" %
-                                    (endpoint,fname))
-                            continue
-                        logger.info("Testing local link %s from %s" %
-                                (endpoint, fullPath))
-                        num_links_checked += 1
-                        filename,anchor = endpoint.split("#",1)
-                        # Strip query parameters
-                        if "?" in filename:
-                            filename, query = filename.split("?", 1)
-                        if filename == "":
-                            fullTargetPath = fullPath
-                        else:
-                            fullTargetPath = os.path.join(dirpath, filename)
-                        if not os.path.exists(fullTargetPath):
-                            logger.warning("Broken local link in %s to %s" %
-                                    (fullPath, endpoint))
-                            broken_links.append( (fullPath, endpoint) )
-
-                        elif filename in config["ignore_anchors_in"]:
-                            #Some pages are populated dynamically, so BeatifulSoup wouldn't
-                            # be able to find anchors in them anyway
-                            logger.info("Skipping anchor link in %s to ignored page %s" %
-                                  (fullPath, endpoint))
-                            continue
-
-                        elif fullTargetPath != "../":
-                            num_links_checked += 1
-                            targetSoup = getSoup(fullTargetPath)
-                            if not targetSoup.find(id=anchor) and not targetSoup.find(
-                                        "a",attrs={"name":anchor}):
-                                logger.warning("Broken anchor link in %s to %s" %
-                                        (fullPath, endpoint))
-                                broken_links.append( (fullPath, endpoint) )
-                            else:
-                                logger.info("...anchor found.")
-                            continue
+                pages.append(fullPath)
+    return pages
+
+
+class PageCheck:
+    """The results of checking the links in one page, apart from the parts
+    that need other pages or the network: the page's anchors, the number of
+    links checked, and a list of results in the order they were found:
+
+    ("broken", link)
+    ("remote", url, is_image) - to be checked over the network
+    ("anchor", link, target_path, anchor) - to be checked once every page's
+                                            anchors are known
+
+    links and unparsed_reflinks are what was found in the page, for saving in
+    a LinkReport.
+    """
+    def __init__(self, fullPath, anchors, results, num_links_checked,
+                 links=None, unparsed_reflinks=None):
+        self.fullPath = fullPath
+        self.anchors = anchors
+        self.results = results
+        self.num_links_checked = num_links_checked
+        self.links = links
+        self.unparsed_reflinks = unparsed_reflinks
+
+
+def check_page(fullPath, offline=False, saved=None):
+    """Parse one page and check its local links and images. If saved is the
+    page's entry from a LinkReport, use the links saved there instead of
+    parsing the page; the local files they point to are still checked."""
+    dirpath, fname = os.path.split(fullPath)
+    if saved is None:
+        page = read_page_links(fullPath)
+    else:
+        page = saved_page_links(saved)
+    results = []
+    num_links_checked = 0
+    unparsed_links = page.unparsed_reflinks
+    if unparsed_links:
+        logger.warning("Found %d unparsed Markdown reference links: %s" %
+                (len(unparsed_links), "\n... ".join(unparsed_links)))
+        [results.append( ("broken", u) ) for u in unparsed_links]
+    checked = set()
+    for tag, endpoint in page.links:
+        if endpoint in checked:
+            # Same target as an earlier link/image on this page
+            continue
+        checked.add(endpoint)
+
+        if tag == "img":
+            num_links_checked += 1
+            src = endpoint
+            if not src or not src.strip():
+                logger.warning("Broken image with no src in %s" % fullPath)
+                results.append( ("broken", src or "") )
+
+            elif src[0] == "/":
+                logger.warning("Skipping absolute image path %s in %s" %
+                        (src, fullPath))
+            elif "://" in src:
+                if offline:
+                    logger.info("Offline - Skipping remote image %s"%(src))
+                    continue
+
+                results.append( ("remote", src, True) )
+
+            else:
+                logger.info("Checking local image %s in %s" %
+                        (src, fullPath))
+                if os.path.exists(os.path.join(dirpath, src)):
+                    logger.info("...success")
+                else:
+                    logger.warning("Broken local image %s in %s" %
+                            (src, fullPath))
+                    results.append( ("broken", src) )
+
+        elif not endpoint.strip():
+            logger.warning("Empty link in %s" % fullPath)
+            results.append( ("broken", endpoint) )
+            num_links_checked += 1
+
+        elif endpoint == "#":
+            continue
 
-                    else:
-                        num_links_checked += 1
-                        if "?" in endpoint:
-                            filename, query = endpoint.split("?", 1)
-                        else:
-                            filename = endpoint
-                        if not os.path.exists(os.path.join(dirpath, filename)):
-                            logger.warning("Broken local link in %s to %s" %
-                                    (fullPath, filename))
-                            broken_links.append( (fullPath, filename) )
-
-                    #Now check images
-                    imgs = soup.find_all('img')
-                    for img in imgs:
-                        num_links_checked += 1
-                        if "src" not in img.attrs or not img["src"].strip():
-                            logger.warning("Broken image with no src in %s" % fullPath)
-                            broken_links.append( (fullPath, img["src"]) )
-                            continue
-
-                        src = img["src"]
-                        if src[0] == "/":
-                            logger.warning("Skipping absolute image path %s in %s" %
-                                    (src, fullPath))
-                        elif "://" in src:
-                            if offline:
-                                logger.info("Offline - Skipping remote image %s"%(endpoint))
-                                continue
-
-                            check_remote_url(src, fullPath, broken_links, externalCache, isImg=True)
-
-                        else:
-                            logger.info("Checking local image %s in %s" %
-                                    (src, fullPath))
-                            if os.path.exists(os.path.join(dirpath, src)):
-                                logger.info("...success")
-                            else:
-                                logger.warning("Broken local image %s in %s" %
-                                        (src, fullPath))
-                                broken_links.append( (fullPath, src) )
-    return broken_links, num_links_checked
-
-
-def final_retry_links(broken_links):
-    """Give the broken remote links a little while to recover in case they're just flaps"""
-    broken_remote_links = [ (page,link) for page,link in broken_links
-                           if re.match(r"^https?://", link) ]
-    if not broken_remote_links:
-        logger.info("(no http/https broken links to retry)")
-        return
+        elif "mailto:" in endpoint:
+            logger.warning("Skipping email link in %s to %s" %
+                    (fullPath, endpoint))
+            continue
+
+        elif endpoint[0] == '/':
+            # Can't properly test absolute links without knowing where the
+            #   server root will be, so skip this
+            logger.warning("Skipping absolute link in %s to %s" %
+                    (fullPath, endpoint))
+            continue
+
+        elif "://" in endpoint:
+            if offline:
+                logger.info("Offline - Skipping remote URL %s" % (endpoint))
+                continue
+
+            num_links_checked += 1
+            results.append( ("remote", endpoint, False) )
+
+
+        elif '#' in endpoint:
+            if fname in config["ignore_anchors_in"]:
+                logger.warning("Ignoring anchor %s in dynamic page %s" %
+                        (endpoint,fname))
+                continue
+            logger.info("Testing local link %s from %s" %
+                    (endpoint, fullPath))
+            num_links_checked += 1
+            filename,anchor = endpoint.split("#",1)
+            # Strip query parameters
+            if "?" in filename:
+                filename, query = filename.split("?", 1)
+            if filename == "":
+                fullTargetPath = fullPath
+            else:
+                fullTargetPath = os.path.join(dirpath, filename)
+            if not os.path.exists(fullTargetPath):
+                logger.warning("Broken local link in %s to %s" %
+                        (fullPath, endpoint))
+                results.append( ("broken", endpoint) )
+
+            elif filename in config["ignore_anchors_in"]:
+                #Some pages are populated dynamically, so the
+                # anchors wouldn't be in the HTML anyway
+                logger.info("Skipping anchor link in %s to ignored page %s" %
+                      (fullPath, endpoint))
+                continue
+
+            elif fullTargetPath != "../":
+                num_links_checked += 1
+                # The target might not be indexed yet, so check
+                # it after the walk
+                results.append( ("anchor", endpoint, fullTargetPath, anchor) )
+                continue
 
-    print("Waiting %d seconds to retry broken %d remote links..."
-                % (FINAL_RETRY_DELAY, len(broken_remote_links)))
-    start_wait = time()
-    elapsed = 0
-    while elapsed < FINAL_RETRY_DELAY:
-        sleep(CHECK_IN_INTERVAL)
-        print("...")
-        elapsed = time() - start_wait
-
-    retry_cache = []
-    retry_broken = []
-    for page, link in broken_remote_links:
-        link_works = check_remote_url(link, page, retry_broken, retry_cache)
-        if link_works:
-            logger.info("Link %s in page %s is back online" % (link, page))
-            broken_links.remove( (page,link) )
         else:
-            logger.info("Link %s in page %s is still down." % (link, page))
+            num_links_checked += 1
+            if "?" in endpoint:
+                filename, query = endpoint.split("?", 1)
+            else:
+                filename = endpoint
+            if not os.path.exists(os.path.join(dirpath, filename)):
+                logger.warning("Broken local link in %s to %s" %
+                        (fullPath, filename))
+                results.append( ("broken", filename) )
+
+    return PageCheck(fullPath, frozenset(page.ids | page.names), results,
+                     num_links_checked, page.links, page.unparsed_reflinks)
+
+
+# Set in the parent before forking, for the worker processes to use
+_worker_pages = []
+_worker_offline = False
+_worker_saved = {}
+
+def check_pages_parallel(pages, offline, jobs, saved_pages={}):
+    """Check pages in a pool of forked worker processes. Yields the same
+    results as check_page, in page order. Each page's console output is
+    replayed when its result is consumed, so the log reads the same as a
+    serial run."""
+    global _worker_pages, _worker_offline, _worker_saved
+    if "fork" not in multiprocessing.get_all_start_methods():
+        logger.warning("Parallel link checking requires fork(); checking serially")
+        for fullPath in pages:
+            yield check_page(fullPath, offline, saved_pages.get(fullPath))
+        return
 
+    _worker_pages = pages
+    _worker_offline = offline
+    _worker_saved = saved_pages
+    # Don't let the workers inherit (and re-print) buffered output
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    logger.info("checking %d pages with %d jobs..." % (len(pages), jobs))
+    chunksize = max(1, len(pages) // (jobs * 4))
+    ctx = multiprocessing.get_context("fork")
+    with ctx.Pool(jobs) as pool:
+        for result, out_s, err_s in pool.imap(_check_page_job,
+                range(len(pages)), chunksize):
+            sys.stdout.write(out_s)
+            sys.stderr.write(err_s)
+            yield result
+
+
+def _check_page_job(i):
+    """Pool worker: check one page, capturing its output instead of printing
+    it. Returns (result, stdout text, stderr text)."""
+    out_buf = io.StringIO()
+    err_buf = io.StringIO()
+    handlers = [h for h in logger.handlers if isinstance(h, logging.StreamHandler)]
+    old_streams = [h.setStream(err_buf) for h in handlers]
+    try:
+        with contextlib.redirect_stdout(out_buf), contextlib.redirect_stderr(err_buf):
+            fullPath = _worker_pages[i]
+            result = check_page(fullPath, _worker_offline,
+                                _worker_saved.get(fullPath))
+    finally:
+        for h, old_stream in zip(handlers, old_streams):
+            h.setStream(old_stream)
+    return result, out_buf.getvalue(), err_buf.getvalue()
+
+
+class LinkCheckResults:
+    """
+    The outcome of a link check, indexed so that looking up a link or URL
+    doesn't mean scanning a list:
+
+    broken          - (page, link) pairs, in the order they were found
+    broken_by_link  - link -> pages where it's broken
+    statuses        - remote URL -> status code
+    referrers       - remote URL -> pages that link to it
+    """
+    def __init__(self, out_path, pages, known_broken_links=()):
+        self.out_path = out_path
+        self.pages = pages
+        self.known_broken_links = set(known_broken_links)
+        self.num_links_checked = 0
+        self.broken = []
+        self.broken_by_link = {}
+        self.statuses = {}
+        self.referrers = {}
+
+    def add_broken(self, page, link):
+        self.broken.append( (page, link) )
+        self.broken_by_link.setdefault(link, []).append(page)
+
+    def add_remote(self, page, url, status):
+        self.statuses[url] = status
+        self.referrers.setdefault(url, []).append(page)
+
+    def is_known(self, link):
+        return link in self.known_broken_links
+
+    def unknown_broken(self):
+        return [(page, link) for page, link in self.broken
+                if link not in self.known_broken_links]
+
+    def relpath(self, page):
+        return os.path.relpath(page, self.out_path)
+
+    def to_json(self):
+        return {
+            "out_path": self.out_path,
+            "pages_checked": len(self.pages),
+            "links_checked": self.num_links_checked,
+            "broken": [{"page": self.relpath(page), "link": link,
+                        "status": self.statuses.get(link),
+                        "known": self.is_known(link)}
+                       for page, link in self.broken],
+            "remote": {url: {"status": status,
+                             "pages": [self.relpath(p) for p in self.referrers[url]]}
+                       for url, status in sorted(self.statuses.items())},
+        }
+
+    def write_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_json(), f, indent=1)
+        logger.info("Wrote JSON link report to %s" % path)
+
+    def write_junit(self, path, strict=False):
+        """Write a JUnit XML report with one test case per page. A page fails
+        if it has broken links (other than known ones, unless strict)."""
+        broken_by_page = {}
+        for page, link in self.broken:
+            broken_by_page.setdefault(page, []).append(link)
+        suite = ET.Element("testsuite", name="dactyl_link_checker",
+                           tests=str(len(self.pages)))
+        failures = 0
+        for page in self.pages:
+            case = ET.SubElement(suite, "testcase", classname="links",
+                                 name=self.relpath(page))
+            links = broken_by_page.get(page, [])
+            if not strict:
+                known = [l for l in links if self.is_known(l)]
+                links = [l for l in links if not self.is_known(l)]
+                if known:
+                    ET.SubElement(case, "system-out").text = \
+                        "Known broken links:\n" + "\n".join(known)
+            if links:
+                failures += 1
+                failure = ET.SubElement(case, "failure",
+                        message="%d broken links" % len(links))
+                failure.text = "\n".join(links)
+        suite.set("failures", str(failures))
+        ET.ElementTree(suite).write(path, encoding="utf-8", xml_declaration=True)
+        logger.info("Wrote JUnit link report to %s" % path)
+
+
+def checkLinks(*args, **kwargs):
+    """Check the links in the output folder. Returns a list of broken links,
+    as (page, link) pairs, and the number of links checked."""
+    results = check_site(*args, **kwargs)
+    return results.broken, results.num_links_checked
+
+
+def check_site(offline=False, max_age=None, jobs=1, retry=True,
+               incremental=False, metrics_path=None):
+    """Check the links in the output folder and return LinkCheckResults. If
+    metrics_path is provided, write progress metrics there as JSON lines."""
+    broken_links = []
+    pending_remote = []
+    seq = itertools.count() # Keeps broken links in the order they were found
+    cache = None
+    if not offline:
+        cache = get_link_cache(max_age)
+    metrics = LinkCheckMetrics(cache=cache, path=metrics_path,
+                               interval=config["link_check_metrics_interval"])
+    remote = RemoteLinkChecker(
+        max_connections=config["link_check_max_connections"],
+        host_connections=config["link_check_host_connections"],
+        host_delay=config["link_check_host_delay"],
+        cache=cache,
+        retries=(config["link_check_retries"] if retry else 0),
+        retry_delay=config["link_check_retry_delay"],
+        max_retry_delay=config["link_check_max_retry_delay"],
+        metrics=metrics)
+    anchor_index = AnchorIndex(max_bytes=config["link_check_anchor_cache_mb"] * MB)
+    pending_anchors = []
+
+    pages = find_pages()
+    metrics.pages_total = len(pages)
+    results = LinkCheckResults(config["out_path"], pages,
+                               config["known_broken_links"])
+    report = None
+    saved_pages = {}
+    if incremental:
+        # Pages that haven't changed since the last check aren't parsed again.
+        # Their local links and anchors are still checked, in case the pages
+        # they point to changed, and their remote links go through the link
+        # cache like any others, so old results still expire.
+        report = LinkReport(config["out_path"])
+        for fullPath in pages:
+            saved = report.saved_page(fullPath)
+            if saved:
+                saved_pages[fullPath] = saved
+        logger.info("%d of %d pages changed since the last link check" %
+                    (len(pages) - len(saved_pages), len(pages)))
+
+    if jobs > 1 and len(pages) > 1:
+        page_checks = check_pages_parallel(pages, offline, jobs, saved_pages)
+    else:
+        page_checks = (check_page(fullPath, offline, saved_pages.get(fullPath))
+                       for fullPath in pages)
 
+    last_checkin = time()
+    for page_check in page_checks:
+        if time() - last_checkin > CHECK_IN_INTERVAL:
+            ## Print output periodically so Jenkins/etc. don't kill the job
+            last_checkin = time()
+            print("... still working (file: %s) ..." % page_check.fullPath)
+        fullPath = page_check.fullPath
+        saved = saved_pages.get(fullPath)
+        metrics.page_parsed()
+        anchor_index.add(fullPath, page_check.anchors)
+        results.num_links_checked += page_check.num_links_checked
+        if report:
+            report.add_page(fullPath, page_check.links, page_check.anchors,
+                            page_check.unparsed_reflinks, saved)
+        # Remote links start checking now, while the other pages are parsed
+        for result in page_check.results:
+            if result[0] == "broken":
+                broken_links.append( (next(seq), fullPath, result[1]) )
+            elif result[0] == "remote":
+                endpoint, isImg = result[1:]
+                if results.is_known(endpoint):
+                    logger.warning("Skipping known broken %s %s in %s" %
+                            ("image" if isImg else "link", endpoint, fullPath))
+                    continue
+                status = remote.check(endpoint)
+                pending_remote.append( (next(seq), fullPath, endpoint, isImg,
+                                        status) )
+            elif result[0] == "anchor":
+                pending_anchors.append( (next(seq), fullPath) + result[1:] )
+
+    resolve_anchor_links(pending_anchors, anchor_index, broken_links)
+    anchor_index.report()
+    resolve_remote_links(pending_remote, broken_links)
+    remote.close()
+    for _, fullPath, endpoint, isImg, status in pending_remote:
+        results.add_remote(fullPath, endpoint, status.result())
+    metrics.close()
+    if report:
+        report.save()
+    if cache:
+        logger.info("Link cache: %d hits, %d misses" % (cache.hits, cache.misses))
+        cache.save()
+    peak_mb = peak_memory_mb()
+    if peak_mb is not None:
+        logger.info("Peak memory use: %.1f MB" % peak_mb)
+    broken_links.sort()
+    for seq, page, link in broken_links:
+        results.add_broken(page, link)
+    return results
 
-def main(cli_args):
-    broken_links, num_links_checked = checkLinks(cli_args.offline)
 
-    if not cli_args.no_final_retry and not cli_args.offline:
-        final_retry_links(broken_links)
-        #^ sleeps for FINAL_RETRY_DELAY and then retries remote links
-        # Automatically removes from broken_links if they work now
+def main(cli_args):
+    results = check_site(cli_args.offline, cli_args.max_age, cli_args.jobs,
+            retry=(not cli_args.no_final_retry),
+            incremental=cli_args.incremental, metrics_path=cli_args.metrics)
+    broken_links = results.broken
+    if cli_args.json_report:
+        results.write_json(cli_args.json_report)
+    if cli_args.junit_report:
+        results.write_junit(cli_args.junit_report, cli_args.strict)
 
     print("---------------------------------------")
-    print("Link check report. %d links checked."%num_links_checked)
+    print("Link check report. %d links checked."%results.num_links_checked)
 
     if not cli_args.strict:
-        unknown_broken_links = [ (page,link) for page,link in broken_links
-                        if link not in config["known_broken_links"] ]
+        unknown_broken_links = results.unknown_broken()
 
     if not broken_links:
         print("Success! No broken links found.")
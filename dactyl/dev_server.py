@@ -0,0 +1,186 @@
+################################################################################
+# Dactyl dev server
+#
+# Serves a target's pages over HTTP for previewing, rendering each page the
+# first time it's requested and keeping the result in memory until one of its
+# inputs changes. Pages include a small script that listens for Server-Sent
+# Events and reloads the page when the server says something changed.
+################################################################################
+from dactyl.common import *
+
+import mimetypes
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+EVENTS_PATH = "/__dactyl_events"
+KEEPALIVE_SECS = 15
+RELOAD_SCRIPT = """<script>
+new EventSource("%s").addEventListener("reload", function() {
+    location.reload();
+});
+</script>""" % EVENTS_PATH
+
+def add_reload_script(html):
+    i = html.lower().rfind("</body>")
+    if i == -1:
+        return html + RELOAD_SCRIPT
+    return html[:i] + RELOAD_SCRIPT + html[i:]
+
+
+class DevRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug("dev server: " + format % args)
+
+    def do_GET(self):
+        server = self.server.dev_server
+        path = unquote(urlparse(self.path).path)
+        if path == EVENTS_PATH:
+            self.send_events(server)
+            return
+        if path.endswith("/"):
+            path += "index.html"
+
+        try:
+            html = server.get_page(path)
+        except Exception as e:
+            traceback.print_tb(e.__traceback__)
+            self.send_body(500, "text/plain; charset=utf-8",
+                           ("Error rendering %s: %s" % (path, repr(e))).encode("utf-8"))
+            return
+        if html is not None:
+            self.send_body(200, "text/html; charset=utf-8",
+                           add_reload_script(html).encode("utf-8"))
+            return
+
+        filepath = server.find_static_file(path)
+        if filepath is None:
+            self.send_body(404, "text/plain; charset=utf-8",
+                           ("Not found: %s" % path).encode("utf-8"))
+            return
+        content_type = mimetypes.guess_type(filepath)[0] or "application/octet-stream"
+        with open(filepath, "rb") as f:
+            self.send_body(200, content_type, f.read())
+
+    def send_body(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self, server):
+        """Stream a reload event every time the server's content changes."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        version = server.version
+        try:
+            self.wfile.write(b": connected\n\n")
+            self.wfile.flush()
+            while not server.stopping:
+                new_version = server.wait_for_change(version, KEEPALIVE_SECS)
+                if new_version == version:
+                    self.wfile.write(b": keepalive\n\n")
+                else:
+                    version = new_version
+                    self.wfile.write(b"event: reload\ndata: %d\n\n" % version)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class DevServer:
+    """
+    An HTTP server for previewing pages. render(path) returns the HTML of the
+    page at a URL path, or None if there's no such page; results are kept in
+    memory until invalidate() is called for them. Other paths are served from
+    static_dirs, a dict of URL path prefix -> folder, or from fallback_dir.
+
+    Call reload() to tell connected browsers to reload.
+    """
+    def __init__(self, render, static_dirs={}, fallback_dir=None,
+                 host="localhost", port=8000):
+        self.render = render
+        self.static_dirs = static_dirs
+        self.fallback_dir = fallback_dir
+        self.cache = {}
+        self.render_lock = threading.Lock() # Rendering isn't thread-safe
+        self.version = 0
+        self.changed = threading.Condition()
+        self.stopping = False
+        self.httpd = ThreadingHTTPServer((host, port), DevRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.dev_server = self
+        self.url = "http://%s:%d/" % (host, self.httpd.server_address[1])
+
+    def get_page(self, path):
+        with self.render_lock:
+            if path not in self.cache:
+                start = time.time()
+                html = self.render(path)
+                if html is None:
+                    return None
+                logger.info("Rendered %s in %.0fms" % (path,
+                            (time.time() - start) * 1000))
+                self.cache[path] = html
+            return self.cache[path]
+
+    def find_static_file(self, path):
+        candidates = []
+        for prefix, folder in self.static_dirs.items():
+            prefix = "/" + prefix.strip("/") + "/"
+            if path.startswith(prefix):
+                candidates.append( (folder, path[len(prefix):]) )
+        if self.fallback_dir:
+            candidates.append( (self.fallback_dir, path.lstrip("/")) )
+        for folder, relpath in candidates:
+            folder = os.path.abspath(folder)
+            filepath = os.path.abspath(os.path.join(folder, relpath))
+            # Don't serve anything outside the folder
+            if os.path.commonpath([folder, filepath]) != folder:
+                continue
+            if os.path.isfile(filepath):
+                return filepath
+        return None
+
+    def invalidate(self, paths=None):
+        """Forget the rendered pages at these URL paths (or all of them, if
+        paths is None), so they're rendered again when next requested."""
+        with self.render_lock:
+            if paths is None:
+                self.cache = {}
+            else:
+                for path in paths:
+                    self.cache.pop(path, None)
+
+    def reload(self):
+        with self.changed:
+            self.version += 1
+            self.changed.notify_all()
+
+    def wait_for_change(self, version, timeout):
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version or self.stopping,
+                                  timeout)
+            return self.version
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        print("Serving at %s (Ctrl-C to stop)" % self.url)
+
+    def shutdown(self):
+        with self.changed:
+            self.stopping = True
+            self.changed.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,369 @@
+################################################################################
+# Dactyl ElasticSearch uploads
+#
+# Sends documents to ElasticSearch in batches using the _bulk API, and
+# publishes whole indexes behind an alias
+################################################################################
+from dactyl.common import *
+
+import hashlib
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+TIMEOUT_SECS = 60
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class ESBulkUploader:
+    """
+    Collects documents into NDJSON batches and sends each batch to the _bulk
+    endpoint of an ElasticSearch instance, several batches at a time, over
+    one keep-alive session. Batches (or the documents in them) that fail with
+    a 429 or 5xx status are retried with exponential backoff.
+
+    Failures are reported with recoverable_error() from whichever thread
+    calls add() or close(), so they can exit the build like before.
+    """
+    def __init__(self, es_base, doc_type="article", max_docs=500,
+                 max_bytes=5*1024*1024, concurrency=4, max_retries=5,
+                 backoff=1.0, bypass_errors=False):
+        self.bulk_url = es_base + "/_bulk"
+        self.doc_type = doc_type
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.bypass_errors = bypass_errors
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+        self.batch = []
+        self.batch_bytes = 0
+        self.in_flight = []
+        self.num_uploaded = 0
+        self.num_failed = 0
+        self.failed_ids = set()
+        self.lock = threading.Lock()
+
+    def add(self, es_json, es_index, id):
+        """Queue a document (a JSON string) for upload."""
+        # Each document has to be on one line in the bulk format
+        doc = json.dumps(json.loads(es_json), separators=(',', ':'))
+        self.queue(id, self.action_line("index", es_index, id) + doc + "\n")
+
+    def delete(self, es_index, id):
+        """Queue the deletion of a document."""
+        self.queue(id, self.action_line("delete", es_index, id))
+
+    def action_line(self, action, es_index, id):
+        metadata = {"_index": es_index.lower(), # ES index names must be lowercase
+                    "_id": id}
+        if self.doc_type:
+            metadata["_type"] = self.doc_type
+        return json.dumps({action: metadata}) + "\n"
+
+    def queue(self, id, entry):
+        entry = entry.encode("utf-8")
+        if self.batch and self.batch_bytes + len(entry) > self.max_bytes:
+            self.flush()
+        self.batch.append( (id, entry) )
+        self.batch_bytes += len(entry)
+        if len(self.batch) >= self.max_docs:
+            self.flush()
+
+    def flush(self):
+        """Start sending the current batch. Blocks if too many batches are
+        already in flight."""
+        if not self.batch:
+            return
+        batch = self.batch
+        self.batch = []
+        self.batch_bytes = 0
+        while len(self.in_flight) >= self.concurrency * 2:
+            self.report(self.in_flight.pop(0).result())
+        self.in_flight.append(self.executor.submit(self.send_batch, batch))
+
+    def close(self):
+        """Send everything that's left and wait for it to finish."""
+        self.flush()
+        while self.in_flight:
+            self.report(self.in_flight.pop(0).result())
+        self.executor.shutdown()
+        self.session.close()
+        logger.info("ES upload finished: %d documents uploaded, %d failed" %
+                    (self.num_uploaded, self.num_failed))
+
+    def report(self, failures):
+        for id, msg in failures:
+            self.failed_ids.add(id)
+        for id, msg in failures:
+            recoverable_error("ES upload of %s failed with error: '%s'" %
+                    (id, msg), self.bypass_errors)
+
+    def send_batch(self, batch):
+        """Send a batch of (id, entry) pairs, retrying as necessary. Runs in a
+        worker thread. Returns a list of (id, error message) failures."""
+        failures = []
+        attempt = 0
+        while batch:
+            body = b"".join(entry for id, entry in batch)
+            logger.info("Uploading %d documents to ES: POST %s" %
+                        (len(batch), self.bulk_url))
+            retry = []
+            try:
+                r = self.session.post(self.bulk_url, data=body,
+                        headers={"Content-Type": "application/x-ndjson"},
+                        timeout=TIMEOUT_SECS)
+            except requests.RequestException as e:
+                retry = batch
+                error_msg = repr(e)
+            else:
+                if r.status_code in RETRY_STATUSES:
+                    retry = batch
+                    error_msg = "HTTP %d: %s" % (r.status_code, r.text)
+                elif r.status_code >= 400:
+                    failures += [(id, r.text) for id, entry in batch]
+                else:
+                    try:
+                        items = r.json()["items"]
+                    except (ValueError, KeyError) as e:
+                        failures += [(id, "Unexpected response: %s" % r.text)
+                                     for id, entry in batch]
+                        items = []
+                    else:
+                        if len(items) != len(batch):
+                            # Results can't be matched up with documents, so
+                            # none of them count as uploaded
+                            failures += [(id, ("Unexpected response: %d results "+
+                                    "for %d documents") % (len(items), len(batch)))
+                                    for id, entry in batch]
+                            items = []
+                    for (id, entry), item in zip(batch, items):
+                        action, result = next(iter(item.items()))
+                        status = result.get("status", 200)
+                        if action == "delete" and status == 404:
+                            # Already gone, which is fine
+                            status = 200
+                        if status in RETRY_STATUSES:
+                            retry.append( (id, entry) )
+                            error_msg = json.dumps(result.get("error", status))
+                        elif status >= 400:
+                            failures.append( (id, json.dumps(result.get("error", status))) )
+                        else:
+                            with self.lock:
+                                self.num_uploaded += 1
+
+            if retry and attempt < self.max_retries:
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                logger.warning("Retrying %d ES documents in %.1fs (%s)" %
+                               (len(retry), delay, error_msg))
+                time.sleep(delay)
+                attempt += 1
+            else:
+                failures += [(id, error_msg) for id, entry in retry]
+                retry = []
+            batch = retry
+
+        with self.lock:
+            self.num_failed += len(failures)
+        return failures
+
+
+ES_MANIFEST_FILENAME = ".dactyl_es_manifest.json"
+ES_MANIFEST_VERSION = 1
+
+class ESPublishError(Exception):
+    pass
+
+class ESIndexPublisher:
+    """
+    Publishes a target's documents behind an alias, without touching the index
+    that's live while the new one is being built:
+
+    1. Creates a new index named after the alias plus a timestamp.
+    2. If the live index is the one recorded in the ES manifest (in the output
+       folder), copies it into the new index with _reindex and only uploads
+       documents whose JSON changed since then. Otherwise, uploads everything.
+    3. Deletes documents for pages that no longer exist.
+    4. Points the alias at the new index in one _aliases call, then deletes the
+       old index. If any of the target's documents didn't make it into the new
+       index, it's deleted instead and the live index is left alone.
+
+    Takes the same options as ESBulkUploader.
+    """
+    def __init__(self, es_base, alias, manifest_dir, **kwargs):
+        self.es_base = es_base
+        self.alias = alias.lower()
+        self.manifest_path = os.path.join(manifest_dir, ES_MANIFEST_FILENAME)
+        self.uploader = ESBulkUploader(es_base, **kwargs)
+        self.session = self.uploader.session
+
+        self.old_indexes, self.old_is_index = self.find_live_indexes()
+        now = time.time()
+        self.index = "%s-%s%03d" % (self.alias,
+                time.strftime("%Y%m%d%H%M%S", time.gmtime(now)),
+                int(now * 1000) % 1000)
+        logger.info("Publishing ES alias %s: creating index %s" %
+                    (self.alias, self.index))
+        self.es_request("PUT", "/"+self.index)
+
+        saved = self.load_manifest()
+        self.doc_hashes = {}
+        self.reused = False
+        if (saved and not self.old_is_index and
+                self.old_indexes == [saved["index"]]):
+            try:
+                self.reindex(saved["index"])
+                self.doc_hashes = saved["docs"]
+                self.reused = True
+            except ESPublishError as e:
+                logger.warning("Couldn't reuse index %s; uploading all documents (%s)" %
+                               (saved["index"], e))
+        else:
+            logger.info("No ES manifest for the live index; uploading all documents")
+        self.uploaded = {}
+        self.num_skipped = 0
+        self.discarded = False
+
+    def es_request(self, method, path, data=None, ok_statuses=()):
+        try:
+            r = self.session.request(method, self.es_base + path, json=data,
+                                     timeout=TIMEOUT_SECS)
+        except requests.RequestException as e:
+            raise ESPublishError("%s %s failed: %s" % (method, path, repr(e)))
+        if r.status_code >= 400 and r.status_code not in ok_statuses:
+            raise ESPublishError("%s %s failed with error: '%s'" %
+                                 (method, path, r.text))
+        return r
+
+    def find_live_indexes(self):
+        """Returns (indexes, is_index): the indexes the alias points to, and
+        whether the alias name is actually a plain index (as left by uploads
+        that didn't use an alias)."""
+        r = self.es_request("GET", "/_alias/"+self.alias, ok_statuses=(404,))
+        if r.status_code != 404:
+            return sorted(r.json().keys()), False
+        r = self.es_request("HEAD", "/"+self.alias, ok_statuses=(404,))
+        if r.status_code != 404:
+            return [self.alias], True
+        return [], False
+
+    def reindex(self, old_index):
+        logger.info("Copying documents from %s to %s" % (old_index, self.index))
+        r = self.es_request("POST", "/_reindex?wait_for_completion=true", {
+            "source": {"index": old_index},
+            "dest": {"index": self.index},
+        })
+        failures = r.json().get("failures")
+        if failures:
+            raise ESPublishError("reindex failures: %s" % json.dumps(failures))
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved.get("version") == ES_MANIFEST_VERSION:
+                return saved["aliases"].get(self.alias)
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable ES manifest %s: %s" %
+                           (self.manifest_path, repr(e)))
+        return None
+
+    def save_manifest(self):
+        aliases = {}
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved.get("version") == ES_MANIFEST_VERSION:
+                aliases = saved["aliases"]
+        except (OSError, ValueError, KeyError):
+            pass
+        aliases[self.alias] = {"index": self.index, "docs": self.doc_hashes}
+        manifest_dir = os.path.dirname(self.manifest_path)
+        if manifest_dir and not os.path.isdir(manifest_dir):
+            os.makedirs(manifest_dir)
+        with open(self.manifest_path, "w", encoding="utf-8") as f:
+            json.dump({"version": ES_MANIFEST_VERSION, "aliases": aliases},
+                      f, indent=1, sort_keys=True)
+
+    def add(self, es_json, es_index, id):
+        """Queue a document for upload to the new index if it changed. es_index
+        is ignored, since documents always go in the new index."""
+        doc = json.loads(es_json)
+        doc_hash = hashlib.sha256(json.dumps(doc, sort_keys=True).encode("utf-8")).hexdigest()
+        if self.doc_hashes.get(id) == doc_hash:
+            logger.debug("ES document %s is unchanged" % id)
+            self.num_skipped += 1
+            return
+        self.uploader.add(es_json, self.index, id)
+        self.uploaded[id] = doc_hash
+
+    def close(self, doc_ids):
+        """Finish uploading, delete documents whose ids aren't in doc_ids, and
+        switch the alias to the new index. Raises ESPublishError (and deletes
+        the new index) if any of doc_ids aren't in the new index."""
+        doc_ids = set(doc_ids)
+        # Documents copied from the live index; empty unless it was reused
+        copied_ids = set(self.doc_hashes.keys())
+        for id in sorted(set(self.doc_hashes.keys()) - doc_ids):
+            logger.info("Deleting stale ES document %s" % id)
+            self.uploader.delete(self.index, id)
+            del self.doc_hashes[id]
+        try:
+            self.uploader.close()
+        except SystemExit:
+            self.discard()
+            raise
+        logger.info("%d ES documents unchanged" % self.num_skipped)
+
+        uploaded_ids = set(self.uploaded.keys()) - set(self.uploader.failed_ids)
+        missing = sorted(doc_ids - copied_ids - uploaded_ids)
+        if missing:
+            self.discard()
+            raise ESPublishError(("%d of %d documents aren't in the new index " +
+                    "(%s); not publishing it") % (len(missing), len(doc_ids),
+                    ", ".join(missing[:5]) + (", ..." if len(missing) > 5 else "")))
+
+        for id, doc_hash in self.uploaded.items():
+            if id in self.uploader.failed_ids:
+                # The new index has the old version, if any; retry next time
+                self.doc_hashes.pop(id, None)
+            else:
+                self.doc_hashes[id] = doc_hash
+
+        self.es_request("POST", "/%s/_refresh" % self.index)
+        actions = [{"add": {"index": self.index, "alias": self.alias}}]
+        if self.old_is_index:
+            actions.insert(0, {"remove_index": {"index": self.alias}})
+        else:
+            actions = [{"remove": {"index": old, "alias": self.alias}}
+                       for old in self.old_indexes] + actions
+        logger.info("Pointing ES alias %s at %s" % (self.alias, self.index))
+        self.es_request("POST", "/_aliases", {"actions": actions})
+        self.save_manifest()
+
+        if not self.old_is_index:
+            for old in self.old_indexes:
+                logger.info("Deleting old ES index %s" % old)
+                self.es_request("DELETE", "/"+old, ok_statuses=(404,))
+
+    def discard(self):
+        """Delete the new index without publishing it."""
+        if self.discarded:
+            return
+        self.discarded = True
+        logger.warning("Deleting unpublished ES index %s" % self.index)
+        try:
+            self.es_request("DELETE", "/"+self.index, ok_statuses=(404,))
+        except ESPublishError as e:
+            logger.warning(str(e))
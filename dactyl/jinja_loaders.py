@@ -1,7 +1,8 @@
 import requests
 from jinja2 import BaseLoader, FileSystemLoader, TemplateNotFound, Template
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlunparse
 from dactyl.common import *
+from dactyl import remote_fetch
 
 class FrontMatterRemoteLoader(BaseLoader):
     def __init__(self):
@@ -28,17 +29,19 @@ class FrontMatterRemoteLoader(BaseLoader):
         # template trying to import another template, so let's assume it's from the
         # base path of the imported template
         if not parsed_url.scheme:
-            url = os.path.join(self.baseurl, template)
+            url = os.path.join(urlunparse(self.baseurl), template)
         else:
             url = template
 
-        response = requests.get(url)
-        if response.status_code == 200:
-            text, frontmatter = parse_frontmatter(response.text)
-            self.fm_map[template] = frontmatter
-            return text, url, None
-        else:
+        fetcher = remote_fetch.get_fetcher()
+        try:
+            source = fetcher.fetch(url)
+        except requests.RequestException as e:
+            logger.debug("Couldn't fetch remote template %s: %s" % (url, repr(e)))
             raise TemplateNotFound(template)
+        text, frontmatter = parse_frontmatter(source)
+        self.fm_map[template] = frontmatter
+        return text, url, fetcher.uptodate(url, source)
 
 class FrontMatterFSLoader(FileSystemLoader):
     def __init__(self, searchpath, encoding='utf-8', followlinks=False):
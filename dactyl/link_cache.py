@@ -0,0 +1,195 @@
+################################################################################
+# Dactyl link cache
+#
+# Remembers the results of remote link checks between runs of the link
+# checker, so URLs that were checked recently don't have to be re-fetched,
+# and (for incremental checks) the links found in each page, so pages that
+# haven't changed don't have to be parsed or re-checked.
+################################################################################
+from dactyl.common import *
+from dactyl.manifest import hash_file
+
+import threading
+
+LINK_REPORT_FILENAME = ".dactyl_link_report.json"
+LINK_REPORT_VERSION = 1
+
+class LinkCache:
+    """Results of remote link checks, saved as JSON lines (one object per URL)
+    with the status code, final URL, ETag/Last-Modified headers, and the time
+    the URL was checked.
+
+    A result is fresh for ok_ttl seconds if the URL worked, or broken_ttl
+    seconds if it didn't. max_age, if provided, replaces both."""
+    def __init__(self, path, ok_ttl=86400, broken_ttl=3600, max_age=None):
+        self.path = path
+        if max_age is not None:
+            ok_ttl = max_age
+            broken_ttl = max_age
+        self.ok_ttl = ok_ttl
+        self.broken_ttl = broken_ttl
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry["url"]] = entry
+                    except (ValueError, KeyError):
+                        logger.debug("Skipping bad line in link cache: %s" % line)
+            logger.info("Loaded %d cached link results from %s" %
+                        (len(self.entries), path))
+        except FileNotFoundError:
+            logger.debug("No link cache at %s" % path)
+        except OSError as e:
+            logger.warning("Couldn't read link cache %s: %s" % (path, repr(e)))
+
+    def get(self, url):
+        """Returns the cached entry for url, fresh or not, or None."""
+        with self.lock:
+            return self.entries.get(url)
+
+    def is_fresh(self, entry):
+        if 200 <= entry["status"] < 400:
+            ttl = self.ok_ttl
+        else:
+            ttl = self.broken_ttl
+        return time.time() - entry["checked"] < ttl
+
+    def lookup(self, url):
+        """Returns the cached status code for url if there's a fresh one, or
+        None."""
+        entry = self.get(url)
+        with self.lock:
+            if entry and self.is_fresh(entry):
+                self.hits += 1
+                return entry["status"]
+            self.misses += 1
+            return None
+
+    def conditional_headers(self, url):
+        """Headers to ask the server whether a URL that worked last time has
+        changed since."""
+        entry = self.get(url)
+        headers = {}
+        if entry and 200 <= entry["status"] < 400:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def update(self, url, status, response=None):
+        """Records the result of checking url. A 304 response means the
+        previous result still stands."""
+        with self.lock:
+            old = self.entries.get(url)
+            if status == 304 and old:
+                old["checked"] = time.time()
+                return old["status"]
+            entry = {"url": url, "status": status, "checked": time.time()}
+            if response is not None:
+                entry["final_url"] = response.headers.get("Location", response.url)
+                entry["etag"] = response.headers.get("ETag")
+                entry["last_modified"] = response.headers.get("Last-Modified")
+            self.entries[url] = entry
+            return status
+
+    def save(self):
+        """Write the cache to disk. Failing to do so only means the next run
+        has to check more links, so it's logged instead of raised."""
+        # Other runs might be saving the same cache at the same time
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            cache_dir = os.path.dirname(self.path)
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for url in sorted(self.entries.keys()):
+                    f.write(json.dumps(self.entries[url]) + "\n")
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning("Couldn't save link cache to %s: %s" %
+                           (self.path, repr(e)))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        logger.info("Saved %d link results to %s" % (len(self.entries), self.path))
+
+
+class LinkReport:
+    """The pages checked by the last incremental link check, saved as JSON in
+    the output folder. For each page (by path relative to out_path), records
+    the file's size, mtime, and hash when it was checked, plus the links,
+    anchors, and unparsed reference links found in it. The results of remote
+    links aren't saved here: those come from the LinkCache, so they expire
+    the same way whether or not the page changed."""
+    def __init__(self, out_path):
+        self.out_path = out_path
+        self.path = os.path.join(out_path, LINK_REPORT_FILENAME)
+        self.pages = {}
+        self.new_pages = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved.get("version") == LINK_REPORT_VERSION:
+                self.pages = saved["pages"]
+            else:
+                logger.info("Link report is from another version; ignoring it")
+        except FileNotFoundError:
+            logger.debug("No previous link report at %s" % self.path)
+        except (ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable link report %s: %s" %
+                           (self.path, repr(e)))
+
+    def saved_page(self, fullPath):
+        """Returns what was saved about a page if it hasn't changed since the
+        last check, or None. A page whose mtime changed but whose contents
+        didn't (for example, because it was rebuilt from scratch) still
+        counts as unchanged."""
+        entry = self.pages.get(os.path.relpath(fullPath, self.out_path))
+        if not entry:
+            return None
+        try:
+            st = os.stat(fullPath)
+        except OSError:
+            return None
+        if st.st_size != entry["size"]:
+            return None
+        if st.st_mtime != entry["mtime"] and hash_file(fullPath) != entry["hash"]:
+            return None
+        return entry
+
+    def add_page(self, fullPath, links, anchors, unparsed_reflinks, saved=None):
+        """Record a page checked in this run. If the page was unchanged,
+        saved is its entry from the last report."""
+        relPath = os.path.relpath(fullPath, self.out_path)
+        if saved:
+            # Same contents as before; only the mtime might be different
+            entry = saved
+        else:
+            entry = {
+                "links": links,
+                "anchors": sorted(anchors),
+                "unparsed_reflinks": unparsed_reflinks,
+                "hash": hash_file(fullPath),
+            }
+        st = os.stat(fullPath)
+        entry["size"] = st.st_size
+        entry["mtime"] = st.st_mtime
+        self.new_pages[relPath] = entry
+
+    def save(self):
+        """Save the pages recorded in this run, replacing the last report.
+        Pages that no longer exist are dropped."""
+        # Other runs might be checking the same output folder
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": LINK_REPORT_VERSION, "pages": self.new_pages},
+                      f, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        logger.info("Saved link report for %d pages to %s" %
+                    (len(self.new_pages), self.path))
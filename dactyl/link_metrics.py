@@ -0,0 +1,145 @@
+################################################################################
+# Dactyl link checker metrics
+#
+# Counts how fast the link checker is going and where it's spending its time
+# (pages parsed, remote URLs in flight, how long each host takes to respond,
+# and how often the link cache helps), so slow hosts can be found and the
+# concurrency settings tuned.
+################################################################################
+from dactyl.common import *
+
+import threading
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+def bucket_label(bound):
+    if bound is None:
+        return "+inf"
+    return "%gms" % (bound * 1000)
+
+class HostLatency:
+    """Histogram of one host's response times."""
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.requests = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, secs):
+        i = 0
+        while i < len(LATENCY_BUCKETS) and secs > LATENCY_BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.requests += 1
+        self.total += secs
+        self.max = max(self.max, secs)
+
+    def to_json(self):
+        bounds = LATENCY_BUCKETS + [None]
+        return {
+            "requests": self.requests,
+            "mean_ms": round(self.total * 1000 / self.requests, 1),
+            "max_ms": round(self.max * 1000, 1),
+            "histogram": {bucket_label(b): c for b, c in zip(bounds, self.counts)},
+        }
+
+
+class LinkCheckMetrics:
+    """Progress counters for one run of the link checker. If path is provided,
+    a snapshot is written there as a JSON line every interval seconds (from a
+    background thread), and a summary line at the end."""
+    def __init__(self, pages_total=0, cache=None, path=None, interval=10):
+        self.start_time = time.time()
+        self.pages_total = pages_total
+        self.pages_parsed = 0
+        self.cache = cache
+        self.urls_queued = 0
+        self.urls_done = 0
+        self.requests_active = 0
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.out = None
+        self.stopped = threading.Event()
+        self.thread = None
+        if path:
+            self.out = open(path, "w", encoding="utf-8")
+            self.interval = interval
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def page_parsed(self):
+        with self.lock:
+            self.pages_parsed += 1
+
+    def url_queued(self):
+        with self.lock:
+            self.urls_queued += 1
+
+    def url_done(self):
+        with self.lock:
+            self.urls_done += 1
+
+    def request_started(self):
+        with self.lock:
+            self.requests_active += 1
+
+    def request_done(self, host, secs):
+        with self.lock:
+            self.requests_active -= 1
+            if host not in self.hosts:
+                self.hosts[host] = HostLatency()
+            self.hosts[host].add(secs)
+
+    def snapshot(self, event="progress"):
+        with self.lock:
+            elapsed = time.time() - self.start_time
+            snap = {
+                "event": event,
+                "time": round(time.time(), 3),
+                "elapsed": round(elapsed, 3),
+                "pages_parsed": self.pages_parsed,
+                "pages_total": self.pages_total,
+                "pages_per_sec": round(self.pages_parsed / elapsed, 1) if elapsed else 0,
+                "urls_queued": self.urls_queued,
+                "urls_in_flight": self.urls_queued - self.urls_done,
+                "requests_active": self.requests_active,
+                "hosts": {host: latency.to_json() for host, latency
+                          in sorted(self.hosts.items())},
+            }
+        if self.cache:
+            lookups = self.cache.hits + self.cache.misses
+            snap["cache_hits"] = self.cache.hits
+            snap["cache_misses"] = self.cache.misses
+            snap["cache_hit_rate"] = round(self.cache.hits / lookups, 3) if lookups else None
+        return snap
+
+    def write(self, snap):
+        self.out.write(json.dumps(snap, sort_keys=True) + "\n")
+        self.out.flush()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write(self.snapshot())
+
+    def close(self):
+        """Stop writing progress, then write and log the summary."""
+        summary = self.snapshot("summary")
+        if self.thread:
+            self.stopped.set()
+            self.thread.join()
+            self.write(summary)
+            self.out.close()
+
+        logger.info("Parsed %d pages in %.1fs (%.1f pages/sec); checked %d remote URLs" %
+                    (summary["pages_parsed"], summary["elapsed"],
+                     summary["pages_per_sec"], summary["urls_queued"]))
+        if summary.get("cache_hit_rate") is not None:
+            logger.info("Link cache hit rate: %.0f%%" % (summary["cache_hit_rate"] * 100))
+        slowest = sorted(summary["hosts"].items(),
+                         key=lambda item: item[1]["mean_ms"], reverse=True)
+        for host, latency in slowest[:5]:
+            logger.info("Host %s: %d requests, mean %.0fms, max %.0fms" %
+                        (host, latency["requests"], latency["mean_ms"],
+                         latency["max_ms"]))
+        return summary
@@ -0,0 +1,130 @@
+################################################################################
+# Dactyl build manifest
+#
+# Records what went into each output file so that later builds can skip
+# pages whose inputs haven't changed.
+################################################################################
+from dactyl.common import *
+
+import hashlib
+import jinja2
+import jinja2.meta
+
+MANIFEST_FILENAME = ".dactyl_manifest.json"
+MANIFEST_VERSION = 1
+
+def _json_fallback(o):
+    # Functions (like OpenAPI __md_generator fields) don't have a stable
+    # representation from one run to the next, so leave them out
+    if callable(o):
+        return "<callable>"
+    return str(o)
+
+def hash_value(value):
+    """Hash a JSON-like value (dicts, lists, strings, numbers)."""
+    s = json.dumps(value, sort_keys=True, default=_json_fallback)
+    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+def hash_file(path):
+    """Hash a file's contents. Returns None if the file can't be read."""
+    h = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                h.update(chunk)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+
+def template_dependencies(env, name):
+    """Find the files a Jinja template is made from: the template itself plus
+    everything it extends, includes, or imports, recursively. Returns a
+    (filenames, complete) tuple. complete is False if some references can't
+    be resolved without rendering, such as {% include some_variable %}."""
+    filenames = set()
+    complete = True
+    seen = set()
+    to_visit = [name]
+    while to_visit:
+        tname = to_visit.pop()
+        if tname in seen:
+            continue
+        seen.add(tname)
+        try:
+            source, filename, uptodate = env.loader.get_source(env, tname)
+            refs = jinja2.meta.find_referenced_templates(env.parse(source))
+        except (jinja2.exceptions.TemplateNotFound,
+                jinja2.exceptions.TemplateSyntaxError) as e:
+            logger.debug("Can't follow template dependency %s: %s" % (tname, repr(e)))
+            complete = False
+            continue
+        if filename:
+            filenames.add(filename)
+        else:
+            complete = False
+        for ref in refs:
+            if ref is None:
+                complete = False
+            else:
+                to_visit.append(ref)
+    return filenames, complete
+
+
+class BuildManifest:
+    """Input hashes for each file written to an output folder, saved as JSON
+    in that folder."""
+    def __init__(self, out_path):
+        self.out_path = out_path
+        self.path = os.path.join(out_path, MANIFEST_FILENAME)
+        self.file_hashes = {} # Hash each input at most once per build
+        self.outputs = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved.get("version") == MANIFEST_VERSION:
+                self.outputs = saved["outputs"]
+            else:
+                logger.info("Build manifest is from another version; ignoring it")
+        except FileNotFoundError:
+            logger.debug("No build manifest at %s" % self.path)
+        except (ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable build manifest %s: %s" %
+                           (self.path, repr(e)))
+
+    def file_hash(self, path):
+        if path not in self.file_hashes:
+            self.file_hashes[path] = hash_file(path)
+        return self.file_hashes[path]
+
+    def is_fresh(self, filepath, fingerprint):
+        """Report whether filepath was written by a previous build with the same
+        fingerprint from inputs that haven't changed since."""
+        entry = self.outputs.get(filepath)
+        if not entry or entry["fingerprint"] != fingerprint:
+            return False
+        if not os.path.isfile(os.path.join(self.out_path, filepath)):
+            return False
+        for input_path, input_hash in entry["inputs"].items():
+            if self.file_hash(input_path) != input_hash:
+                logger.debug("%s changed since last build" % input_path)
+                return False
+        return True
+
+    def record(self, filepath, fingerprint, input_paths):
+        """Save the inputs of an output file that was just written."""
+        self.outputs[filepath] = {
+            "fingerprint": fingerprint,
+            "inputs": {p: self.file_hash(p) for p in sorted(input_paths)},
+        }
+
+    def forget(self, filepath):
+        """Make sure the next build rebuilds filepath."""
+        self.outputs.pop(filepath, None)
+
+    def save(self):
+        if not os.path.isdir(self.out_path):
+            os.makedirs(self.out_path)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "outputs": self.outputs},
+                      f, indent=1, sort_keys=True)
@@ -12,6 +12,7 @@ from ruamel.yaml.comments import CommentedMap as YamlMap
 from ruamel.yaml.comments import CommentedSeq as YamlSeq
 
 from dactyl.common import *
+from dactyl import remote_fetch
 from dactyl.http_constants import HTTP_METHODS, HTTP_STATUS_CODES, HTTP_METHODS_WITH_REQ_BODIES
 
 DATA_TYPES_SUFFIX = "-data-types"
@@ -49,11 +50,7 @@ class ApiDef:
         logger.debug("Reading OpenAPI definition from %s"%spec_path)
 
         if spec_path[:5] == "http:" or spec_path[:6] == "https:":
-            response = requests.get(spec_path)
-            if response.status_code == 200:
-                self.swag = yaml.load(response.text)
-            else:
-                raise requests.RequestException("Status code for page was not 200")
+            self.swag = yaml.load(remote_fetch.fetch(spec_path))
         else:
             with open(spec_path, "r", encoding="utf-8") as f:
                 self.swag = yaml.load(f)
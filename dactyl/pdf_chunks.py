@@ -0,0 +1,204 @@
+################################################################################
+# Dactyl chunked PDFs
+#
+# Makes a big PDF faster by splitting its pages into chunks, running several
+# Prince processes at once (Prince itself only uses one core), and merging the
+# results. Each chunk's page numbers continue from the previous chunk's, and
+# each chunk's bookmarks are kept. Chunks whose HTML and static files haven't
+# changed since the last build are reused. Merging needs the pypdf package.
+################################################################################
+from dactyl.common import *
+
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from dactyl.manifest import hash_file, hash_value
+from dactyl.static_sync import STATIC_MANIFEST_FILENAME
+
+CHUNKS_FILENAME = ".dactyl_pdf_chunks.json"
+CHUNKS_VERSION = 1
+CHUNKS_FOLDER = "pdf-chunks"
+# Changing where a chunk's page numbers start can change how many pages it has
+# (for example, with page breaks to a right-hand page), so it might take more
+# than one extra pass to get every chunk's numbering right
+MAX_PASSES = 3
+
+def chunk_pages(pages, by="category", size=50):
+    """Split a list of pages into chunks, keeping them in order. By "category",
+    each run of consecutive pages with the same category is a chunk. By
+    "pages", each chunk has up to size pages."""
+    if by == "category":
+        chunks = []
+        for page in pages:
+            if chunks and chunks[-1][-1].get("category") == page.get("category"):
+                chunks[-1].append(page)
+            else:
+                chunks.append([page])
+        return chunks
+    elif by == "pages":
+        size = max(1, int(size))
+        return [pages[i:i+size] for i in range(0, len(pages), size)]
+    exit("Unknown pdf_chunk_by value '%s'; use 'category' or 'pages'" % by)
+
+
+def first_page_numbers(page_counts):
+    """Where each chunk's page numbers start, given how many pages each chunk
+    has."""
+    numbers = []
+    next_page = 1
+    for count in page_counts:
+        numbers.append(next_page)
+        next_page += count
+    return numbers
+
+
+def load_pypdf():
+    try:
+        import pypdf
+    except ImportError:
+        exit("Chunked PDFs need the pypdf package. Install it with 'pip install pypdf'.")
+    return pypdf
+
+
+def pdf_page_count(path):
+    pypdf = load_pypdf()
+    return len(pypdf.PdfReader(path).pages)
+
+
+def merge_pdfs(paths, outfile):
+    """Concatenate PDFs into outfile, keeping each one's bookmarks."""
+    pypdf = load_pypdf()
+    writer = pypdf.PdfWriter()
+    for path in paths:
+        writer.append(path, import_outline=True)
+    tmp_path = "%s.%d.tmp" % (outfile, os.getpid())
+    with open(tmp_path, "wb") as f:
+        writer.write(f)
+    os.replace(tmp_path, outfile)
+
+
+class ChunkedPdf:
+    """Makes one PDF from chunks of HTML files in staging_dir (each chunk is a
+    list of paths relative to staging_dir). prince_args is the Prince command
+    to run, without the output or input files. Runs up to jobs copies of
+    Prince at a time."""
+    def __init__(self, chunks, staging_dir, prince_args, jobs=4):
+        self.chunks = chunks
+        self.staging_dir = staging_dir
+        self.prince_args = prince_args
+        self.jobs = max(1, jobs)
+        self.chunk_dir = os.path.join(staging_dir, CHUNKS_FOLDER)
+        self.keys = [hash_value(files)[:16] for files in chunks]
+        self.path = os.path.join(staging_dir, CHUNKS_FILENAME)
+        self.saved = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved.get("version") == CHUNKS_VERSION:
+                self.saved = saved["chunks"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable PDF chunk list %s: %s" %
+                           (self.path, repr(e)))
+        self.entries = {}
+        self.prince_runs = 0
+        # Static files can change a chunk's PDF even if its HTML didn't
+        self.static_hash = hash_file(os.path.join(staging_dir,
+                                                  STATIC_MANIFEST_FILENAME))
+
+    def chunk_pdf(self, i):
+        return os.path.join(self.chunk_dir, "chunk-%s.pdf" % self.keys[i])
+
+    def fingerprint(self, i, first_page):
+        return hash_value({
+            "files": {f: hash_file(os.path.join(self.staging_dir, f))
+                      for f in self.chunks[i]},
+            "first_page": first_page,
+            "prince_args": self.prince_args,
+            "static": self.static_hash,
+        })
+
+    def render_chunk(self, i, first_page):
+        """Make chunk i's PDF with page numbers starting at first_page, unless
+        it's unchanged since the last build. Returns its number of pages."""
+        key = self.keys[i]
+        pdf_path = self.chunk_pdf(i)
+        fingerprint = self.fingerprint(i, first_page)
+        saved = self.saved.get(key)
+        if saved and saved["fingerprint"] == fingerprint and os.path.isfile(pdf_path):
+            logger.debug("PDF chunk %d is unchanged" % (i+1))
+            self.entries[key] = saved
+            return saved["pages"]
+
+        style_path = os.path.join(self.chunk_dir, "chunk-%s.css" % key)
+        with open(style_path, "w", encoding="utf-8") as f:
+            f.write(":root { counter-reset: page %d; }\n" % first_page)
+        args = self.prince_args + ["--style=%s" % style_path, "-o", pdf_path]
+        args += self.chunks[i]
+        logger.info("generating PDF chunk %d of %d: running %s..." %
+                    (i+1, len(self.chunks), " ".join(args)))
+        self.prince_runs += 1
+        prince_resp = subprocess.check_output(args, universal_newlines=True,
+                                              cwd=self.staging_dir)
+        if prince_resp:
+            print(prince_resp)
+        pages = pdf_page_count(pdf_path)
+        self.entries[key] = {"fingerprint": fingerprint, "pages": pages}
+        return pages
+
+    def guess_page_counts(self):
+        """Guess how many pages each chunk has, to choose where their page
+        numbers start: the same as last time, or for a chunk that's new, from
+        the average number of pages per HTML file in the other chunks."""
+        known_pages = 0
+        known_files = 0
+        for files, key in zip(self.chunks, self.keys):
+            if key in self.saved:
+                known_pages += self.saved[key]["pages"]
+                known_files += len(files)
+        pages_per_file = known_pages / known_files if known_files else 1
+        return [self.saved[key]["pages"] if key in self.saved else
+                max(1, round(pages_per_file * len(files)))
+                for files, key in zip(self.chunks, self.keys)]
+
+    def render_chunks(self, indexes, first_pages, page_counts):
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            counts = executor.map(lambda i: self.render_chunk(i, first_pages[i]),
+                                  indexes)
+            for i, count in zip(indexes, counts):
+                page_counts[i] = count
+
+    def make(self, outfile):
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        first_pages = first_page_numbers(self.guess_page_counts())
+        page_counts = [None] * len(self.chunks)
+        to_render = list(range(len(self.chunks)))
+        for attempt in range(MAX_PASSES):
+            self.render_chunks(to_render, first_pages, page_counts)
+            correct_first_pages = first_page_numbers(page_counts)
+            to_render = [i for i in range(len(self.chunks))
+                         if first_pages[i] != correct_first_pages[i]]
+            first_pages = correct_first_pages
+            if not to_render:
+                break
+            logger.info("Page numbers changed; re-rendering %d PDF chunks" %
+                        len(to_render))
+        else:
+            logger.warning("Page numbers in %s may be off: chunk lengths kept changing" %
+                           outfile)
+
+        logger.info("merging %d PDF chunks (%d pages) into %s" %
+                    (len(self.chunks), sum(page_counts), outfile))
+        merge_pdfs([self.chunk_pdf(i) for i in range(len(self.chunks))], outfile)
+        self.save()
+
+    def save(self):
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({"version": CHUNKS_VERSION, "chunks": self.entries},
+                      f, indent=1, sort_keys=True)
+        # Remove chunks that aren't part of the PDF anymore
+        keep = set(self.keys)
+        for filename in os.listdir(self.chunk_dir):
+            if filename.split("-", 1)[-1].split(".")[0] not in keep:
+                os.remove(os.path.join(self.chunk_dir, filename))
@@ -0,0 +1,191 @@
+################################################################################
+# Dactyl remote fetch
+#
+# Downloads remote files that a build reads (Markdown pages, templates, and
+# OpenAPI specs) over one keep-alive session. Each URL is downloaded at most
+# once per build. With a cache folder, the last copy of each URL is saved to
+# disk and later builds only ask the server whether it changed (using the
+# ETag and Last-Modified headers), or don't ask at all in offline mode.
+################################################################################
+from dactyl.common import *
+
+import hashlib
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+TIMEOUT_SECS = 30
+CONCURRENCY = 8
+
+class RemoteFetcher:
+    """Fetches the text of remote files. cache_path is a folder to save
+    downloads in, or None for no disk cache. If offline is True, files are
+    only read from the cache. prefetch() downloads up to concurrency files
+    at a time."""
+    def __init__(self, cache_path=None, offline=False, timeout=TIMEOUT_SECS,
+                 concurrency=CONCURRENCY):
+        self.cache_path = cache_path
+        self.offline = offline
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.session = self.new_session()
+        self.fetched = {} # url -> text, for this build
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+
+    def cache_file(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_path, key + ".json")
+
+    def load_cached(self, url):
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_file(url), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            if entry.get("url") == url:
+                return entry
+        except FileNotFoundError:
+            pass
+        except (ValueError, OSError) as e:
+            logger.debug("Ignoring unreadable cached copy of %s: %s" % (url, repr(e)))
+        return None
+
+    def save_cached(self, url, response):
+        """Save a copy of a download. Errors are logged, not raised, since the
+        download itself worked."""
+        if not self.cache_path:
+            return
+        entry = {
+            "url": url,
+            "text": response.text,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched": time.time(),
+        }
+        path = self.cache_file(url)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            os.makedirs(self.cache_path, exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Couldn't save a copy of %s: %s" % (url, repr(e)))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def fetch(self, url):
+        """Returns the text of a remote file. Raises requests.RequestException
+        if it can't be fetched (or, in offline mode, isn't cached)."""
+        with self.lock:
+            if url in self.fetched:
+                return self.fetched[url]
+        text = self.fetch_uncached(url)
+        with self.lock:
+            self.fetched[url] = text
+        return text
+
+    def fetch_uncached(self, url):
+        cached = self.load_cached(url)
+        if self.offline:
+            if cached is None:
+                raise requests.RequestException(
+                        "Offline, and no cached copy of %s" % url)
+            logger.debug("Offline - using cached copy of %s" % url)
+            return cached["text"]
+
+        headers = {}
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+        with self.lock:
+            self.requests += 1
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            if cached is None:
+                raise
+            logger.warning("Couldn't fetch %s (%s); using cached copy" %
+                           (url, repr(e)))
+            return cached["text"]
+
+        if response.status_code == 304 and cached:
+            logger.debug("Cached copy of %s is up to date" % url)
+            with self.lock:
+                self.not_modified += 1
+            return cached["text"]
+        if response.status_code == 200:
+            self.save_cached(url, response)
+            return response.text
+        raise requests.RequestException("Status code for page was not 200")
+
+    def prefetch(self, urls):
+        """Fetch several remote files at once, so that fetching them later in
+        the build doesn't have to wait on the network. Errors are logged but
+        not raised; fetch() raises them when the file is actually needed."""
+        with self.lock:
+            urls = [url for url in dict.fromkeys(urls) if url not in self.fetched]
+        if not urls:
+            return
+        logger.info("Prefetching %d remote files..." % len(urls))
+        def prefetch_one(url):
+            try:
+                self.fetch(url)
+            except requests.RequestException as e:
+                logger.debug("Couldn't prefetch %s: %s" % (url, repr(e)))
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            list(executor.map(prefetch_one, urls))
+
+    def uptodate(self, url, text):
+        """Returns a function for Jinja's get_source() uptodate value: a
+        template from url is current if url still has the same text. Within
+        a build, that doesn't need another request."""
+        def is_current():
+            try:
+                return self.fetch(url) == text
+            except requests.RequestException:
+                return False
+        return is_current
+
+    def new_build(self):
+        """Forget what was fetched, so the next build checks for changes."""
+        with self.lock:
+            self.fetched = {}
+
+    def new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.concurrency)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def reset_session(self):
+        # A forked process can't share the parent's open connections
+        self.session = self.new_session()
+        self.lock = threading.Lock()
+
+
+_fetcher = RemoteFetcher()
+
+def get_fetcher():
+    return _fetcher
+
+def configure(cache_path=None, offline=False, timeout=TIMEOUT_SECS,
+              concurrency=CONCURRENCY):
+    """Replace the shared RemoteFetcher with one using these settings."""
+    global _fetcher
+    _fetcher.session.close()
+    _fetcher = RemoteFetcher(cache_path, offline, timeout, concurrency)
+    return _fetcher
+
+def fetch(url):
+    """Fetch the text of a remote file with the shared RemoteFetcher."""
+    return _fetcher.fetch(url)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=lambda: _fetcher.reset_session())
@@ -0,0 +1,193 @@
+################################################################################
+# Dactyl static file sync
+#
+# Copies static files (images, CSS, video, etc.) to an output folder, skipping
+# files that haven't changed since the last time they were copied there. A
+# manifest in the output folder records the size and modification time of each
+# file copied. Files are hard-linked instead of copied where possible.
+################################################################################
+from dactyl.common import *
+
+import errno
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dactyl.manifest import hash_file
+
+STATIC_MANIFEST_FILENAME = ".dactyl_static_manifest.json"
+STATIC_MANIFEST_VERSION = 1
+
+class StaticSync:
+    """Syncs static files to out_path. Add the files to sync with add_tree()
+    and add_file(), then call sync().
+
+    jobs is how many files to copy at a time. If link is True, files are hard-
+    linked when the source and destination are on the same filesystem. If
+    prune is True, files copied by an earlier sync into a folder synced with
+    add_tree() are deleted if they're no longer in the source folder. If
+    checksum is True, a file whose modification time changed but whose size
+    didn't is only copied again if its contents changed."""
+    def __init__(self, out_path, jobs=8, link=True, prune=False, checksum=False):
+        self.out_path = out_path
+        self.path = os.path.join(out_path, STATIC_MANIFEST_FILENAME)
+        self.jobs = max(1, jobs)
+        self.link = link
+        self.prune = prune
+        self.checksum = checksum
+        self.wanted = {} # destination (relative to out_path) -> source
+        self.roots = [] # destination folders synced with add_tree()
+        self.lock = threading.Lock()
+        self.files = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved.get("version") == STATIC_MANIFEST_VERSION:
+                self.files = saved["files"]
+            else:
+                logger.info("Static file manifest is from another version; ignoring it")
+        except FileNotFoundError:
+            logger.debug("No static file manifest at %s" % self.path)
+        except (ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable static file manifest %s: %s" %
+                           (self.path, repr(e)))
+
+    def add_tree(self, src, dst):
+        """Sync every file in the folder src to the folder dst (relative to
+        out_path)."""
+        dst = os.path.normpath(dst)
+        self.roots.append(dst)
+        for dirpath, dirnames, filenames in os.walk(src):
+            reldir = os.path.relpath(dirpath, src)
+            for filename in filenames:
+                self.add_file(os.path.join(dirpath, filename),
+                              os.path.normpath(os.path.join(dst, reldir, filename)))
+
+    def add_file(self, src, dst):
+        """Sync the file src to dst (relative to out_path)."""
+        self.wanted[os.path.normpath(dst)] = src
+
+    def is_current(self, dst, src, src_stat):
+        entry = self.files.get(dst)
+        if not entry or entry["src"] != src or entry["size"] != src_stat.st_size:
+            return False
+        try:
+            dst_stat = os.stat(os.path.join(self.out_path, dst))
+        except OSError:
+            return False
+        if dst_stat.st_size != entry["dst_size"] or \
+                dst_stat.st_mtime_ns != entry["dst_mtime_ns"]:
+            logger.debug("%s changed in the output folder" % dst)
+            return False
+        if src_stat.st_mtime_ns == entry["mtime_ns"]:
+            return True
+        if self.checksum and entry.get("hash") and hash_file(src) == entry["hash"]:
+            # Touched, but not changed
+            self.record(dst, src, src_stat, dst_stat, entry["hash"])
+            return True
+        return False
+
+    def record(self, dst, src, src_stat, dst_stat, file_hash=None):
+        entry = {
+            "src": src,
+            "size": src_stat.st_size,
+            "mtime_ns": src_stat.st_mtime_ns,
+            "dst_size": dst_stat.st_size,
+            "dst_mtime_ns": dst_stat.st_mtime_ns,
+        }
+        if file_hash:
+            entry["hash"] = file_hash
+        with self.lock:
+            self.files[dst] = entry
+
+    def copy(self, dst, src, src_stat):
+        """Copy (or link) src to dst. Returns "linked" or "copied"."""
+        dst_path = os.path.join(self.out_path, dst)
+        os.makedirs(os.path.dirname(dst_path) or ".", exist_ok=True)
+        # Write to a temp file and rename it into place, so that a hard link
+        # from an earlier sync doesn't get written through to its source
+        tmp_path = "%s.%d.%d.tmp" % (dst_path, os.getpid(), threading.get_ident())
+        how = "copied"
+        try:
+            if self.link:
+                try:
+                    os.link(src, tmp_path)
+                    how = "linked"
+                except OSError as e:
+                    if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                                   errno.ENOTSUP, errno.EOPNOTSUPP):
+                        if e.errno == errno.EXDEV:
+                            logger.debug("Static files are on another filesystem; copying instead of linking")
+                            self.link = False
+                    else:
+                        raise
+            if how == "copied":
+                shutil.copy2(src, tmp_path)
+            os.replace(tmp_path, dst_path)
+        except BaseException:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        file_hash = hash_file(src) if self.checksum else None
+        self.record(dst, src, src_stat, os.stat(dst_path), file_hash)
+        return how
+
+    def prune_deleted(self):
+        """Delete files that an earlier sync copied into one of the folders
+        synced this time, but which aren't in the source anymore."""
+        pruned = 0
+        for dst in sorted(self.files.keys()):
+            if dst in self.wanted:
+                continue
+            if not any(dst.startswith(root + os.sep) for root in self.roots):
+                continue
+            dst_path = os.path.join(self.out_path, dst)
+            logger.debug("Removing deleted static file %s" % dst_path)
+            try:
+                os.remove(dst_path)
+                pruned += 1
+            except FileNotFoundError:
+                pass
+            del self.files[dst]
+            # Clean up folders that are now empty, up to the synced folder
+            folder = os.path.dirname(dst_path)
+            while os.path.relpath(folder, self.out_path) not in self.roots:
+                try:
+                    os.rmdir(folder)
+                except OSError:
+                    break
+                folder = os.path.dirname(folder)
+        return pruned
+
+    def sync(self):
+        """Copy the files that changed and save the manifest. Returns counts
+        of the files linked, copied, unchanged, and pruned."""
+        counts = {"linked": 0, "copied": 0, "unchanged": 0, "pruned": 0}
+        to_copy = []
+        for dst, src in self.wanted.items():
+            src_stat = os.stat(src)
+            if self.is_current(dst, src, src_stat):
+                counts["unchanged"] += 1
+            else:
+                to_copy.append( (dst, src, src_stat) )
+
+        if to_copy:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                for how in executor.map(lambda args: self.copy(*args), to_copy):
+                    counts[how] += 1
+        if self.prune:
+            counts["pruned"] = self.prune_deleted()
+
+        self.save()
+        logger.info("Static files: %d linked, %d copied, %d unchanged, %d removed" %
+                    (counts["linked"], counts["copied"], counts["unchanged"],
+                     counts["pruned"]))
+        return counts
+
+    def save(self):
+        os.makedirs(self.out_path, exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": STATIC_MANIFEST_VERSION, "files": self.files},
+                      f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -50,6 +50,9 @@ setup(
         'requests',
         'watchdog'
     ],
+    extras_require={
+        'pdf_chunks': ['pypdf'],
+    },
     package_data={
         '': ["templates/*", "default-config.yml"],
     }
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+################################################################################
+# Stub ElasticSearch server
+#
+# Accepts _bulk uploads on localhost so ES uploads can be tested (and timed)
+# without a real ElasticSearch instance.
+################################################################################
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StubESHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length).decode("utf-8")
+
+    def do_GET(self):
+        stub = self.server.stub
+        if self.path.startswith("/_alias/"):
+            alias = self.path[len("/_alias/"):]
+            with stub.lock:
+                indexes = [i for i, a in stub.aliases.items() if a == alias]
+            if indexes:
+                self.respond(200, {i: {"aliases": {alias: {}}} for i in indexes})
+                return
+        self.respond(404, {"error": "not found"})
+
+    def do_HEAD(self):
+        stub = self.server.stub
+        with stub.lock:
+            exists = self.path[1:] in stub.indexes
+        self.send_response(200 if exists else 404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_PUT(self):
+        self.read_body()
+        stub = self.server.stub
+        index = self.path[1:]
+        with stub.lock:
+            if index in stub.indexes:
+                self.respond(400, {"error": "resource_already_exists_exception"})
+                return
+            stub.indexes.add(index)
+        self.respond(200, {"acknowledged": True})
+
+    def do_DELETE(self):
+        stub = self.server.stub
+        index = self.path[1:]
+        with stub.lock:
+            if index not in stub.indexes:
+                self.respond(404, {"error": "index_not_found_exception"})
+                return
+            stub.delete_index(index)
+        self.respond(200, {"acknowledged": True})
+
+    def do_POST(self):
+        body = self.read_body()
+        stub = self.server.stub
+        if self.path.startswith("/_reindex"):
+            data = json.loads(body)
+            source, dest = data["source"]["index"], data["dest"]["index"]
+            with stub.lock:
+                copied = [(dest, id) for (index, id) in stub.docs if index == source]
+                for index, id in copied:
+                    stub.docs[(index, id)] = stub.docs[(source, id)]
+            self.respond(200, {"total": len(copied), "failures": []})
+            return
+        elif self.path.endswith("/_refresh"):
+            self.respond(200, {"_shards": {}})
+            return
+        elif self.path == "/_aliases":
+            with stub.lock:
+                for action in json.loads(body)["actions"]:
+                    name, args = next(iter(action.items()))
+                    if name == "add":
+                        stub.aliases[args["index"]] = args["alias"]
+                    elif name == "remove":
+                        stub.aliases.pop(args["index"], None)
+                    elif name == "remove_index":
+                        stub.delete_index(args["index"])
+            self.respond(200, {"acknowledged": True})
+            return
+        elif self.path != "/_bulk":
+            self.respond(404, {"error": "no handler for %s" % self.path})
+            return
+
+        with stub.lock:
+            stub.requests += 1
+            stub.connections.add(self.client_address)
+            if stub.fail_requests > 0:
+                stub.fail_requests -= 1
+                fail_status = stub.fail_status
+            else:
+                fail_status = None
+        if stub.latency:
+            time.sleep(stub.latency)
+        if fail_status:
+            self.respond(fail_status, {"error": "injected failure"})
+            return
+
+        lines = body.splitlines()
+        items = []
+        while lines:
+            action_name, action = next(iter(json.loads(lines.pop(0)).items()))
+            doc_id = action["_id"]
+            key = (action["_index"], doc_id)
+            with stub.lock:
+                if action_name == "delete":
+                    status = 200 if stub.docs.pop(key, None) else 404
+                elif stub.item_failures.get(doc_id, 0) > 0:
+                    status = 429
+                    stub.item_failures[doc_id] -= 1
+                elif doc_id in stub.rejected_ids:
+                    status = 400
+                else:
+                    status = 201
+                    stub.docs[key] = json.loads(lines[0])
+                    stub.indexed.append(key)
+                    stub.indexes.add(action["_index"])
+            if action_name != "delete":
+                lines.pop(0)
+            result = {"_index": action["_index"], "_id": doc_id, "status": status}
+            if status >= 400:
+                result["error"] = {"type": "stub_error", "reason": "injected"}
+            items.append({action_name: result})
+        with stub.lock:
+            if stub.drop_items:
+                items = items[:-stub.drop_items]
+                stub.drop_items = 0
+        self.respond(200, {"errors": any(r["status"] >= 400
+                                         for i in items for r in i.values()),
+                           "items": items})
+
+    def respond(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class StubESServer:
+    """An ElasticSearch stand-in that runs in a background thread. Use as a
+    context manager; base_url is set once it's running.
+
+    To test error handling, set fail_requests to make that many _bulk requests
+    fail with fail_status; add ids to item_failures (id -> count) to make
+    those documents fail with 429 that many times; or add ids to rejected_ids
+    to make those documents fail with 400 every time."""
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.docs = {} # (index, id) -> document
+        self.indexed = [] # (index, id) of every document uploaded
+        self.indexes = set()
+        self.aliases = {} # index -> alias
+        self.requests = 0
+        self.connections = set()
+        self.fail_requests = 0
+        self.fail_status = 503
+        self.item_failures = {}
+        self.rejected_ids = set()
+        self.drop_items = 0 # Leave this many results out of the next response
+
+    def delete_index(self, index):
+        self.indexes.discard(index)
+        self.aliases.pop(index, None)
+        for key in [k for k in self.docs if k[0] == index]:
+            del self.docs[key]
+
+    def alias_docs(self, alias):
+        """The documents visible through an alias (or index name)."""
+        indexes = [i for i, a in self.aliases.items() if a == alias] or [alias]
+        return {id: doc for (index, id), doc in self.docs.items()
+                if index in indexes}
+
+    def __enter__(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubESHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.base_url = "http://127.0.0.1:%d" % self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
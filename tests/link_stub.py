@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+################################################################################
+# Stub web server
+#
+# Serves URLs with predictable results on localhost, so the link checker's
+# remote checks can be tested without the network.
+#
+# /ok/...          200
+# /status/N/...    status N
+# /slow/S/...      200 after S seconds
+# /etag/...        200 with an ETag, or 304 if the request has a matching
+#                  If-None-Match header
+# /flaky/N/...     503 the first N times it's requested, then 200
+# /retryafter/S/.. 429 with "Retry-After: S" the first time, then 200
+#
+# Paths in the server's files dict are served with that text as the body and
+# an ETag (or 304 if the request has a matching If-None-Match header).
+################################################################################
+
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StubWebHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request()
+
+    def do_GET(self):
+        self.handle_request()
+
+    def handle_request(self):
+        stub = self.server.stub
+        with stub.lock:
+            stub.requests.append( (self.command, self.path) )
+            stub.request_headers.append(dict(self.headers))
+            stub.request_times.append(time.time())
+            stub.connections.add(self.client_address)
+            stub.in_flight += 1
+            stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+        try:
+            parts = self.path.split("/")
+            status = 200
+            headers = {}
+            body = b""
+            if self.path in stub.files:
+                body = stub.files[self.path].encode("utf-8")
+                etag = '"%s"' % hashlib.sha256(body).hexdigest()[:16]
+                headers["ETag"] = etag
+                headers["Content-Type"] = "text/plain; charset=utf-8"
+                if self.headers.get("If-None-Match") == etag:
+                    status = 304
+                    body = b""
+            elif parts[1] == "etag":
+                headers["ETag"] = '"v1"'
+                if self.headers.get("If-None-Match") == '"v1"':
+                    status = 304
+            elif parts[1] == "flaky":
+                with stub.lock:
+                    stub.hits[self.path] = stub.hits.get(self.path, 0) + 1
+                    if stub.hits[self.path] <= int(parts[2]):
+                        status = 503
+            elif parts[1] == "retryafter":
+                with stub.lock:
+                    stub.hits[self.path] = stub.hits.get(self.path, 0) + 1
+                    if stub.hits[self.path] == 1:
+                        status = 429
+                        headers["Retry-After"] = parts[2]
+            elif parts[1] == "status":
+                status = int(parts[2])
+            elif parts[1] == "slow":
+                time.sleep(float(parts[2]))
+            elif parts[1] != "ok":
+                status = 404
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            if self.command == "HEAD":
+                body = b""
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with stub.lock:
+                stub.in_flight -= 1
+
+class StubWebServer:
+    """A web server that runs in a background thread. Use as a context
+    manager; base_url is set once it's running."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = [] # (method, path) of every request
+        self.request_headers = []
+        self.request_times = [] # when each request was received
+        self.hits = {} # path -> number of requests
+        self.connections = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.files = {} # path -> text to serve
+
+    def url(self, path):
+        return self.base_url + path
+
+    def __enter__(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubWebHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.base_url = "http://127.0.0.1:%d" % self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+################################################################################
+# Fake Prince
+#
+# Takes the same arguments as Dactyl passes to Prince and writes a small PDF
+# with a bookmark for each input HTML file, so that PDF builds can be tested
+# without Prince. Each file gets one page, or the number of pages in a
+# <meta name="pages" content="N"> tag. Each page says its page number, starting
+# from the number in a "counter-reset: page N" rule in the --style file, if any.
+#
+# If PRINCE_STUB_LOG is set, a JSON line describing each run is appended to
+# that file. If PRINCE_STUB_DELAY is set, each run takes that many seconds.
+################################################################################
+
+import json
+import os
+import re
+import sys
+import time
+
+def pdf_string(text):
+    # Plain PDF strings are Latin-1
+    text = text.encode("latin-1", "replace").decode("latin-1")
+    return "(%s)" % text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def read_html(html_path):
+    """Returns the title and number of pages of an HTML file."""
+    with open(html_path, "r", encoding="utf-8") as f:
+        html = f.read()
+    m = re.search(r"<title>(.*?)</title>", html, re.S)
+    title = m.group(1).strip() if m else os.path.basename(html_path)
+    m = re.search(r'<meta name="pages" content="(\d+)"', html)
+    return title, int(m.group(1)) if m else 1
+
+def write_pdf(path, docs, first_page):
+    """Write a PDF with the pages of each (title, pages) in docs, and a
+    bookmark to the first page of each."""
+    objects = [] # bodies of objects 1..N
+    def add(body):
+        objects.append(body)
+        return len(objects)
+    def ref(num):
+        return "%d 0 R" % num
+
+    catalog = add(None)
+    pages_obj = add(None)
+    outlines = add(None)
+    font = add("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    page_nums = []
+    doc_first_pages = []
+    for title, pages in docs:
+        doc_first_pages.append(len(page_nums))
+        for i in range(pages):
+            text = "BT /F1 24 Tf 72 720 Td %s Tj ET" % pdf_string(
+                    "%s - page %d" % (title, first_page + len(page_nums)))
+            content = add("<< /Length %d >>\nstream\n%s\nendstream" % (len(text), text))
+            page_nums.append(add("<< /Type /Page /Parent %s /MediaBox [0 0 612 792] "
+                                 "/Resources << /Font << /F1 %s >> >> /Contents %s >>" %
+                                 (ref(pages_obj), ref(font), ref(content))))
+    items = [add(None) for doc in docs]
+    for i, ((title, pages), item) in enumerate(zip(docs, items)):
+        body = "<< /Title %s /Parent %s /Dest [%s /Fit]" % (
+                pdf_string(title), ref(outlines), ref(page_nums[doc_first_pages[i]]))
+        if i > 0:
+            body += " /Prev %s" % ref(items[i-1])
+        if i < len(items) - 1:
+            body += " /Next %s" % ref(items[i+1])
+        objects[item-1] = body + " >>"
+    objects[catalog-1] = "<< /Type /Catalog /Pages %s /Outlines %s >>" % (
+            ref(pages_obj), ref(outlines))
+    objects[pages_obj-1] = "<< /Type /Pages /Kids [%s] /Count %d >>" % (
+            " ".join(ref(n) for n in page_nums), len(page_nums))
+    objects[outlines-1] = "<< /Type /Outlines /First %s /Last %s /Count %d >>" % (
+            ref(items[0]), ref(items[-1]), len(items))
+
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for num, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += ("%d 0 obj\n%s\nendobj\n" % (num, body)).encode("latin-1")
+    xref_offset = len(out)
+    out += ("xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)).encode("latin-1")
+    for offset in offsets:
+        out += ("%010d 00000 n \n" % offset).encode("latin-1")
+    out += ("trailer\n<< /Size %d /Root %s >>\nstartxref\n%d\n%%%%EOF\n" %
+            (len(objects) + 1, ref(catalog), xref_offset)).encode("latin-1")
+    with open(path, "wb") as f:
+        f.write(out)
+
+def main(args):
+    start = time.time()
+    outfile = None
+    first_page = 1
+    inputs = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == "-o":
+            outfile = args[i+1]
+            i += 1
+        elif arg.startswith("--style="):
+            with open(arg[len("--style="):], "r", encoding="utf-8") as f:
+                m = re.search(r"counter-reset:\s*page\s+(\d+)", f.read())
+            if m:
+                first_page = int(m.group(1))
+        elif not arg.startswith("-"):
+            inputs.append(arg)
+        i += 1
+
+    time.sleep(float(os.environ.get("PRINCE_STUB_DELAY", 0)))
+    write_pdf(outfile, [read_html(path) for path in inputs], first_page)
+
+    if os.environ.get("PRINCE_STUB_LOG"):
+        with open(os.environ["PRINCE_STUB_LOG"], "a", encoding="utf-8") as f:
+            f.write(json.dumps({"out": outfile, "inputs": inputs,
+                                "first_page": first_page, "start": start,
+                                "end": time.time()}) + "\n")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 
 import os
+import shutil
 import subprocess
 import sys
 import unittest
 
-from distutils.dir_util import remove_tree
 from pathlib import Path
 
 class TestDactyl(unittest.TestCase):
@@ -14,7 +14,7 @@ class TestDactyl(unittest.TestCase):
         self.startdir = os.getcwd()
         # Before each test is run, remove the existing files in out subdirectory.
         try:
-	        remove_tree("out")
+	        shutil.rmtree("out")
         except FileNotFoundError:
             print("No out/ dir to remove")
 
@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
 
 import argparse
+import os
 import sys
+import tempfile
+import time
 import unittest
 
-from dactyl import dactyl_build
+from dactyl import dactyl_build, remote_fetch
+from es_stub import StubESServer
+from link_stub import StubWebServer
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
 
 class MockCliArgs:
     version=None
@@ -27,6 +37,7 @@ try:
 except ModuleNotFoundError:
     print("Oh no!  A module wasn't found, and this statement is extremely unhelpful!")
 
+from bs4 import BeautifulSoup
 from jinja2 import Template
 mocktemplate = Template("This page is {{ currentpage.name }}.")
 
@@ -52,10 +63,472 @@ class TestDactylBuild(unittest.TestCase):
     def test_parse_markdown(self):
         output = dactyl_build.parse_markdown(dactyl_build.config["pages"][2], "filters_target", dactyl_build.config["pages"], [], "html", "", False)
 
+    def test_page_content(self):
+        html = ('<h1 id="top">Top</h1><p> </p><p>First <em>real</em> paragraph.</p>'
+                '<h2 id="sub">Sub <code>section</code></h2><h4>No ID</h4>')
+        content = dactyl_build.PageContent(BeautifulSoup(html, "html.parser"))
+        assert content.html == html
+        assert content.toc() == dactyl_build.toc_from_headers(html)
+        assert content.headermap() == {"Top": "#top", "Sub section": "#sub"}
+        assert content.blurb() == "First real paragraph."
+        assert content.plaintext() == "Top First real paragraph.Sub sectionNo ID"
+        assert dactyl_build.PageContent().blurb() is None
+
     def test_render_page(self):
         output = dactyl_build.render_page(dactyl_build.config["pages"][2], "filters_target", dactyl_build.config["pages"], "html", "", [], mocktemplate, False)
         assert output == "This page is md_test."
 
+    def test_render_pages_parallel(self):
+        old_out_path = dactyl_build.config["out_path"]
+        try:
+            outputs = []
+            for jobs in (1, 2):
+                with tempfile.TemporaryDirectory() as out_path:
+                    dactyl_build.config["out_path"] = out_path
+                    dactyl_build.render_pages("test_target", jobs=jobs)
+                    written = {}
+                    for fname in sorted(os.listdir(out_path)):
+                        with open(os.path.join(out_path, fname), encoding="utf-8") as f:
+                            written[fname] = f.read()
+                    outputs.append(written)
+        finally:
+            dactyl_build.config["out_path"] = old_out_path
+        assert sorted(outputs[0].keys()) == ["filters_page.html", "test.html"]
+        assert outputs[0] == outputs[1]
+
+    def test_render_pages_gets_pages_once(self):
+        calls = []
+        real_get_pages = dactyl_build.get_pages
+        def counting_get_pages(*args, **kwargs):
+            calls.append(args)
+            return real_get_pages(*args, **kwargs)
+        old_out_path = dactyl_build.config["out_path"]
+        dactyl_build.get_pages = counting_get_pages
+        try:
+            with tempfile.TemporaryDirectory() as out_path:
+                dactyl_build.config["out_path"] = out_path
+                dactyl_build.render_pages("filters_target", mode="md")
+                dactyl_build.render_pages("filters_target", mode="html")
+        finally:
+            dactyl_build.get_pages = real_get_pages
+            dactyl_build.config["out_path"] = old_out_path
+        assert len(calls) == 2
+
+    def test_render_pages_incremental(self):
+        rendered = []
+        real_render_page = dactyl_build.render_page
+        def counting_render_page(currentpage, *args, **kwargs):
+            rendered.append(currentpage["html"])
+            return real_render_page(currentpage, *args, **kwargs)
+        old_out_path = dactyl_build.config["out_path"]
+        dactyl_build.render_page = counting_render_page
+        try:
+            with tempfile.TemporaryDirectory() as out_path:
+                dactyl_build.config["out_path"] = out_path
+                dactyl_build.render_pages("test_target", incremental=True)
+                assert sorted(rendered) == ["filters_page.html", "test.html"]
+                assert os.path.isfile(os.path.join(out_path, ".dactyl_manifest.json"))
+
+                rendered.clear()
+                dactyl_build.render_pages("test_target", incremental=True)
+                assert rendered == []
+
+                # Missing outputs get rebuilt
+                os.remove(os.path.join(out_path, "test.html"))
+                dactyl_build.render_pages("test_target", incremental=True)
+                assert rendered == ["test.html"]
+        finally:
+            dactyl_build.render_page = real_render_page
+            dactyl_build.config["out_path"] = old_out_path
+
+    def test_watch_rebuilds_affected_pages(self):
+        rendered = []
+        real_render_page = dactyl_build.render_page
+        def counting_render_page(currentpage, *args, **kwargs):
+            rendered.append(currentpage["html"])
+            return real_render_page(currentpage, *args, **kwargs)
+        old_out_path = dactyl_build.config["out_path"]
+        old_content_path = dactyl_build.config["content_path"]
+        dactyl_build.render_page = counting_render_page
+        try:
+            with tempfile.TemporaryDirectory() as out_path, \
+                    tempfile.TemporaryDirectory() as content_path:
+                os.mkdir(os.path.join(content_path, "code_samples"))
+                files = {
+                    "a.md": "# A\n\n{% include 'code_samples/a.js' %}",
+                    "b.md": "---\nblurb: OldBlurb\n---\n# B\n\n{{ currentpage.blurb }}",
+                    "code_samples/a.js": "console.log('a')",
+                }
+                for filename, text in files.items():
+                    with open(os.path.join(content_path, filename), "w") as f:
+                        f.write(text)
+                dactyl_build.config["out_path"] = out_path
+                dactyl_build.config["content_path"] = content_path
+                pages = [{"name": "A", "md": "a.md", "html": "a.html"},
+                         {"name": "B", "md": "b.md", "html": "b.html"}]
+                state = dactyl_build.WatchState(pages)
+                dactyl_build.render_modes("test_target", watch_state=state)
+                assert rendered == ["a.html", "b.html"]
+
+                sample = os.path.join(content_path, "code_samples", "a.js")
+                assert state.affected_pages([sample]) == [pages[0]]
+                rendered.clear()
+                dactyl_build.render_modes("test_target", watch_state=state,
+                                          rebuild_pages=[pages[0]])
+                assert rendered == ["a.html"]
+
+                # Unknown files and frontmatter changes mean a full rebuild
+                assert state.affected_pages([os.path.join(content_path, "new.md")]) is None
+                with open(os.path.join(content_path, "b.md"), "w") as f:
+                    f.write("---\nblurb: NewBlurb\n---\n# B\n\n{{ currentpage.blurb }}")
+                assert state.affected_pages([os.path.join(content_path, "b.md")]) is None
+
+                # The new frontmatter replaces what the last build merged in
+                state.reset_pages()
+                dactyl_build.render_modes("test_target", watch_state=state)
+                with open(os.path.join(out_path, "b.html")) as f:
+                    html = f.read()
+                assert "NewBlurb" in html
+                assert "OldBlurb" not in html
+                assert pages[1]["blurb"] == "NewBlurb"
+        finally:
+            dactyl_build.render_page = real_render_page
+            dactyl_build.config["out_path"] = old_out_path
+            dactyl_build.config["content_path"] = old_content_path
+
+    def test_make_pdf_staging(self):
+        rendered = []
+        real_render_page = dactyl_build.render_page
+        real_get_pages = dactyl_build.get_pages
+        def counting_render_page(currentpage, *args, **kwargs):
+            rendered.append(currentpage["html"])
+            return real_render_page(currentpage, *args, **kwargs)
+        old_config = {k: dactyl_build.config.get(k) for k in ("out_path",
+                "content_path", "template_static_path", "pdf_staging_path",
+                "prince_executable")}
+        dactyl_build.render_page = counting_render_page
+        try:
+            with tempfile.TemporaryDirectory() as tempdir:
+                content_path = os.path.join(tempdir, "content")
+                static_path = os.path.join(tempdir, "assets")
+                os.mkdir(content_path)
+                os.mkdir(static_path)
+                for filename, text in [("content/a.md", "# A"),
+                        ("content/b.md", "# B"), ("assets/style.css", "body {}")]:
+                    with open(os.path.join(tempdir, filename), "w") as f:
+                        f.write(text)
+                dactyl_build.config["out_path"] = os.path.join(tempdir, "out")
+                dactyl_build.config["content_path"] = content_path
+                dactyl_build.config["template_static_path"] = static_path
+                dactyl_build.config["pdf_staging_path"] = os.path.join(tempdir, "staging")
+                dactyl_build.config["prince_executable"] = "true"
+                pages = [{"name": "A", "md": "a.md", "html": "a.html"},
+                         {"name": "B", "md": "b.md", "html": "b.html"}]
+                dactyl_build.get_pages = lambda *args, **kwargs: pages
+
+                dactyl_build.make_pdf("test.pdf", target="test_target")
+                assert rendered == ["a.html", "b.html"]
+                staging_dir = dactyl_build.pdf_staging_dir(
+                        dactyl_build.get_target("test_target"))
+                assert os.path.isfile(os.path.join(staging_dir, "a.html"))
+                assert os.path.isfile(os.path.join(staging_dir, "assets", "style.css"))
+
+                rendered.clear()
+                dactyl_build.make_pdf("test.pdf", target="test_target")
+                assert rendered == []
+
+                with open(os.path.join(content_path, "b.md"), "w") as f:
+                    f.write("# B changed")
+                dactyl_build.make_pdf("test.pdf", target="test_target")
+                assert rendered == ["b.html"]
+                with open(os.path.join(staging_dir, "b.html")) as f:
+                    assert "B changed" in f.read()
+        finally:
+            dactyl_build.render_page = real_render_page
+            dactyl_build.get_pages = real_get_pages
+            for k, v in old_config.items():
+                if v is None:
+                    dactyl_build.config.config.pop(k, None)
+                else:
+                    dactyl_build.config[k] = v
+
+    def test_pdf_staging_dir_private(self):
+        old_config = {k: dactyl_build.config.get(k) for k in ("out_path",
+                "content_path", "temporary_files_path", "pdf_staging_path",
+                "prince_executable")}
+        old_config_file = dactyl_build.config.cli_args.config
+        real_get_pages = dactyl_build.get_pages
+        try:
+            with tempfile.TemporaryDirectory() as tempdir:
+                content_path = os.path.join(tempdir, "content")
+                os.mkdir(content_path)
+                with open(os.path.join(content_path, "a.md"), "w") as f:
+                    f.write("# A")
+                dactyl_build.config["out_path"] = os.path.join(tempdir, "out")
+                dactyl_build.config["content_path"] = content_path
+                dactyl_build.config["temporary_files_path"] = tempdir
+                dactyl_build.config["prince_executable"] = "true"
+                dactyl_build.config.config.pop("pdf_staging_path", None)
+                pages = [{"name": "A", "md": "a.md", "html": "a.html"}]
+                dactyl_build.get_pages = lambda *args, **kwargs: pages
+                target = dactyl_build.get_target("test_target")
+
+                staging_dir = dactyl_build.pdf_staging_dir(target)
+                staging_root = os.path.dirname(staging_dir)
+                assert os.path.basename(staging_root) == \
+                        "dactyl-pdf-staging-%d" % os.getuid()
+                assert os.stat(staging_root).st_mode & 0o777 == 0o700
+                assert os.stat(staging_dir).st_mode & 0o777 == 0o700
+                dactyl_build.config.cli_args.config = "other-config.yml"
+                assert dactyl_build.pdf_staging_dir(target) != staging_dir
+                dactyl_build.config.cli_args.config = old_config_file
+
+                # The default staging folder is a temp file
+                dactyl_build.make_pdf("test.pdf", target=target)
+                assert not os.path.exists(staging_dir)
+                dactyl_build.make_pdf("test.pdf", target=target, remove_tmp=False)
+                assert os.path.isfile(os.path.join(staging_dir, "a.html"))
+
+                # Others could change what Prince runs
+                os.chmod(staging_root, 0o777)
+                assert dactyl_build.pdf_staging_dir(target) is None
+        finally:
+            dactyl_build.get_pages = real_get_pages
+            dactyl_build.config.cli_args.config = old_config_file
+            for k, v in old_config.items():
+                if v is None:
+                    dactyl_build.config.config.pop(k, None)
+                else:
+                    dactyl_build.config[k] = v
+
+    def test_watch_pdf_keeps_staging(self):
+        rendered = []
+        real_render_page = dactyl_build.render_page
+        real_get_pages = dactyl_build.get_pages
+        real_watch_files = dactyl_build.watch_files
+        real_time = dactyl_build.time
+        def counting_render_page(currentpage, *args, **kwargs):
+            rendered.append(currentpage["html"])
+            return real_render_page(currentpage, *args, **kwargs)
+        old_config = {k: dactyl_build.config.get(k) for k in ("out_path",
+                "content_path", "temporary_files_path", "pdf_staging_path",
+                "prince_executable")}
+        debouncers = []
+        class StubObserver:
+            def stop(self):
+                pass
+            def join(self):
+                pass
+        def stub_watch_files(debouncer, *args, **kwargs):
+            debouncers.append(debouncer)
+            return StubObserver()
+        try:
+            with tempfile.TemporaryDirectory() as tempdir:
+                content_path = os.path.join(tempdir, "content")
+                os.mkdir(content_path)
+                md_path = os.path.join(content_path, "a.md")
+                with open(md_path, "w") as f:
+                    f.write("# A")
+                dactyl_build.config["out_path"] = os.path.join(tempdir, "out")
+                dactyl_build.config["content_path"] = content_path
+                dactyl_build.config["temporary_files_path"] = tempdir
+                dactyl_build.config["prince_executable"] = "true"
+                dactyl_build.config.config.pop("pdf_staging_path", None)
+                pages = [{"name": "A", "md": "a.md", "html": "a.html"}]
+                dactyl_build.get_pages = lambda *args, **kwargs: pages
+                dactyl_build.render_page = counting_render_page
+                dactyl_build.watch_files = stub_watch_files
+                staging_dir = dactyl_build.pdf_staging_dir(
+                        dactyl_build.get_target("test_target"))
+
+                class WatchTime:
+                    # Rebuild twice, then stop watching
+                    def __getattr__(self, name):
+                        return getattr(real_time, name)
+                    def sleep(self, secs):
+                        debouncers[0].rebuild({md_path})
+                        assert rendered == ["a.html"]
+                        assert os.path.isfile(os.path.join(staging_dir, "a.html"))
+                        debouncers[0].rebuild({md_path})
+                        assert rendered == ["a.html"]
+                        raise KeyboardInterrupt()
+                dactyl_build.time = WatchTime()
+                dactyl_build.watch("pdf", "test_target")
+                assert not os.path.exists(staging_dir)
+        finally:
+            dactyl_build.render_page = real_render_page
+            dactyl_build.get_pages = real_get_pages
+            dactyl_build.watch_files = real_watch_files
+            dactyl_build.time = real_time
+            for k, v in old_config.items():
+                if v is None:
+                    dactyl_build.config.config.pop(k, None)
+                else:
+                    dactyl_build.config[k] = v
+
+    @unittest.skipUnless(pypdf, "needs pypdf")
+    def test_make_pdf_chunked(self):
+        real_get_pages = dactyl_build.get_pages
+        old_config = {k: dactyl_build.config.get(k) for k in ("out_path",
+                "content_path", "pdf_staging_path", "prince_executable",
+                "pdf_chunk_by", "pdf_chunk_size")}
+        try:
+            with tempfile.TemporaryDirectory() as tempdir:
+                content_path = os.path.join(tempdir, "content")
+                os.mkdir(content_path)
+                for name in ["a", "b", "c"]:
+                    with open(os.path.join(content_path, name+".md"), "w") as f:
+                        f.write("# %s" % name.upper())
+                dactyl_build.config["out_path"] = os.path.join(tempdir, "out")
+                dactyl_build.config["content_path"] = content_path
+                dactyl_build.config["pdf_staging_path"] = os.path.join(tempdir, "staging")
+                dactyl_build.config["prince_executable"] = os.path.abspath("prince_stub.py")
+                dactyl_build.config["pdf_chunk_by"] = "pages"
+                dactyl_build.config["pdf_chunk_size"] = 2
+                pages = [{"name": n.upper(), "md": n+".md", "html": n+".html"}
+                         for n in ["a", "b", "c"]]
+                dactyl_build.get_pages = lambda *args, **kwargs: pages
+
+                dactyl_build.make_pdf("test.pdf", target="test_target")
+                reader = pypdf.PdfReader(os.path.join(tempdir, "out", "test.pdf"))
+                assert len(reader.pages) == 3
+                assert len(reader.outline) == 3
+                staging_dir = dactyl_build.pdf_staging_dir(
+                        dactyl_build.get_target("test_target"))
+                assert len([f for f in os.listdir(os.path.join(staging_dir, "pdf-chunks"))
+                            if f.endswith(".pdf")]) == 2
+        finally:
+            dactyl_build.get_pages = real_get_pages
+            for k, v in old_config.items():
+                if v is None:
+                    dactyl_build.config.config.pop(k, None)
+                else:
+                    dactyl_build.config[k] = v
+
+    def test_bytecode_cache_private(self):
+        old_cache_path = dactyl_build.config.get("jinja_cache_path")
+        old_caches = dactyl_build.bytecode_caches
+        try:
+            with tempfile.TemporaryDirectory() as tempdir:
+                cache_path = os.path.join(tempdir, "cache")
+                dactyl_build.config["jinja_cache_path"] = cache_path
+                dactyl_build.bytecode_caches = {}
+                assert dactyl_build.get_bytecode_cache("html") is not None
+                assert os.stat(cache_path).st_mode & 0o777 == 0o700
+
+                # Someone else could have put compiled templates in it
+                os.chmod(cache_path, 0o777)
+                dactyl_build.bytecode_caches = {}
+                assert dactyl_build.get_bytecode_cache("html") is None
+        finally:
+            dactyl_build.bytecode_caches = old_caches
+            if old_cache_path is None:
+                dactyl_build.config.config.pop("jinja_cache_path", None)
+            else:
+                dactyl_build.config["jinja_cache_path"] = old_cache_path
+
+    def test_remote_cache_private(self):
+        old_config = {k: dactyl_build.config.get(k) for k in (
+                "temporary_files_path", "remote_cache_path")}
+        try:
+            with tempfile.TemporaryDirectory() as tempdir:
+                dactyl_build.config["temporary_files_path"] = tempdir
+                dactyl_build.config.config.pop("remote_cache_path", None)
+                dactyl_build.setup_remote_fetch()
+                cache_path = remote_fetch.get_fetcher().cache_path
+                assert cache_path == os.path.join(tempdir,
+                        "dactyl-remote-cache-%d" % os.getuid())
+                assert os.stat(cache_path).st_mode & 0o777 == 0o700
+
+                # Someone else could have planted a cached page in it
+                os.chmod(cache_path, 0o777)
+                dactyl_build.setup_remote_fetch()
+                assert remote_fetch.get_fetcher().cache_path is None
+        finally:
+            remote_fetch.configure()
+            for k, v in old_config.items():
+                if v is None:
+                    dactyl_build.config.config.pop(k, None)
+                else:
+                    dactyl_build.config[k] = v
+
+    def test_rebuild_debouncer(self):
+        rebuilds = []
+        debouncer = dactyl_build.RebuildDebouncer(rebuilds.append, delay=0.1)
+        for path in ["a.md", "a.md", "b.md", "template-x.html"]:
+            debouncer.add(path)
+        time.sleep(0.4)
+        assert rebuilds == [{"a.md", "b.md", "template-x.html"}]
+
+    def test_setup_pp_env_pooling(self):
+        page1 = {"name": "page1", "md": "page1.md", "pp_dir": "some_dir"}
+        page2 = {"name": "page2", "md": "page2.md", "pp_dir": "some_dir"}
+        page3 = {"name": "page3", "md": "page3.md", "pp_dir": "other_dir"}
+        env1 = dactyl_build.setup_pp_env(page1)
+        assert dactyl_build.setup_pp_env(page2) is env1
+        assert dactyl_build.setup_pp_env(page3) is not env1
+        assert dactyl_build.setup_pp_env(page1, strict_undefined=True) is not env1
+
+    def test_render_pages_html_with_es_upload(self):
+        parsed = []
+        real_parse_page_content = dactyl_build.parse_page_content
+        def counting_parse_page_content(page, *args, **kwargs):
+            parsed.append(page["name"])
+            return real_parse_page_content(page, *args, **kwargs)
+        old_out_path = dactyl_build.config["out_path"]
+        old_content_path = dactyl_build.config["content_path"]
+        dactyl_build.parse_page_content = counting_parse_page_content
+        try:
+            with tempfile.TemporaryDirectory() as out_path, StubESServer() as es:
+                dactyl_build.config["out_path"] = out_path
+                dactyl_build.config["content_path"] = "."
+                dactyl_build.render_pages("filters_target", mode="html",
+                        es_upload=es.base_url)
+                assert os.path.isfile(os.path.join(out_path, "test.html"))
+        finally:
+            dactyl_build.parse_page_content = real_parse_page_content
+            dactyl_build.config["out_path"] = old_out_path
+            dactyl_build.config["content_path"] = old_content_path
+        assert parsed == ["md_test"]
+        assert list(es.docs.keys()) == [("filters_target", "filters_target.test.html")]
+
+    def test_upload_es_json(self):
+        with StubESServer() as es:
+            dactyl_build.upload_es_json('{"name": "Page 1"}', "Test-Index",
+                                        es.base_url, "page1")
+        assert es.docs == {("test-index", "page1"): {"name": "Page 1"}}
+
+    def test_render_pages_es_publish_partial(self):
+        old_out_path = dactyl_build.config["out_path"]
+        old_content_path = dactyl_build.config["content_path"]
+        real_render_page = dactyl_build.render_page
+        def failing_render_page(*args, **kwargs):
+            exit("build stopped")
+        dactyl_build.config["es_publish"] = True
+        try:
+            with tempfile.TemporaryDirectory() as out_path, StubESServer() as es:
+                dactyl_build.config["out_path"] = out_path
+                dactyl_build.config["content_path"] = "."
+                # Publishing one page would replace the whole live index
+                dactyl_build.render_pages("filters_target", mode="html",
+                        es_upload=es.base_url, only_page="test.html",
+                        bypass_errors=True)
+                assert es.indexes == set()
+                assert es.docs == {}
+
+                # A build that stops partway doesn't leave a new index behind
+                dactyl_build.render_page = failing_render_page
+                with self.assertRaises(SystemExit):
+                    dactyl_build.render_pages("filters_target", mode="html",
+                            es_upload=es.base_url)
+                assert es.indexes == set()
+                assert es.aliases == {}
+        finally:
+            dactyl_build.render_page = real_render_page
+            dactyl_build.config["es_publish"] = False
+            dactyl_build.config["out_path"] = old_out_path
+            dactyl_build.config["content_path"] = old_content_path
+
     def test_target_slug_name(self):
         print("target_slug_name is", dactyl_build.target_slug_name("conditionals"))
         fields_to_use = ["display_name"]
@@ -71,6 +544,25 @@ class TestDactylBuild(unittest.TestCase):
     def test_make_adhoc_target(self):
         assert dactyl_build.make_adhoc_target(["gfm-compat.md"]) == {'name': '__ADHOC__', 'display_name': 'GitHub Markdown Compatibility'}
 
+    def test_prefetch_remote_sources(self):
+        with StubWebServer() as web:
+            web.files["/page.md"] = "# Remote page"
+            pages = [
+                {"name": "remote", "md": web.url("/page.md")},
+                {"name": "local", "md": "local.md"},
+                {"name": "spec", "openapi_specification": web.url("/ok/spec.yml")},
+            ]
+            fetcher = remote_fetch.configure()
+            try:
+                dactyl_build.prefetch_remote_sources(pages)
+                assert sorted(fetcher.fetched.keys()) == \
+                       [web.url("/ok/spec.yml"), web.url("/page.md")]
+                assert dactyl_build.read_markdown_remote(web.url("/page.md")) == \
+                       "# Remote page"
+                assert len(web.requests) == 2
+            finally:
+                remote_fetch.configure()
+
     def test_get_categories(self):
         assert dactyl_build.get_categories(dactyl_build.config["pages"]) == ['Filters', 'Tests', 'Markdown']
 
@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import tempfile
+import time
+import unittest
+import xml.etree.ElementTree as ET
+from unittest import mock
+from email.utils import formatdate
+
+import requests
+
+from dactyl import dactyl_link_checker
+from dactyl.link_cache import LinkCache
+from link_stub import StubWebServer
+
+class MockCliArgs:
+    version=None
+    bypass_errors=False
+    config="test-config.yml"
+    debug=False
+    quiet=False
+
+from dactyl.config import DactylConfig
+
+class MockDactylConfig(DactylConfig):
+    def load_filters(self):
+        pass
+
+dactyl_link_checker.config = MockDactylConfig(MockCliArgs)
+
+def write_site(out_path, pages):
+    """Write HTML files, given as {filename: body HTML}"""
+    for filename, body in pages.items():
+        with open(os.path.join(out_path, filename), "w", encoding="utf-8") as f:
+            f.write("<html><body>%s</body></html>" % body)
+
+class TestDactylLinkChecker(unittest.TestCase):
+    #IMPORTANT: Please run these tests from the "tests" directory, to ensure test config files and mocks are correctly loaded.
+
+    def setUp(self):
+        self.config = dactyl_link_checker.config
+        self.old_config = dict(self.config.config)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.out_path = self.tempdir.name
+        self.config["out_path"] = self.out_path
+        self.cache_path = os.path.join(self.out_path, "link-cache.jsonl")
+        self.config["link_cache_path"] = self.cache_path
+        self.config["link_check_retries"] = 0
+
+    def tearDown(self):
+        self.config.config = self.old_config
+        self.tempdir.cleanup()
+
+    def test_local_links(self):
+        write_site(self.out_path, {
+            "a.html": '<h1 id="top">A</h1><a href="b.html">B</a>'+
+                      '<a href="b.html#sec">B sec</a>'+
+                      '<a href="b.html#nope">bad anchor</a>'+
+                      '<a href="missing.html">missing</a>'+
+                      '<a href="#top">top</a>',
+            "b.html": '<a name="sec"></a>',
+        })
+        broken_links, num_checked = dactyl_link_checker.checkLinks()
+        a = os.path.join(self.out_path, "a.html")
+        assert broken_links == [(a, "b.html#nope"), (a, "missing.html")]
+
+    def test_remote_links_checked_once(self):
+        with StubWebServer() as web:
+            ok = web.url("/ok/1")
+            missing = web.url("/status/404/1")
+            write_site(self.out_path, {
+                "a.html": '<a href="%s">1</a><a href="%s">2</a><a href="missing.html">3</a><a href="%s">4</a>' %
+                          (ok, missing, missing),
+                "b.html": '<a href="%s">1</a>' % ok,
+            })
+            broken_links, num_checked = dactyl_link_checker.checkLinks()
+        a = os.path.join(self.out_path, "a.html")
+        # Each (page, target) pair is only reported once
+        assert broken_links == [(a, missing), (a, "missing.html")]
+        assert web.requests.count(("HEAD", "/ok/1")) == 1
+        # 404 from HEAD is retried with GET, but only once for both links
+        assert web.requests.count(("HEAD", "/status/404/1")) == 1
+        assert web.requests.count(("GET", "/status/404/1")) == 1
+
+    def test_images(self):
+        with StubWebServer() as web:
+            missing = web.url("/status/404/img")
+            write_site(self.out_path, {
+                "a.html": '<a href="b.html">1</a><a href="b.html">2</a><a href="#">3</a>'+
+                          '<img src="%s"><img src="nope.png"><img>' % missing+
+                          '<img src="a.png"><img src="nope.png">',
+                "b.html": "",
+            })
+            with open(os.path.join(self.out_path, "a.png"), "wb") as f:
+                f.write(b"")
+            broken_links, num_checked = dactyl_link_checker.checkLinks()
+        a = os.path.join(self.out_path, "a.html")
+        assert broken_links == [(a, missing), (a, "nope.png"), (a, "")]
+        assert web.requests.count(("HEAD", "/status/404/img")) == 1
+        assert num_checked == 5
+
+    def test_unparsed_reflinks(self):
+        write_site(self.out_path, {
+            "a.html": '<p>See [the docs][] and [more][docs].</p>'+
+                      '<script>var x = a[1][2];</script><!-- [not][] -->',
+        })
+        broken_links, num_checked = dactyl_link_checker.checkLinks()
+        a = os.path.join(self.out_path, "a.html")
+        assert broken_links == [(a, "[the docs][]")]
+
+    def test_page_links(self):
+        page = dactyl_link_checker.PageLinks()
+        page.feed('<h1 id="top">Top</h1><a name="n1"></a><a href="x.html#y">x</a>'+
+                  '<img src="i.png"><a href="a&amp;b.html">ab</a>')
+        page.close()
+        assert page.links == [("a", "x.html#y"), ("img", "i.png"), ("a", "a&b.html")]
+        assert page.ids == {"top"}
+        assert page.names == {"n1"}
+
+    def test_anchor_index(self):
+        os.makedirs(os.path.join(self.out_path, "sub"))
+        write_site(self.out_path, {
+            "a.html": '<a href="sub/z.html#z1">1</a><a href="sub/z.html#z2">2</a>'+
+                      '<a href="notes.txt#n">3</a><a href="notes.txt#m">4</a>',
+            "sub/z.html": '<h2 id="z1">Z1</h2><a href="../a.html#nope">a</a>',
+            "notes.txt": '<a name="n"></a>',
+        })
+        broken_links, num_checked = dactyl_link_checker.checkLinks()
+        a = os.path.join(self.out_path, "a.html")
+        z = os.path.join(self.out_path, "sub", "z.html")
+        assert sorted(broken_links) == sorted([(a, "sub/z.html#z2"),
+                (a, "notes.txt#m"), (z, "../a.html#nope")])
+
+    def test_anchor_index_limit(self):
+        pages = {"p%d.html" % i: "".join('<h2 id="p%d-h%d">x</h2>' % (i, j)
+                                         for j in range(20))
+                 for i in range(10)}
+        pages["index.html"] = "".join('<a href="p%d.html#p%d-h3">x</a>' % (i, i)
+                                      for i in range(10))
+        pages["index.html"] += '<a href="p1.html#p2-h3">bad</a>'
+        write_site(self.out_path, pages)
+        page = dactyl_link_checker.read_page_links(
+                os.path.join(self.out_path, "p0.html"))
+        one_page = dactyl_link_checker.anchors_size(frozenset(page.ids))
+
+        anchor_index = dactyl_link_checker.AnchorIndex(max_bytes=one_page * 3)
+        for filename in pages.keys():
+            path = os.path.join(self.out_path, filename)
+            page = dactyl_link_checker.read_page_links(path)
+            anchor_index.add(path, frozenset(page.ids | page.names))
+        assert len(anchor_index.anchors) <= 3
+        assert anchor_index.size <= one_page * 3
+        for i in range(10):
+            path = os.path.join(self.out_path, "p%d.html" % i)
+            assert anchor_index.has_anchor(path, "p%d-h3" % i)
+            assert not anchor_index.has_anchor(path, "p%d-h3" % (i+1))
+        assert anchor_index.rereads > 0
+
+        self.config["link_check_anchor_cache_mb"] = one_page * 3 / dactyl_link_checker.MB
+        broken_links, num_checked = dactyl_link_checker.checkLinks()
+        assert broken_links == [(os.path.join(self.out_path, "index.html"),
+                                 "p1.html#p2-h3")]
+
+    def test_parallel_jobs(self):
+        os.makedirs(os.path.join(self.out_path, "sub"))
+        pages = {}
+        for i in range(20):
+            pages["p%d.html" % i] = ('<h2 id="h%d">x</h2><a href="p%d.html#h%d">1</a>'+
+                    '<a href="sub/s%d.html">2</a><img src="i%d.png">') % (i, (i+1)%20, i%3, i%4, i)
+            pages["sub/s%d.html" % i] = '<a href="../p%d.html#h%d">x</a> [ref][]' % (i, i%2+i)
+        write_site(self.out_path, pages)
+        serial = dactyl_link_checker.checkLinks(offline=True)
+        parallel = dactyl_link_checker.checkLinks(offline=True, jobs=4)
+        assert len(serial[0]) > 20
+        assert parallel == serial
+
+    def test_remote_links_concurrent(self):
+        self.config["link_check_max_connections"] = 8
+        self.config["link_check_host_connections"] = 3
+        with StubWebServer() as web:
+            links = "".join('<a href="%s">x</a>' % web.url("/slow/0.3/%d" % i)
+                            for i in range(9))
+            write_site(self.out_path, {"a.html": links})
+            start = time.time()
+            broken_links, num_checked = dactyl_link_checker.checkLinks()
+            elapsed = time.time() - start
+        assert broken_links == []
+        assert num_checked == 9
+        assert web.max_in_flight == 3
+        assert elapsed < 9 * 0.3
+        assert len(web.connections) <= 3
+
+    def test_remote_links_host_delay(self):
+        self.config["link_check_host_delay"] = 0.2
+        with StubWebServer() as web:
+            links = "".join('<a href="%s">x</a>' % web.url("/ok/%d" % i)
+                            for i in range(4))
+            write_site(self.out_path, {"a.html": links})
+            start = time.time()
+            dactyl_link_checker.checkLinks()
+            elapsed = time.time() - start
+        assert elapsed >= 3 * 0.2
+
+    def test_known_broken_links(self):
+        with StubWebServer() as web:
+            missing = web.url("/status/404/1")
+            self.config["known_broken_links"] = [missing]
+            write_site(self.out_path, {"a.html": '<a href="%s">x</a>' % missing})
+            broken_links, num_checked = dactyl_link_checker.checkLinks()
+        assert broken_links == []
+        assert web.requests == []
+
+    def test_link_cache(self):
+        with StubWebServer() as web:
+            ok = web.url("/ok/1")
+            missing = web.url("/status/404/1")
+            write_site(self.out_path, {"a.html": '<a href="%s">1</a><a href="%s">2</a>' %
+                                                 (ok, missing)})
+            first = dactyl_link_checker.checkLinks()
+            num_requests = len(web.requests)
+            second = dactyl_link_checker.checkLinks()
+            assert len(web.requests) == num_requests
+        assert first == second
+        assert second[0] == [(os.path.join(self.out_path, "a.html"), missing)]
+        with open(self.cache_path, "r", encoding="utf-8") as f:
+            assert len(f.readlines()) == 2
+
+    def test_link_cache_private(self):
+        del self.config.config["link_cache_path"]
+        self.config["temporary_files_path"] = self.out_path
+        cache = dactyl_link_checker.get_link_cache()
+        cache_dir = os.path.dirname(cache.path)
+        assert os.path.basename(cache_dir) == "dactyl-link-cache-%d" % os.getuid()
+        assert os.stat(cache_dir).st_mode & 0o777 == 0o700
+        os.chmod(cache_dir, 0o777)
+        assert dactyl_link_checker.get_link_cache() is None
+
+    def test_link_cache_save_error(self):
+        # A file where the cache's folder should be
+        with open(os.path.join(self.out_path, "notadir"), "w") as f:
+            f.write("x")
+        cache = LinkCache(os.path.join(self.out_path, "notadir", "cache.jsonl"))
+        cache.update("http://example.com/", 200)
+        cache.save()
+
+    def test_link_cache_expiry(self):
+        self.config["link_cache_broken_ttl"] = 0
+        with StubWebServer() as web:
+            ok = web.url("/ok/1")
+            missing = web.url("/status/404/1")
+            write_site(self.out_path, {"a.html": '<a href="%s">1</a><a href="%s">2</a>' %
+                                                 (ok, missing)})
+            dactyl_link_checker.checkLinks()
+            web.requests = []
+            dactyl_link_checker.checkLinks()
+            # Only the broken link's result expired
+            assert web.requests == [("HEAD", "/status/404/1"),
+                                    ("GET", "/status/404/1")]
+            web.requests = []
+            dactyl_link_checker.checkLinks(max_age=0)
+            assert ("HEAD", "/ok/1") in web.requests
+
+    def test_link_cache_conditional_requests(self):
+        with StubWebServer() as web:
+            etag = web.url("/etag/1")
+            write_site(self.out_path, {"a.html": '<a href="%s">1</a>' % etag})
+            dactyl_link_checker.checkLinks()
+            broken_links, num_checked = dactyl_link_checker.checkLinks(max_age=0)
+            assert broken_links == []
+            assert web.request_headers[-1]["If-None-Match"] == '"v1"'
+            assert len(web.requests) == 2
+
+    def test_retries(self):
+        self.config["link_check_retries"] = 3
+        self.config["link_check_retry_delay"] = 0.05
+        with StubWebServer() as web:
+            flaky = web.url("/flaky/2/1")
+            down = web.url("/status/503/1")
+            write_site(self.out_path, {"a.html": '<a href="%s">1</a><a href="%s">2</a>' %
+                                                 (flaky, down)})
+            start = time.time()
+            broken_links, num_checked = dactyl_link_checker.checkLinks()
+            elapsed = time.time() - start
+        assert broken_links == [(os.path.join(self.out_path, "a.html"), down)]
+        assert web.requests.count(("HEAD", "/flaky/2/1")) == 3
+        assert web.requests.count(("HEAD", "/status/503/1")) == 4
+        # Backoff of about 0.05 + 0.1 + 0.2 seconds, not minutes
+        assert elapsed < 2
+
+    def test_retry_after(self):
+        self.config["link_check_retries"] = 1
+        self.config["link_check_retry_delay"] = 10
+        with StubWebServer() as web:
+            limited = web.url("/retryafter/1/1")
+            write_site(self.out_path, {"a.html": '<a href="%s">1</a>' % limited})
+            broken_links, num_checked = dactyl_link_checker.checkLinks()
+        assert broken_links == []
+        assert len(web.requests) == 2
+        assert 0.9 < web.request_times[1] - web.request_times[0] < 5
+
+    def test_retry_after_date(self):
+        r = requests.Response()
+        r.headers["Retry-After"] = formatdate(time.time() + 30, usegmt=True)
+        assert 25 < dactyl_link_checker.retry_after_secs(r) <= 30
+        r.headers["Retry-After"] = "nonsense"
+        assert dactyl_link_checker.retry_after_secs(r) is None
+
+    def test_offline(self):
+        write_site(self.out_path, {"a.html": '<a href="http://127.0.0.1:1/">x</a>'})
+        broken_links, num_checked = dactyl_link_checker.checkLinks(offline=True)
+        assert broken_links == []
+
+    def test_incremental(self):
+        self.config["link_cache_broken_ttl"] = 0
+        with StubWebServer() as web:
+            write_site(self.out_path, {
+                "a.html": '<a href="b.html#sec">B</a><a href="%s">1</a>' %
+                          web.url("/ok/a"),
+                "b.html": '<h2 id="sec">Sec</h2><a href="%s">2</a>' %
+                          web.url("/status/404/b"),
+                "c.html": '<a href="%s">3</a>' % web.url("/ok/c"),
+            })
+            first, num_first = dactyl_link_checker.checkLinks(incremental=True)
+            b = os.path.join(self.out_path, "b.html")
+            c = os.path.join(self.out_path, "c.html")
+            assert first == [(b, web.url("/status/404/b"))]
+
+            # b loses its anchor; c is rewritten with the same contents
+            write_site(self.out_path, {
+                "b.html": '<h2>Sec</h2><a href="%s">2</a>' %
+                          web.url("/status/404/b"),
+            })
+            mtime = os.stat(c).st_mtime
+            os.utime(c, (mtime + 10, mtime + 10))
+            web.requests = []
+            with mock.patch.object(dactyl_link_checker, "read_page_links",
+                    wraps=dactyl_link_checker.read_page_links) as read:
+                second, num_second = dactyl_link_checker.checkLinks(incremental=True)
+            assert [call[0][0] for call in read.call_args_list] == [b]
+            # Only the expired result was checked again
+            assert [path for method, path in web.requests] == \
+                   ["/status/404/b", "/status/404/b"]
+
+            # Remote links in unchanged pages don't keep their results longer
+            # than the link cache does
+            web.requests = []
+            dactyl_link_checker.checkLinks(incremental=True, max_age=0)
+            assert sorted(path for method, path in web.requests
+                          if method == "HEAD") == \
+                   ["/ok/a", "/ok/c", "/status/404/b"]
+        a = os.path.join(self.out_path, "a.html")
+        # a didn't change, but the anchor it links to went away
+        assert sorted(second) == [(a, "b.html#sec"), (b, web.url("/status/404/b"))]
+        assert num_second == num_first
+
+    def test_incremental_deleted_target(self):
+        write_site(self.out_path, {
+            "a.html": '<a href="b.html">B</a>',
+            "b.html": 'B',
+        })
+        broken_links, num_checked = dactyl_link_checker.checkLinks(incremental=True)
+        assert broken_links == []
+        os.remove(os.path.join(self.out_path, "b.html"))
+        broken_links, num_checked = dactyl_link_checker.checkLinks(incremental=True)
+        assert broken_links == [(os.path.join(self.out_path, "a.html"), "b.html")]
+
+    def test_reports(self):
+        self.config["known_broken_links"] = ["known.html"]
+        with StubWebServer() as web:
+            ok = web.url("/ok/1")
+            missing = web.url("/status/404/1")
+            write_site(self.out_path, {
+                "a.html": '<a href="%s">1</a><a href="%s">2</a><a href="known.html">3</a>' %
+                          (ok, missing),
+                "b.html": '<a href="%s">1</a>' % ok,
+            })
+            results = dactyl_link_checker.check_site()
+        a = os.path.join(self.out_path, "a.html")
+        b = os.path.join(self.out_path, "b.html")
+        assert results.broken_by_link == {missing: [a], "known.html": [a]}
+        assert sorted(results.referrers[ok]) == [a, b]
+        assert results.unknown_broken() == [(a, missing)]
+
+        json_path = os.path.join(self.out_path, "report.json")
+        results.write_json(json_path)
+        with open(json_path, "r", encoding="utf-8") as f:
+            report = json.load(f)
+        assert report["pages_checked"] == 2
+        assert {"page": "a.html", "link": missing, "status": 404,
+                "known": False} in report["broken"]
+        assert report["remote"][ok]["status"] == 200
+
+        junit_path = os.path.join(self.out_path, "report.xml")
+        results.write_junit(junit_path)
+        suite = ET.parse(junit_path).getroot()
+        assert suite.get("tests") == "2"
+        assert suite.get("failures") == "1"
+        failure = suite.find("testcase[@name='a.html']/failure")
+        assert failure.text == missing
+        results.write_junit(junit_path, strict=True)
+        failure = ET.parse(junit_path).getroot().find("testcase/failure")
+        assert failure.get("message") == "2 broken links"
+
+    def test_metrics_cache_hit_rate(self):
+        metrics_path = os.path.join(self.out_path, "metrics.jsonl")
+        self.config["link_check_metrics_interval"] = 0.05
+        with StubWebServer() as web:
+            write_site(self.out_path, {
+                "a.html": '<a href="%s">1</a><a href="%s">2</a>' %
+                          (web.url("/ok/1"), web.url("/slow/0.3/1")),
+                "b.html": '<a href="%s">1</a>' % web.url("/ok/1"),
+            })
+            dactyl_link_checker.check_site(metrics_path=metrics_path)
+            # Second run: both URLs come from the link cache
+            dactyl_link_checker.check_site(metrics_path=metrics_path)
+        with open(metrics_path, "r", encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f]
+        assert lines[-1]["event"] == "summary"
+        assert lines[-1]["cache_hit_rate"] == 1.0
+        assert lines[-1]["urls_queued"] == 0
+
+    def test_metrics_progress(self):
+        metrics_path = os.path.join(self.out_path, "metrics.jsonl")
+        self.config["link_check_metrics_interval"] = 0.05
+        self.config["link_cache_path"] = ""
+        with StubWebServer() as web:
+            host = web.base_url.split("://")[1]
+            write_site(self.out_path, {
+                "a.html": '<a href="%s">1</a><a href="%s">2</a>' %
+                          (web.url("/ok/1"), web.url("/slow/0.3/1")),
+            })
+            dactyl_link_checker.check_site(metrics_path=metrics_path)
+        with open(metrics_path, "r", encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f]
+        assert lines[-1]["event"] == "summary"
+        progress = [line for line in lines if line["event"] == "progress"]
+        assert progress
+        assert max(line["urls_in_flight"] for line in progress) >= 1
+        summary = lines[-1]
+        assert summary["pages_parsed"] == summary["pages_total"] == 1
+        assert summary["urls_queued"] == 2
+        assert summary["urls_in_flight"] == 0
+        latency = summary["hosts"][host]
+        assert latency["requests"] == 2
+        assert latency["histogram"]["500ms"] == 1
+        assert latency["max_ms"] >= 300
+
+    def test_benchmark_50k_links(self):
+        # Not a pass/fail benchmark; prints how long a synthetic site with
+        # 50,000 links takes to check, with a long known_broken_links list
+        num_pages = 500
+        self.config["known_broken_links"] = [
+                "http://example.com/known/%d" % i for i in range(5000)]
+        with StubWebServer() as web:
+            pages = {}
+            for i in range(num_pages):
+                links = []
+                for j in range(100):
+                    n = (i * 100 + j) % num_pages
+                    if j % 10 == 0:
+                        links.append(web.url("/ok/%d" % ((i * 10 + j // 10) % 200)))
+                    elif j % 10 < 5:
+                        links.append("p%d.html#s%d" % (n, j % 5))
+                    else:
+                        links.append("p%d.html?v=%d" % (n, j))
+                pages["p%d.html" % i] = "".join(
+                        '<h2 id="s%d">S</h2>' % k for k in range(5)) + \
+                        "".join('<a href="%s">x</a>' % l for l in links)
+            write_site(self.out_path, pages)
+            start = time.time()
+            results = dactyl_link_checker.check_site()
+            elapsed = time.time() - start
+        print("Checked %d links in %d pages, %.2fs (%d links/sec)" %
+              (results.num_links_checked, num_pages, elapsed,
+               results.num_links_checked/elapsed))
+        assert results.broken == []
+        assert len(results.statuses) == 200
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import threading
+import unittest
+
+import requests
+
+from dactyl.dev_server import DevServer, EVENTS_PATH, add_reload_script
+
+class TestDevServer(unittest.TestCase):
+    #IMPORTANT: Please run these tests from the "tests" directory, so test config files are loaded.
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.static_path = os.path.join(self.tempdir.name, "assets")
+        os.mkdir(self.static_path)
+        with open(os.path.join(self.static_path, "style.css"), "w") as f:
+            f.write("body {}")
+        with open(os.path.join(self.tempdir.name, "secret.txt"), "w") as f:
+            f.write("secret")
+        self.rendered = []
+        self.server = DevServer(self.render, static_dirs={"assets": self.static_path},
+                                port=0)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.tempdir.cleanup()
+
+    def render(self, path):
+        if path not in ("/index.html", "/a.html"):
+            return None
+        self.rendered.append(path)
+        return "<html><body>%s %d</body></html>" % (path, len(self.rendered))
+
+    def get(self, path):
+        return requests.get(self.server.url.rstrip("/") + path, timeout=5)
+
+    def test_add_reload_script(self):
+        html = add_reload_script("<html><body><p>Hi</p></body></html>")
+        assert html.startswith("<html><body><p>Hi</p><script>")
+        assert html.endswith("</script></body></html>")
+        assert EVENTS_PATH in html
+        assert add_reload_script("<p>Hi</p>").startswith("<p>Hi</p><script>")
+
+    def test_pages_rendered_on_demand(self):
+        assert self.rendered == []
+        r = self.get("/a.html")
+        assert r.status_code == 200
+        assert "/a.html 1" in r.text
+        assert "EventSource" in r.text
+        # Served from memory the second time
+        assert "/a.html 1" in self.get("/a.html").text
+        assert "/index.html 2" in self.get("/").text
+        assert self.rendered == ["/a.html", "/index.html"]
+
+    def test_invalidate(self):
+        self.get("/a.html")
+        self.get("/index.html")
+        self.server.invalidate(["/a.html"])
+        assert "/a.html 3" in self.get("/a.html").text
+        assert "/index.html 2" in self.get("/index.html").text
+        self.server.invalidate()
+        assert "/index.html 4" in self.get("/index.html").text
+
+    def test_static_files(self):
+        r = self.get("/assets/style.css")
+        assert r.status_code == 200
+        assert r.text == "body {}"
+        assert r.headers["Content-Type"] == "text/css"
+        assert self.get("/missing.html").status_code == 404
+        # Nothing outside the static folders
+        assert self.get("/assets/%2e%2e/secret.txt").status_code == 404
+
+    def test_render_error(self):
+        def broken_render(path):
+            raise ValueError("oops")
+        self.server.render = broken_render
+        r = self.get("/a.html")
+        assert r.status_code == 500
+        assert "oops" in r.text
+
+    def test_reload_events(self):
+        lines = []
+        connected = threading.Event()
+        def listen():
+            with requests.get(self.server.url.rstrip("/") + EVENTS_PATH,
+                              stream=True, timeout=5) as r:
+                for line in r.iter_lines(chunk_size=1, decode_unicode=True):
+                    lines.append(line)
+                    connected.set()
+                    if line.startswith("data:"):
+                        return
+        listener = threading.Thread(target=listen)
+        listener.start()
+        assert connected.wait(5)
+        self.server.reload()
+        listener.join(5)
+        assert not listener.is_alive()
+        assert "event: reload" in lines
+        assert "data: 1" in lines
+
+if __name__ == '__main__':
+    unittest.main()
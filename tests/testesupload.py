@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+import json
+import tempfile
+import time
+import unittest
+
+from dactyl.es_upload import ESBulkUploader, ESIndexPublisher, ESPublishError
+from es_stub import StubESServer
+
+def make_doc(i):
+    return json.dumps({"name": "Page %d" % i, "md": "Some *text*\n" * 20},
+                      indent=4)
+
+class TestESUpload(unittest.TestCase):
+    #IMPORTANT: Please run these tests from the "tests" directory, so the stub ES server can be imported.
+
+    def test_batches_by_doc_count(self):
+        with StubESServer() as es:
+            uploader = ESBulkUploader(es.base_url, max_docs=10, concurrency=2)
+            for i in range(25):
+                uploader.add(make_doc(i), "Test-Index", "page%d" % i)
+            uploader.close()
+        assert uploader.num_uploaded == 25
+        assert es.requests == 3
+        assert es.docs[("test-index", "page7")]["name"] == "Page 7"
+
+    def test_batches_by_size(self):
+        doc = make_doc(0)
+        with StubESServer() as es:
+            uploader = ESBulkUploader(es.base_url, max_bytes=len(doc)*3)
+            for i in range(6):
+                uploader.add(doc, "test-index", "page%d" % i)
+            uploader.close()
+        assert len(es.docs) == 6
+        assert es.requests == 3
+
+    def test_keep_alive(self):
+        with StubESServer() as es:
+            uploader = ESBulkUploader(es.base_url, max_docs=1, concurrency=1)
+            for i in range(5):
+                uploader.add(make_doc(i), "test-index", "page%d" % i)
+            uploader.close()
+        assert es.requests == 5
+        assert len(es.connections) == 1
+
+    def test_retries_failed_batches(self):
+        with StubESServer() as es:
+            es.fail_requests = 2
+            es.fail_status = 429
+            uploader = ESBulkUploader(es.base_url, backoff=0.01)
+            uploader.add(make_doc(1), "test-index", "page1")
+            uploader.close()
+        assert es.requests == 3
+        assert ("test-index", "page1") in es.docs
+
+    def test_retries_failed_docs(self):
+        with StubESServer() as es:
+            es.item_failures["page2"] = 1
+            uploader = ESBulkUploader(es.base_url, backoff=0.01)
+            for i in range(3):
+                uploader.add(make_doc(i), "test-index", "page%d" % i)
+            uploader.close()
+        assert es.requests == 2
+        assert len(es.docs) == 3
+
+    def test_gives_up_after_retries(self):
+        with StubESServer() as es:
+            es.fail_requests = 10
+            uploader = ESBulkUploader(es.base_url, max_retries=2, backoff=0.01,
+                                      bypass_errors=True)
+            uploader.add(make_doc(1), "test-index", "page1")
+            uploader.close()
+        assert es.requests == 3
+        assert uploader.num_failed == 1
+
+    def test_rejected_doc_is_recoverable_error(self):
+        with StubESServer() as es:
+            es.rejected_ids.add("page1")
+            uploader = ESBulkUploader(es.base_url, bypass_errors=True)
+            for i in range(3):
+                uploader.add(make_doc(i), "test-index", "page%d" % i)
+            uploader.close()
+            assert uploader.num_uploaded == 2
+            assert uploader.num_failed == 1
+
+            uploader = ESBulkUploader(es.base_url)
+            uploader.add(make_doc(1), "test-index", "page1")
+            with self.assertRaises(SystemExit):
+                uploader.close()
+
+    def test_missing_results_are_failures(self):
+        with StubESServer() as es:
+            es.drop_items = 1
+            uploader = ESBulkUploader(es.base_url, bypass_errors=True)
+            for i in range(3):
+                uploader.add(make_doc(i), "test-index", "page%d" % i)
+            uploader.close()
+        assert uploader.num_uploaded == 0
+        assert uploader.failed_ids == {"page0", "page1", "page2"}
+
+    def publish(self, es, manifest_dir, docs, **kwargs):
+        publisher = ESIndexPublisher(es.base_url, "Test-Alias", manifest_dir,
+                                     backoff=0.01, **kwargs)
+        for id, doc in docs.items():
+            publisher.add(json.dumps(doc), "test-alias", id)
+        publisher.close(docs.keys())
+        return publisher
+
+    def test_publish_uploads_only_changes(self):
+        docs = {"page%d" % i: {"name": "Page %d" % i} for i in range(5)}
+        with StubESServer() as es, tempfile.TemporaryDirectory() as manifest_dir:
+            first = self.publish(es, manifest_dir, docs)
+            assert es.aliases == {first.index: "test-alias"}
+            assert len(es.indexed) == 5
+
+            docs["page1"] = {"name": "Changed"}
+            del docs["page3"]
+            es.indexed = []
+            second = self.publish(es, manifest_dir, docs)
+            assert second.index != first.index
+            assert second.reused
+            assert es.indexed == [(second.index, "page1")]
+            assert es.aliases == {second.index: "test-alias"}
+            assert es.indexes == {second.index}
+            live_docs = es.alias_docs("test-alias")
+            assert sorted(live_docs.keys()) == ["page0", "page1", "page2", "page4"]
+            assert live_docs["page1"] == {"name": "Changed"}
+
+    def test_publish_without_manifest(self):
+        docs = {"page%d" % i: {"name": "Page %d" % i} for i in range(3)}
+        with StubESServer() as es:
+            with tempfile.TemporaryDirectory() as manifest_dir:
+                self.publish(es, manifest_dir, docs)
+            es.indexed = []
+            with tempfile.TemporaryDirectory() as manifest_dir:
+                publisher = self.publish(es, manifest_dir, {"page0": docs["page0"]})
+            assert not publisher.reused
+            assert len(es.indexed) == 1
+            assert list(es.alias_docs("test-alias").keys()) == ["page0"]
+
+    def test_publish_replaces_plain_index(self):
+        with StubESServer() as es, tempfile.TemporaryDirectory() as manifest_dir:
+            uploader = ESBulkUploader(es.base_url)
+            uploader.add(make_doc(1), "test-alias", "old-page")
+            uploader.close()
+            self.publish(es, manifest_dir, {"page1": {"name": "Page 1"}})
+            assert "test-alias" not in es.indexes
+            assert list(es.alias_docs("test-alias").keys()) == ["page1"]
+
+    def test_publish_failure_keeps_live_index(self):
+        docs = {"page1": {"name": "Page 1"}}
+        with StubESServer() as es, tempfile.TemporaryDirectory() as manifest_dir:
+            first = self.publish(es, manifest_dir, docs)
+            es.rejected_ids.add("page2")
+            docs["page2"] = {"name": "Page 2"}
+            with self.assertRaises(SystemExit):
+                self.publish(es, manifest_dir, docs)
+            assert es.aliases == {first.index: "test-alias"}
+            assert es.indexes == {first.index}
+
+    def test_publish_refuses_incomplete_index(self):
+        docs = {"page1": {"name": "Page 1"}, "page2": {"name": "Page 2"}}
+        with StubESServer() as es, tempfile.TemporaryDirectory() as manifest_dir:
+            first = self.publish(es, manifest_dir, docs)
+            # A page that wasn't added (for example, because the build stopped
+            # partway through)
+            publisher = ESIndexPublisher(es.base_url, "Test-Alias", manifest_dir,
+                                         backoff=0.01)
+            publisher.add(json.dumps(docs["page1"]), "test-alias", "page1")
+            with self.assertRaises(ESPublishError):
+                publisher.close(["page1", "page2", "page3"])
+            assert es.aliases == {first.index: "test-alias"}
+            assert es.indexes == {first.index}
+
+            # A page that failed to upload, with errors bypassed
+            es.rejected_ids.add("page3")
+            docs["page3"] = {"name": "Page 3"}
+            with self.assertRaises(ESPublishError):
+                self.publish(es, manifest_dir, docs, bypass_errors=True)
+            assert es.aliases == {first.index: "test-alias"}
+            assert es.indexes == {first.index}
+            assert sorted(es.alias_docs("test-alias").keys()) == ["page1", "page2"]
+
+    def test_throughput(self):
+        # Not a pass/fail benchmark; prints docs/sec against a stub with some
+        # simulated latency so the numbers are comparable between runs
+        num_docs = 2000
+        with StubESServer(latency=0.005) as es:
+            start = time.time()
+            uploader = ESBulkUploader(es.base_url, max_docs=100, concurrency=4)
+            for i in range(num_docs):
+                uploader.add(make_doc(i), "test-index", "page%d" % i)
+            uploader.close()
+            elapsed = time.time() - start
+        print("Uploaded %d docs in %d requests, %.2fs (%d docs/sec)" %
+              (num_docs, es.requests, elapsed, num_docs/elapsed))
+        assert len(es.docs) == num_docs
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+from dactyl.pdf_chunks import ChunkedPdf, chunk_pages, first_page_numbers
+
+PRINCE_STUB = os.path.abspath("prince_stub.py")
+
+class TestPdfChunks(unittest.TestCase):
+    #IMPORTANT: Please run these tests from the "tests" directory, so the fake Prince can be found.
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.staging_dir = os.path.join(self.tempdir.name, "staging")
+        os.mkdir(self.staging_dir)
+        self.log_path = os.path.join(self.tempdir.name, "prince.log")
+        os.environ["PRINCE_STUB_LOG"] = self.log_path
+        self.chunks = [["a1.html", "a2.html"], ["b1.html"], ["c1.html", "c2.html"]]
+        for chunk in self.chunks:
+            for filename in chunk:
+                self.write_html(filename, filename.split(".")[0].upper())
+
+    def tearDown(self):
+        os.environ.pop("PRINCE_STUB_LOG", None)
+        os.environ.pop("PRINCE_STUB_DELAY", None)
+        self.tempdir.cleanup()
+
+    def write_html(self, filename, title, pages=1):
+        with open(os.path.join(self.staging_dir, filename), "w") as f:
+            f.write('<html><head><title>%s</title><meta name="pages" content="%d">'
+                    '</head></html>' % (title, pages))
+
+    def prince_runs(self):
+        if not os.path.isfile(self.log_path):
+            return []
+        with open(self.log_path) as f:
+            runs = [json.loads(line) for line in f]
+        os.remove(self.log_path)
+        return runs
+
+    def make(self, outfile, jobs=3):
+        chunked_pdf = ChunkedPdf(self.chunks, self.staging_dir,
+                                 [sys.executable, PRINCE_STUB, "--javascript"],
+                                 jobs=jobs)
+        chunked_pdf.make(outfile)
+        return chunked_pdf
+
+    def test_chunk_pages(self):
+        pages = [{"html": "1", "category": "A"}, {"html": "2", "category": "A"},
+                 {"html": "3", "category": "B"}, {"html": "4"},
+                 {"html": "5", "category": "A"}]
+        by_category = chunk_pages(pages, "category")
+        assert [[p["html"] for p in c] for c in by_category] == \
+                [["1", "2"], ["3"], ["4"], ["5"]]
+        by_pages = chunk_pages(pages, "pages", 2)
+        assert [[p["html"] for p in c] for c in by_pages] == \
+                [["1", "2"], ["3", "4"], ["5"]]
+
+    def test_first_page_numbers(self):
+        assert first_page_numbers([2, 1, 2]) == [1, 3, 4]
+
+    @unittest.skipUnless(pypdf, "needs pypdf")
+    def test_chunked_pdf(self):
+        os.environ["PRINCE_STUB_DELAY"] = "0.3"
+        self.write_html("a1.html", "A1", pages=2)
+        outfile = os.path.join(self.tempdir.name, "out.pdf")
+        self.make(outfile)
+        runs = self.prince_runs()
+        # Page numbers are guessed at first (one page per file), so the chunks
+        # after the first one are rendered again once its length is known
+        assert len(runs) == 5
+        first_pass = sorted(runs, key=lambda r: r["start"])[:3]
+        assert max(r["start"] for r in first_pass) < min(r["end"] for r in first_pass)
+        final = {tuple(r["inputs"]): r["first_page"] for r in runs}
+        assert final == {("a1.html", "a2.html"): 1, ("b1.html",): 4,
+                         ("c1.html", "c2.html"): 5}
+
+        reader = pypdf.PdfReader(outfile)
+        assert len(reader.pages) == 6
+        assert [o.title for o in reader.outline] == ["A1", "A2", "B1", "C1", "C2"]
+        assert reader.get_destination_page_number(reader.outline[3]) == 4
+        assert "C1 - page 5" in reader.pages[4].extract_text()
+
+    @unittest.skipUnless(pypdf, "needs pypdf")
+    def test_reuse_unchanged_chunks(self):
+        outfile = os.path.join(self.tempdir.name, "out.pdf")
+        self.make(outfile)
+        self.prince_runs()
+        chunked_pdf = self.make(outfile)
+        assert chunked_pdf.prince_runs == 0
+        assert self.prince_runs() == []
+
+        self.write_html("b1.html", "B1 changed")
+        self.make(outfile)
+        runs = self.prince_runs()
+        assert [r["inputs"] for r in runs] == [["b1.html"]]
+        reader = pypdf.PdfReader(outfile)
+        assert [o.title for o in reader.outline][2] == "B1 changed"
+
+        # A new chunk's length is guessed from the others
+        self.chunks[0].append("a3.html")
+        self.write_html("a3.html", "A3")
+        self.make(outfile)
+        runs = self.prince_runs()
+        assert sorted((r["inputs"][0], r["first_page"]) for r in runs) == \
+                [("a1.html", 1), ("b1.html", 4), ("c1.html", 5)]
+        assert len(pypdf.PdfReader(outfile).pages) == 6
+        assert len(os.listdir(os.path.join(self.staging_dir, "pdf-chunks"))) == 6
+
+        # A chunk getting longer shifts the numbering of the chunks after it
+        self.write_html("a2.html", "A2", pages=3)
+        self.make(outfile)
+        runs = self.prince_runs()
+        assert sorted((r["inputs"][0], r["first_page"]) for r in runs) == \
+                [("a1.html", 1), ("b1.html", 6), ("c1.html", 7)]
+        assert len(pypdf.PdfReader(outfile).pages) == 8
+
+if __name__ == '__main__':
+    unittest.main()
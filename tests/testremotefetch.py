@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import time
+import unittest
+
+import jinja2
+import requests
+
+from dactyl import remote_fetch
+from dactyl.jinja_loaders import FrontMatterRemoteLoader
+from link_stub import StubWebServer
+
+class TestRemoteFetch(unittest.TestCase):
+    #IMPORTANT: Please run these tests from the "tests" directory, so the stub web server can be imported.
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.cache_path = self.tempdir.name
+
+    def tearDown(self):
+        remote_fetch.configure()
+        self.tempdir.cleanup()
+
+    def test_fetch_once_per_build(self):
+        with StubWebServer() as web:
+            web.files["/page.md"] = "# Hello"
+            fetcher = remote_fetch.RemoteFetcher()
+            assert fetcher.fetch(web.url("/page.md")) == "# Hello"
+            assert fetcher.fetch(web.url("/page.md")) == "# Hello"
+            assert web.requests == [("GET", "/page.md")]
+            with self.assertRaises(requests.RequestException):
+                fetcher.fetch(web.url("/status/404/x.md"))
+        assert len(web.connections) == 1
+
+    def test_disk_cache(self):
+        with StubWebServer() as web:
+            web.files["/page.md"] = "# Hello"
+            first = remote_fetch.RemoteFetcher(self.cache_path)
+            first.fetch(web.url("/page.md"))
+            second = remote_fetch.RemoteFetcher(self.cache_path)
+            assert second.fetch(web.url("/page.md")) == "# Hello"
+            assert "If-None-Match" in web.request_headers[-1]
+            assert second.not_modified == 1
+
+            web.files["/page.md"] = "# Changed"
+            second.new_build()
+            assert second.fetch(web.url("/page.md")) == "# Changed"
+
+    def test_cache_save_error(self):
+        # A file where the cache folder should be
+        cache_path = os.path.join(self.cache_path, "notadir")
+        with open(cache_path, "w") as f:
+            f.write("x")
+        with StubWebServer() as web:
+            web.files["/page.md"] = "# Hello"
+            fetcher = remote_fetch.RemoteFetcher(cache_path)
+            assert fetcher.fetch(web.url("/page.md")) == "# Hello"
+
+    def test_offline(self):
+        with StubWebServer() as web:
+            web.files["/page.md"] = "# Hello"
+            url = web.url("/page.md")
+            remote_fetch.RemoteFetcher(self.cache_path).fetch(url)
+            offline = remote_fetch.RemoteFetcher(self.cache_path, offline=True)
+            assert offline.fetch(url) == "# Hello"
+            with self.assertRaises(requests.RequestException):
+                offline.fetch(web.url("/ok/other.md"))
+        assert len(web.requests) == 1
+
+    def test_unreachable_uses_cache(self):
+        with StubWebServer() as web:
+            web.files["/page.md"] = "# Hello"
+            url = web.url("/page.md")
+            remote_fetch.RemoteFetcher(self.cache_path).fetch(url)
+        # The server is gone now
+        fetcher = remote_fetch.RemoteFetcher(self.cache_path, timeout=1)
+        assert fetcher.fetch(url) == "# Hello"
+
+    def test_prefetch(self):
+        with StubWebServer() as web:
+            urls = [web.url("/slow/0.3/%d.md" % i) for i in range(6)]
+            urls.append(web.url("/status/404/missing.md"))
+            fetcher = remote_fetch.RemoteFetcher(concurrency=8)
+            start = time.time()
+            fetcher.prefetch(urls + urls)
+            elapsed = time.time() - start
+            assert web.max_in_flight > 1
+            assert elapsed < 1.5 # 6 x 0.3s one at a time
+            assert len(web.requests) == 7
+            for url in urls[:-1]:
+                assert fetcher.fetch(url) == ""
+            assert len(web.requests) == 7
+            with self.assertRaises(requests.RequestException):
+                fetcher.fetch(urls[-1])
+
+    def test_remote_template_loader(self):
+        with StubWebServer() as web:
+            web.files["/tpl/page.md"] = "---\ntitle: Hi\n---\n{% include 'inc.md' %}"
+            web.files["/tpl/inc.md"] = "Included"
+            remote_fetch.configure(self.cache_path)
+            for i in range(2):
+                loader = FrontMatterRemoteLoader()
+                env = jinja2.Environment(loader=loader)
+                assert env.get_template(web.url("/tpl/page.md")).render() == "Included"
+            assert loader.fm_map[web.url("/tpl/page.md")]["title"] == "Hi"
+            assert sorted(web.requests) == [("GET", "/tpl/inc.md"),
+                                            ("GET", "/tpl/page.md")]
+            source, filename, uptodate = loader.get_source(env, web.url("/tpl/page.md"))
+            assert uptodate()
+            with self.assertRaises(jinja2.TemplateNotFound):
+                env.get_template(web.url("/tpl/missing.md"))
+
+if __name__ == '__main__':
+    unittest.main()
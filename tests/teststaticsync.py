@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+from dactyl.static_sync import StaticSync, STATIC_MANIFEST_FILENAME
+
+class TestStaticSync(unittest.TestCase):
+    #IMPORTANT: Please run these tests from the "tests" directory, so test config files are loaded.
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tempdir.name, "assets")
+        self.out = os.path.join(self.tempdir.name, "out")
+        self.files = {
+            "style.css": "body {}",
+            "img/a.png": "A",
+            "img/icons/b.svg": "<svg/>",
+        }
+        for filename, text in self.files.items():
+            self.write(filename, text)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def write(self, filename, text):
+        path = os.path.join(self.src, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+
+    def read_out(self, filename):
+        with open(os.path.join(self.out, "assets", filename)) as f:
+            return f.read()
+
+    def sync(self, **kwargs):
+        static_sync = StaticSync(self.out, **kwargs)
+        static_sync.add_tree(self.src, "assets")
+        return static_sync.sync()
+
+    def test_sync_only_changed(self):
+        counts = self.sync(link=False)
+        assert counts["copied"] == 3
+        for filename, text in self.files.items():
+            assert self.read_out(filename) == text
+        assert os.path.isfile(os.path.join(self.out, STATIC_MANIFEST_FILENAME))
+
+        counts = self.sync(link=False)
+        assert counts["copied"] == 0
+        assert counts["unchanged"] == 3
+
+        self.write("img/a.png", "AA")
+        counts = self.sync(link=False)
+        assert counts["copied"] == 1
+        assert self.read_out("img/a.png") == "AA"
+
+    def test_changed_in_output(self):
+        self.sync(link=False)
+        with open(os.path.join(self.out, "assets", "style.css"), "w") as f:
+            f.write("p {}")
+        counts = self.sync(link=False)
+        assert counts["copied"] == 1
+        assert self.read_out("style.css") == "body {}"
+        os.remove(os.path.join(self.out, "assets", "style.css"))
+        assert self.sync(link=False)["copied"] == 1
+
+    def test_hard_links(self):
+        counts = self.sync(link=True)
+        assert counts["linked"] == 3
+        assert os.path.samefile(os.path.join(self.src, "style.css"),
+                                os.path.join(self.out, "assets", "style.css"))
+        # Editors usually replace files instead of writing to them
+        os.remove(os.path.join(self.src, "style.css"))
+        self.write("style.css", "p {}")
+        counts = self.sync(link=True)
+        assert counts["linked"] == 1
+        assert self.read_out("style.css") == "p {}"
+
+    def test_prune(self):
+        self.sync(link=False)
+        os.remove(os.path.join(self.src, "img", "icons", "b.svg"))
+        counts = self.sync(link=False)
+        assert counts["pruned"] == 0
+        assert os.path.isfile(os.path.join(self.out, "assets", "img", "icons", "b.svg"))
+
+        # Other files in the output folder are left alone
+        with open(os.path.join(self.out, "assets", "img", "other.txt"), "w") as f:
+            f.write("not synced")
+        counts = self.sync(link=False, prune=True)
+        assert counts["pruned"] == 1
+        assert not os.path.exists(os.path.join(self.out, "assets", "img", "icons"))
+        assert os.path.isfile(os.path.join(self.out, "assets", "img", "other.txt"))
+        assert os.path.isfile(os.path.join(self.out, "assets", "img", "a.png"))
+
+    def test_checksum(self):
+        path = os.path.join(self.src, "style.css")
+        st = os.stat(path)
+        self.sync(link=False)
+        # Without checksums, a touched file is copied again
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        assert self.sync(link=False, checksum=True)["copied"] == 1
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 2 * 10**9))
+        counts = self.sync(link=False, checksum=True)
+        assert counts["copied"] == 0
+        assert counts["unchanged"] == 3
+        # Same size, different contents
+        self.write("style.css", "body {;")
+        assert self.sync(link=False, checksum=True)["copied"] == 1
+
+    def test_single_file(self):
+        static_sync = StaticSync(self.out, link=False)
+        static_sync.add_file(os.path.join(self.src, "style.css"), "misc/style.css")
+        assert static_sync.sync()["copied"] == 1
+        with open(os.path.join(self.out, "misc", "style.css")) as f:
+            assert f.read() == "body {}"
+
+if __name__ == '__main__':
+    unittest.main()